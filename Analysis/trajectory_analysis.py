@@ -0,0 +1,256 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+from Modeling3d.batch_dynamics import rotation
+from State.state_schema import StateSchema
+
+# Samples per chunk when reducing a trajectory; a memory-mapped file is read
+# one chunk at a time
+CHUNK = 65536
+
+# Dive and climb segments whose depth changes by less than this (m) are
+# merged into their neighbours: the vertical speed flickers around zero
+# while the glider pitches over
+MIN_DEPTH_CHANGE = 1.0
+
+# Reductions of the segment fields when consecutive runs of samples are joined
+FIRST = ("t_start", "x_start", "y_start", "z_start")
+LAST = ("t_end", "x_end", "y_end", "z_end")
+MAX = ("z_max",)
+MIN = ("z_min",)
+SUM = ("distance", "path")
+
+
+class Trajectory:
+    # Output times t (T,) and states y (schema.size, T) of a run, in memory or
+    # memory-mapped from a trajectory file (see load_trajectory). States the
+    # schema does not integrate are taken from `constants`, e.g. rp3 in 2D.
+    def __init__(self, t, y, schema, constants=None):
+        self.t = t
+        self.y = y
+        self.schema = schema
+        self.constants = constants or {}
+
+    def __len__(self):
+        return len(self.t)
+
+    def chunks(self, size=CHUNK):
+        for a in range(0, len(self.t), size):
+            yield np.asarray(self.t[a : a + size]), np.asarray(self.y[:, a : a + size])
+
+
+def save_trajectory(path, t, y, schema, constants=None):
+    # A small JSON header plus a .npy file next to it holding one row per
+    # output time, (T, 1 + schema.size): the time, then the states
+    data = os.path.splitext(path)[0] + ".npy"
+    rows = np.lib.format.open_memmap(
+        data, mode="w+", dtype=float, shape=(len(t), 1 + schema.size)
+    )
+    rows[:, 0] = t
+    rows[:, 1:] = np.asarray(y).T
+    rows.flush()
+
+    header = {
+        "data": os.path.basename(data),
+        "states": list(schema.names),
+        "constants": constants or {},
+    }
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(header, file, indent=4)
+
+
+def load_trajectory(path):
+    with open(path, encoding="utf-8") as file:
+        header = json.load(file)
+
+    data = os.path.join(os.path.dirname(os.path.abspath(path)), header["data"])
+    rows = np.load(data, mmap_mode="r")
+
+    return Trajectory(
+        rows[:, 0], rows[:, 1:].T, StateSchema(header["states"]), header["constants"]
+    )
+
+
+def flight_state(y, schema, constants=None):
+    # Flight quantities at every sample of a (schema.size, ...) state array.
+    # Angles in radians; gamma is the flight path angle (negative diving) and
+    # the turn radius is signed like the heading rate, positive turning to
+    # starboard and inf in a straight glide. The velocity is relative to the
+    # water.
+    x = schema.view(y, constants)
+    v1, v2, v3 = x["v1"], x["v2"], x["v3"]
+    phi, theta, psi = x["phi"], x["theta"], x["psi"]
+
+    V = np.sqrt(v1**2 + v2**2 + v3**2)
+    R = rotation(phi, theta, psi)
+    velocity = np.einsum("...ij,j...->i...", R, np.array([v1, v2, v3]))
+    horizontal = np.hypot(velocity[0], velocity[1])
+
+    sphi, cphi = np.sin(phi), np.cos(phi)
+    psi_dot = (sphi * x["q"] + cphi * x["r"]) / np.cos(theta)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "V": V,
+            "alpha": np.arctan2(v3, v1),
+            "beta": np.arcsin(v2 / V),
+            "gamma": np.arctan2(-velocity[2], horizontal),
+            "course": np.arctan2(velocity[1], velocity[0]),
+            "psi_dot": psi_dot,
+            "turn_radius": horizontal / psi_dot,
+            "velocity": velocity,
+        }
+
+
+def _join(runs, starts):
+    # Joins the runs of each group (groups begin at `starts`)
+    ends = np.append(starts[1:], len(runs["direction"])) - 1
+    joined = {"direction": runs["direction"][starts]}
+    joined.update({name: runs[name][starts] for name in FIRST})
+    joined.update({name: runs[name][ends] for name in LAST})
+    joined.update({name: np.maximum.reduceat(runs[name], starts) for name in MAX})
+    joined.update({name: np.minimum.reduceat(runs[name], starts) for name in MIN})
+    joined.update({name: np.add.reduceat(runs[name], starts) for name in SUM})
+
+    return joined
+
+
+def _group_starts(direction):
+    return np.flatnonzero(np.diff(direction, prepend=0))
+
+
+def segments(trajectory, min_depth_change=MIN_DEPTH_CHANGE, chunk=CHUNK):
+    # Splits the trajectory into dives (direction +1, depth increasing) and
+    # climbs (-1). Every segment ends where the next one starts, so their
+    # times and distances add up to the whole run. Returns a dict of arrays,
+    # one entry per segment: start and end times and positions, the
+    # shallowest and deepest points, the horizontal path length (distance)
+    # and the path length through the water (path).
+    S, constants = trajectory.schema, trajectory.constants
+    runs = []
+    last = None
+
+    for t, y in trajectory.chunks(chunk):
+        x = S.view(y, constants)
+        flight = flight_state(y, S, constants)
+        point = {
+            "t": t,
+            "x": x["x"],
+            "y": x["y"],
+            "z": x["z"],
+            "V": flight["V"],
+            "direction": np.where(flight["velocity"][2] >= 0, 1, -1),
+        }
+
+        # Each sample carries the interval from the sample before it, so the
+        # last sample of the previous chunk (or the first sample, repeated)
+        # goes in front
+        if last is None:
+            last = {name: value[:1] for name, value in point.items()}
+        point = {name: np.concatenate([last[name], point[name]]) for name in point}
+        last = {name: value[-1:] for name, value in point.items()}
+
+        dt = np.diff(point["t"])
+        distance = np.hypot(np.diff(point["x"]), np.diff(point["y"]))
+        path = 0.5 * (point["V"][1:] + point["V"][:-1]) * dt
+
+        direction = point["direction"][1:]
+        starts = _group_starts(direction)
+        ends = np.append(starts[1:], len(direction)) - 1
+        z = point["z"][1:]
+
+        run = {"direction": direction[starts]}
+        for name in ("t", "x", "y", "z"):
+            run[name + "_start"] = point[name][starts]  # the sample before
+            run[name + "_end"] = point[name][ends + 1]
+        run["z_max"] = np.fmax(np.maximum.reduceat(z, starts), run["z_start"])
+        run["z_min"] = np.fmin(np.minimum.reduceat(z, starts), run["z_start"])
+        run["distance"] = np.add.reduceat(distance, starts)
+        run["path"] = np.add.reduceat(path, starts)
+        runs.append(run)
+
+    runs = {name: np.concatenate([run[name] for run in runs]) for name in runs[0]}
+    runs = _join(runs, _group_starts(runs["direction"]))
+
+    # Short runs take the direction of the segment before them (the first
+    # one, of the segment after it) and are joined to it
+    while len(runs["direction"]) > 1:
+        short = np.abs(runs["z_end"] - runs["z_start"]) < min_depth_change
+        if not short.any():
+            break
+        k = np.flatnonzero(short)[0]
+        runs["direction"][k] = runs["direction"][k - 1 if k > 0 else 1]
+        runs = _join(runs, _group_starts(runs["direction"]))
+
+    runs["duration"] = runs["t_end"] - runs["t_start"]
+    with np.errstate(invalid="ignore"):
+        runs["glide_angle"] = np.degrees(
+            np.arctan2(runs["z_start"] - runs["z_end"], runs["distance"])
+        )
+
+    return runs
+
+
+def yo_statistics(trajectory, min_depth_change=MIN_DEPTH_CHANGE, chunk=CHUNK):
+    # One entry per yo, a dive followed by the climb after it (a run that
+    # ends mid-yo leaves the last dive out): times, depth range, horizontal
+    # path length and displacement, the mean speed through the water and the
+    # glide angles (deg) of the dive and the climb
+    s = segments(trajectory, min_depth_change, chunk)
+    dive = np.flatnonzero((s["direction"][:-1] > 0) & (s["direction"][1:] < 0))
+    climb = dive + 1
+
+    duration = s["t_end"][climb] - s["t_start"][dive]
+    return {
+        "start": s["t_start"][dive],
+        "end": s["t_end"][climb],
+        "duration": duration,
+        "max_depth": np.fmax(s["z_max"][dive], s["z_max"][climb]),
+        "min_depth": np.fmin(s["z_min"][dive], s["z_min"][climb]),
+        "distance": s["distance"][dive] + s["distance"][climb],
+        "displacement": np.hypot(
+            s["x_end"][climb] - s["x_start"][dive],
+            s["y_end"][climb] - s["y_start"][dive],
+        ),
+        "speed": (s["path"][dive] + s["path"][climb]) / duration,
+        "dive_angle": s["glide_angle"][dive],
+        "climb_angle": s["glide_angle"][climb],
+    }
+
+
+def print_yos(yos):
+    print(
+        "\n{:>4} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9} {:>8} {:>8}".format(
+            "yo",
+            "start s",
+            "time s",
+            "depth m",
+            "dist m",
+            "disp m",
+            "speed",
+            "dive",
+            "climb",
+        )
+    )
+    for k in range(len(yos["start"])):
+        print(
+            "{:4d} {:8.0f} {:8.0f} {:9.1f} {:9.1f} {:9.1f} {:9.3f} {:8.1f} {:8.1f}".format(
+                k,
+                yos["start"][k],
+                yos["duration"][k],
+                yos["max_depth"][k],
+                yos["distance"][k],
+                yos["displacement"][k],
+                yos["speed"][k],
+                yos["dive_angle"][k],
+                yos["climb_angle"][k],
+            )
+        )
+
+
+if __name__ == "__main__":
+    # python -m Analysis.trajectory_analysis run.json
+    print_yos(yo_statistics(load_trajectory(sys.argv[1])))
@@ -0,0 +1,354 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from State.checkpoints import SegmentCache
+
+# Settings that name input files. Relative paths are taken from the
+# manifest's directory when the file is there, as every job runs in its own
+# directory.
+INPUTS = (
+    "glider",
+    "current",
+    "density",
+    "hydrotable",
+    "fleet",
+    "log",
+    "mission",
+    "turntable",
+    "tolerances",
+    "checkpoints",
+)
+
+# Settings that name output files, placed in the job's directory
+OUTPUTS = ("trajectory",)
+
+# Settings a job cannot take: plots and the live view would wait for a window
+FIXED = {"plot": [], "live": False}
+
+# Modes that can run as threads (-th): their models keep all their state,
+# and do not write files other than those of OUTPUTS
+THREAD_MODES = ("2D", "3D", "waypoint", "fleet")
+
+LEDGER = "ledger.json"
+
+
+def load_manifest(path):
+    # {"defaults": {...}, "scenario": [{...}, ...]} from a TOML or JSON file
+    if path.endswith(".toml"):
+        import tomllib
+
+        with open(path, "rb") as file:
+            return tomllib.load(file)
+
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def expand(manifest):
+    # Jobs of a manifest as {name: settings}. Every scenario is laid over the
+    # defaults; a list value is a range of settings and the scenario gives
+    # one job per combination, named after the scenario and those values
+    # ("spiral-angle=20-setrudder=5"). The settings are the long option
+    # names of main.py.
+    defaults = manifest.get("defaults", {})
+    jobs = {}
+    for k, scenario in enumerate(manifest["scenario"]):
+        settings = dict(defaults, **scenario)
+        name = str(settings.pop("name", "scenario{}".format(k)))
+        ranges = {
+            key: value for key, value in settings.items() if isinstance(value, list)
+        }
+
+        for values in itertools.product(*ranges.values()):
+            job = dict(settings, **dict(zip(ranges, values)))
+            label = "-".join(
+                [name]
+                + ["{}={}".format(key, value) for key, value in zip(ranges, values)]
+            )
+            label = label.replace(os.sep, "_").replace(" ", "")
+            if label in jobs:
+                raise ValueError("Two jobs are named {}".format(label))
+            jobs[label] = job
+
+    return jobs
+
+
+def job_arguments(settings, folder, directory):
+    # main.py arguments of a job, parsed as on the command line so that every
+    # value gets the type and default the CLI would give it. A fleet given
+    # inline is written to the job's directory.
+    from main import argument_parser
+
+    parser = argument_parser()
+    options = {action.dest: action for action in parser._actions}
+    argv = []
+    for key, value in settings.items():
+        if key not in options or key in FIXED:
+            raise ValueError("{} is not a setting of a batch job".format(key))
+
+        action = options[key]
+        if key == "fleet" and isinstance(value, dict):
+            path = os.path.join(directory, "fleet.json")
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(value, file, indent=4)
+            value = path
+        elif key in INPUTS and isinstance(value, str) and not os.path.isabs(value):
+            if os.path.exists(os.path.join(folder, value)):
+                value = os.path.join(folder, value)
+        elif key in OUTPUTS and isinstance(value, str):
+            value = os.path.join(directory, value)
+
+        if action.nargs == 0:
+            argv += [action.option_strings[-1]] if value else []
+        else:
+            argv += [action.option_strings[-1], str(value)]
+
+    # A bad value fails the job instead of exiting the batch
+    parser.exit_on_error = False
+    try:
+        args = parser.parse_args(argv)
+    except argparse.ArgumentError as error:
+        raise ValueError(str(error)) from None
+    for key, value in FIXED.items():
+        setattr(args, key, value)
+
+    return args
+
+
+def fly_job(name, settings, directory, folder):
+    # Runs one job and returns (name, error or None, wall time)
+    start = time.perf_counter()
+    error = None
+    try:
+        from main import main
+
+        main(job_arguments(settings, folder, directory))
+    except (Exception, SystemExit):
+        # argparse and scripts may still exit: the job fails, the batch goes on
+        error = traceback.format_exc()
+        print(error)
+
+    return name, error, time.perf_counter() - start
+
+
+def run_job(job):
+    # A job in a worker process, in its directory. The modes write their
+    # default outputs to vars/ of the working directory; pool processes run
+    # one job at a time, and the working directory is restored for the
+    # next. The job's output goes to output.txt there.
+    name, settings, directory, folder = job
+    cwd = os.getcwd()
+
+    os.makedirs(os.path.join(directory, "vars"), exist_ok=True)
+    os.chdir(directory)
+    try:
+        with open("output.txt", "w", encoding="utf-8") as output:
+            with contextlib.redirect_stdout(output):
+                import matplotlib
+
+                matplotlib.use("Agg")
+                return fly_job(*job)
+    finally:
+        os.chdir(cwd)
+
+
+class ThreadOutput:
+    # sys.stdout of a threaded batch: what a job thread prints goes to the
+    # output.txt of its job, anything else to the original stream
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, "output", None) or self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+
+def run_thread(job, stdout):
+    # A job in a thread of this process. The working directory is shared, so
+    # the outputs are given paths in the job's directory (OUTPUTS), and the
+    # job's prints reach its output.txt through stdout, a ThreadOutput.
+    name, settings, directory, folder = job
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "output.txt"), "w", encoding="utf-8") as output:
+        stdout.local.output = output
+        try:
+            return fly_job(*job)
+        finally:
+            stdout.local.output = None
+
+
+class Batch_Runner:
+    # Runs the jobs of a scenario manifest (-mf) in a pool of -w worker
+    # processes, or of -w threads with -th. Each job runs in
+    # <manifest without extension>/<job name>/, and a ledger there records
+    # every finished job with a digest of its settings. A new run of the
+    # same manifest skips the jobs done with unchanged settings, so an
+    # interrupted batch carries on where it stopped; failed jobs are run
+    # again.
+    def __init__(self, args):
+        self.args = args
+        self.mode = self.args.mode
+        self.info = self.args.info
+        self.workers = self.args.workers
+        self.threads = self.args.threads
+        self.manifest = self.args.manifest
+
+        self.initialization()
+
+    def initialization(self):
+        self.folder = os.path.dirname(os.path.abspath(self.manifest))
+        self.directory = os.path.splitext(os.path.abspath(self.manifest))[0]
+        self.jobs = expand(load_manifest(self.manifest))
+        if self.threads:
+            for name, settings in self.jobs.items():
+                if settings.get("mode", "2D") not in THREAD_MODES:
+                    raise ValueError(
+                        "{} cannot run as a thread: -th takes {} jobs".format(
+                            name, ", ".join(THREAD_MODES)
+                        )
+                    )
+        self.digests = {
+            name: SegmentCache.digest("", settings)
+            for name, settings in self.jobs.items()
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.ledger_path = os.path.join(self.directory, LEDGER)
+        self.ledger = {}
+        if os.path.isfile(self.ledger_path):
+            with open(self.ledger_path, encoding="utf-8") as file:
+                self.ledger = json.load(file)
+
+    def pending(self):
+        return [
+            name
+            for name in self.jobs
+            if self.ledger.get(name, {}).get("status") != "done"
+            or self.ledger[name]["digest"] != self.digests[name]
+        ]
+
+    def set_desired_trajectory(self):
+        pending = self.pending()
+        print(
+            "{} jobs, {} done before, {} to run with {} {}".format(
+                len(self.jobs),
+                len(self.jobs) - len(pending),
+                len(pending),
+                max(self.workers, 1),
+                "threads" if self.threads else "workers",
+            )
+        )
+
+        jobs = [
+            (
+                name,
+                self.jobs[name],
+                os.path.join(self.directory, name),
+                self.folder,
+            )
+            for name in pending
+        ]
+        self.start = time.perf_counter()
+        self.finished = 0
+        self.remaining = len(jobs)
+
+        if self.threads:
+            self.run_threads(jobs)
+        elif self.workers > 0:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(run_job, job) for job in jobs]
+                for future in as_completed(futures):
+                    self.record(*future.result())
+        else:
+            for job in jobs:
+                self.record(*run_job(job))
+
+        self.print_summary()
+
+    def run_threads(self, jobs):
+        # Jobs as threads of this process, which share its NumPy and SciPy
+        # and whatever they run outside the GIL. The threads' prints are
+        # sorted out by a ThreadOutput; the progress lines still reach the
+        # console.
+        import matplotlib
+
+        matplotlib.use("Agg")
+        stdout = sys.stdout
+        sys.stdout = ThreadOutput(stdout)
+        try:
+            with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as pool:
+                futures = [pool.submit(run_thread, job, sys.stdout) for job in jobs]
+                for future in as_completed(futures):
+                    self.record(*future.result())
+        finally:
+            sys.stdout = stdout
+
+    def record(self, name, error, elapsed):
+        # Ledger entry of a finished job, written at once (under a temporary
+        # name first, so an interruption never leaves a truncated ledger),
+        # and the progress line
+        self.ledger[name] = {
+            "status": "failed" if error else "done",
+            "digest": self.digests[name],
+            "time": elapsed,
+            "error": error.strip().splitlines()[-1] if error else None,
+        }
+        temporary = "{}.{}".format(self.ledger_path, os.getpid())
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(self.ledger, file, indent=4)
+        os.replace(temporary, self.ledger_path)
+
+        self.finished += 1
+        self.remaining -= 1
+        wall = time.perf_counter() - self.start
+        eta = wall / self.finished * self.remaining
+        print(
+            "[{:>{w}}/{}] {} {} in {:.1f} s | elapsed {} | ETA {}".format(
+                self.finished,
+                self.finished + self.remaining,
+                name,
+                "failed" if error else "done",
+                elapsed,
+                clock(wall),
+                clock(eta),
+                w=len(str(self.finished + self.remaining)),
+            ),
+            flush=True,
+        )
+
+    def print_summary(self):
+        failed = [
+            name
+            for name in self.jobs
+            if self.ledger.get(name, {}).get("status") == "failed"
+        ]
+        done = sum(
+            1 for name in self.jobs if self.ledger.get(name, {}).get("status") == "done"
+        )
+        print(
+            "\n{} of {} jobs done, {} failed".format(done, len(self.jobs), len(failed))
+        )
+        for name in failed:
+            print("  {}: {}".format(name, self.ledger[name]["error"]))
+        print("Job directories and ledger in {}".format(self.directory))
+
+
+def clock(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
@@ -0,0 +1,123 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+def _point_mass_blocks(r):
+    # Skew matrix of a point mass position and its contribution per unit mass
+    # to the rotational inertia, |r|^2 I - r r^T
+    S = np.array([[0.0, -r[2], r[1]], [r[2], 0.0, -r[0]], [-r[1], r[0], 0.0]])
+
+    return S, np.dot(r, r) * np.eye(3) - np.outer(r, r)
+
+
+# A run sees one glider, but sensitivity and Monte Carlo sweeps perturb the
+# masses and inertias of every sample, so the caches keep only the latest ones
+CACHE_SIZE = 32
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _fixed_point_mass_blocks(r):
+    # Blocks of a mass that never moves (rb, rw), which hit the cache on every
+    # RHS call
+    return _point_mass_blocks(np.array(r, dtype=float))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _rigid_body_blocks(M, J):
+    return np.array(M, dtype=float), np.array(J, dtype=float)
+
+
+def _key(a):
+    return tuple(map(tuple, np.asarray(a, dtype=float).reshape(3, -1)))
+
+
+def solve_control_forces(M, J, masses, positions, rhs, moving=1):
+    # Solves F u = rhs for the forces u_i on the internal point masses, where
+    #   F_ij = inv(M) + delta_ij I / m_i - r_i^ inv(J) r_j^
+    # is the (2x2 or, with mw != 0, 3x3) block matrix of control_transformation.
+    # F = diag(I / m_i) + U diag(inv(M), inv(J)) U^T with U_i = [I, r_i^], so by
+    # the Woodbury identity only the 6x6 matrix
+    #   K = [[M + m I, c^], [c^T, J + sum m_i (|r_i|^2 I - r_i r_i^T)]]
+    # (the inertia of the hull plus the point masses, c = sum m_i r_i) has to be
+    # solved, and that is done through the Schur complement of its first block.
+    # The first `moving` masses (rp) move and their blocks are computed on
+    # every call; those of the others are cached.
+    M, J = _rigid_body_blocks(_key(M), _key(J))
+
+    m_total = 0.0
+    c = np.zeros(3)
+    K22 = J.copy()
+    h1 = np.zeros(3)
+    h2 = np.zeros(3)
+    y = []
+    S = []
+    for i, (m, r, b) in enumerate(zip(masses, positions, rhs)):
+        r = np.asarray(r, dtype=float).ravel()
+        if i < moving:
+            S_i, I_i = _point_mass_blocks(r)
+        else:
+            S_i, I_i = _fixed_point_mass_blocks(tuple(r))
+        y_i = m * np.asarray(b, dtype=float).ravel()
+
+        m_total += m
+        c += m * r
+        K22 += m * I_i
+        h1 += y_i
+        h2 += y_i @ S_i
+        y.append(y_i)
+        S.append(S_i)
+
+    C = np.array([[0.0, -c[2], c[1]], [c[2], 0.0, -c[0]], [-c[1], c[0], 0.0]])
+    A = M + m_total * np.eye(3)
+    A_inv_C = np.linalg.solve(A, C)
+
+    beta = np.linalg.solve(K22 + C @ A_inv_C, h2 + C @ np.linalg.solve(A, h1))
+    a = np.linalg.solve(A, h1 - C @ beta)
+
+    return [y_i - m * (a + S_i @ beta) for m, y_i, S_i in zip(masses, y, S)]
+
+
+def solve_control_forces_batch(M, J, masses, positions, rhs):
+    # solve_control_forces for N gliders at once: M and J are (N, 3, 3) or
+    # (3, 3), masses (N,) or scalars, positions and rhs (N, 3) arrays.
+    n = len(rhs[0])
+    eye = np.eye(3)
+
+    m_total = 0.0
+    c = np.zeros((n, 3))
+    K22 = np.broadcast_to(J, (n, 3, 3)).copy()
+    h1 = np.zeros((n, 3))
+    h2 = np.zeros((n, 3))
+    y = []
+    for m, r, b in zip(masses, positions, rhs):
+        m = np.asarray(m, dtype=float)
+        m_col = np.broadcast_to(m, (n,))[:, None]
+        y_i = m_col * b
+
+        m_total = m_total + m
+        c += m_col * r
+        K22 += m_col[..., None] * (
+            np.sum(r * r, axis=1)[:, None, None] * eye - r[:, :, None] * r[:, None, :]
+        )
+        h1 += y_i
+        h2 += np.cross(y_i, r)
+        y.append(y_i)
+
+    C = np.zeros((n, 3, 3))
+    C[:, 0, 1], C[:, 0, 2] = -c[:, 2], c[:, 1]
+    C[:, 1, 0], C[:, 1, 2] = c[:, 2], -c[:, 0]
+    C[:, 2, 0], C[:, 2, 1] = -c[:, 1], c[:, 0]
+
+    A = M + np.broadcast_to(m_total, (n,))[:, None, None] * eye
+    A_inv_C = np.linalg.solve(A, C)
+    A_inv_h1 = np.linalg.solve(A, h1[..., None])
+
+    beta = np.linalg.solve(K22 + C @ A_inv_C, h2[..., None] + C @ A_inv_h1)
+    a = np.linalg.solve(A, h1[..., None] - C @ beta)[..., 0]
+    beta = beta[..., 0]
+
+    return [
+        y_i - np.broadcast_to(m, (n,))[:, None] * (a + np.cross(r, beta))
+        for m, y_i, r in zip(masses, y, positions)
+    ]
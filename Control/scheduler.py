@@ -0,0 +1,195 @@
+import numpy as np
+from scipy.integrate import BDF, DOP853, LSODA, RK23, RK45, OdeSolution, Radau
+from scipy.optimize import OptimizeResult
+
+METHODS = {
+    "RK23": RK23,
+    "RK45": RK45,
+    "DOP853": DOP853,
+    "Radau": Radau,
+    "BDF": BDF,
+    "LSODA": LSODA,
+}
+
+
+class Task:
+    # Discrete-time controller: law(t, y) is evaluated every `period` seconds
+    # from the sampled state and its output is held (zero-order hold) until
+    # the next tick. A law may keep its own state (integral, previous error)
+    # since it runs exactly once per tick. An output that moves by no more
+    # than `tolerance` from the held one is not applied, so that the solver
+    # is not restarted for it: the actuator command is resolved to the
+    # tolerance.
+    def __init__(self, name, period, law, tolerance=0.0):
+        self.name = name
+        self.period = period
+        self.law = law
+        self.tolerance = tolerance
+
+
+class Scheduler:
+    # Runs a set of Tasks at their own rates and integrates the continuous
+    # dynamics between controller ticks. fun(t, y) reads the held outputs from
+    # scheduler.held; they are constant between ticks, so the solver sees a
+    # smooth right-hand side. Held outputs that change at a tick restart the
+    # solver there, which costs a few right-hand side calls per tick: a
+    # sampled controller is about fidelity, not speed.
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.held = {}
+        self.ticks = {}
+        self.history = []
+
+    def start(self, t, y):
+        self.t0 = t
+        self.history = []
+        for task in self.tasks:
+            self.ticks[task.name] = 0
+        self.update(t, y)
+
+    def tick_time(self, task):
+        return self.t0 + self.ticks[task.name] * task.period
+
+    def next_tick(self):
+        return min(self.tick_time(task) for task in self.tasks)
+
+    def update(self, t, y):
+        # Runs every task due at t and tells whether a held output changed.
+        # Ticks are counted from the start so that their times do not drift
+        # with rounding.
+        changed = False
+        for task in self.tasks:
+            if self.tick_time(task) <= t + 1e-9 * task.period:
+                output = task.law(t, y)
+                held = self.held.get(task.name)
+                if held is None or np.any(np.abs(output - held) > task.tolerance):
+                    self.held[task.name] = output
+                    changed = True
+                self.ticks[task.name] += 1
+        self.history.append((t, dict(self.held)))
+
+        return changed
+
+    def held_at(self, t):
+        # Outputs held at time t of the last solve; at a tick, the new ones
+        k = np.searchsorted([tick for tick, held in self.history], t, side="right")
+        return self.history[max(k - 1, 0)][1]
+
+    def solve(
+        self, fun, t_span, y0, method="RK45", t_eval=None, dense_output=False, **options
+    ):
+        # solve_ivp over t_span with the outputs held between ticks. Returns
+        # the same fields, with sol.t the solver steps and the ticks when
+        # t_eval is None, plus sol.outputs: the held output of every task at
+        # sol.t.
+        #
+        # The solver steps across a tick and the state there is read from
+        # its dense output, at no right-hand side call. While the held
+        # outputs do not change, one solver runs through the ticks with its
+        # step size and history. When they change, the part of the step past
+        # the tick is dropped and a new solver starts there. The first solver
+        # and those started at a change stop at the next tick, since outputs
+        # that change at a tick tend to change at the next.
+        method = METHODS.get(method, method)
+        t, t_end = t_span
+        y = np.asarray(y0, dtype=float)
+        t_eval = None if t_eval is None else np.asarray(t_eval, dtype=float)
+
+        self.start(t, y)
+
+        times, states = [], []
+        ts, interpolants = [t], []
+        nfev, message, step, solver = 0, "", None, None
+        bound = min(self.next_tick(), t_end)
+
+        def record(t, t_next):
+            # Solver points and t_eval between t and t_next of the last step
+            if t_eval is None:
+                if t < solver.t < t_next:
+                    times.append([solver.t])
+                    states.append(solver.y[:, None])
+                return None
+
+            lower, upper = max(solver.t_old, t), min(solver.t, t_next)
+            points = t_eval[(t_eval >= lower) & (t_eval < upper)]
+            if len(points) == 0:
+                return None
+            dense = solver.dense_output()
+            times.append(points)
+            states.append(dense(points))
+            return dense
+
+        while t < t_end:
+            t_next = min(self.next_tick(), t_end)
+            if t_eval is None:
+                times.append([t])
+                states.append(y[:, None])
+            if solver is None:
+                if step:
+                    options["first_step"] = min(step, bound - t)
+                solver = method(fun, t, y, bound, **options)
+            elif solver.t > t:
+                # The rest of a step across the last tick
+                record(t, t_next)
+
+            while solver.status == "running" and solver.t < t_next:
+                message = solver.step()
+                if solver.status == "failed":
+                    break
+
+                dense = record(t, t_next)
+                if dense_output:
+                    ts.append(solver.t)
+                    interpolants.append(dense or solver.dense_output())
+
+            if solver.status == "failed":
+                nfev += solver.nfev
+                break
+
+            across = solver.t > t_next
+            t = t_next
+            y = solver.dense_output()(t) if across else solver.y
+            if self.update(t, y):
+                # A new right-hand side: the step past the tick is dropped,
+                # and the next solver starts from the step size the last one
+                # would have taken next instead of from its cautious initial
+                # step
+                if across and dense_output:
+                    ts[-1] = t
+                nfev += solver.nfev
+                step = getattr(solver, "h_abs", None)
+                solver, bound = None, min(self.next_tick(), t_end)
+            elif solver.t_bound < t_end:
+                # A solver stopped at the tick goes on to the end. LSODA takes
+                # its end time once, when it is created, and starts again.
+                if isinstance(solver, LSODA):
+                    nfev += solver.nfev
+                    step = getattr(solver, "h_abs", None)
+                    solver = None
+                else:
+                    solver.t_bound = t_end
+                    solver.status = "running"
+                bound = t_end
+
+        if solver is not None:
+            nfev += solver.nfev
+
+        if t >= t_end and (t_eval is None or t_eval[-1] >= t_end):
+            times.append([t])
+            states.append(y[:, None])
+
+        times = np.concatenate(times)
+        held = [self.held_at(t) for t in times]
+
+        return OptimizeResult(
+            t=times,
+            y=np.concatenate(states, axis=1),
+            sol=OdeSolution(ts, interpolants) if dense_output else None,
+            nfev=nfev,
+            status=0 if t >= t_end else -1,
+            success=t >= t_end,
+            message=message or "",
+            outputs={
+                task.name: np.array([h[task.name] for h in held]) for task in self.tasks
+            },
+        )
@@ -0,0 +1,404 @@
+import numpy as np
+import time
+from scipy.integrate import solve_ivp
+import utils
+from Environment.density import load_density_profile, displaced_mass_batch
+from Modeling2d.glider_model_2D import steady_glide
+from Modeling2d.planar_dynamics import PlanarDynamics
+from State.state_schema import STATE_2D
+from State.checkpoints import SegmentCache, file_signature
+from State.tolerances import absolute_tolerances, load_tolerances
+from Parameters.registry import load_glider
+
+SECONDS_PER_DAY = 86400.0
+
+# Relative tolerance of the simulated legs
+RTOL = 1e-8
+
+# Energies (J) are resolved to the relative tolerance times this
+ENERGY_SCALE = 1.0
+
+
+def pump_power(mb_dot, z, energy, g):
+    # The pump pushes water out (mb falling) against the hydrostatic pressure
+    # rho g z: volume rate mb_dot / rho, so rho cancels. Water is let in
+    # through a valve at no cost.
+    return np.maximum(-mb_dot, 0.0) * g * np.maximum(z, 0.0) / energy.PUMP_EFFICIENCY
+
+
+def moving_mass_power(u1, rp1_dot, energy):
+    # Work done by the actuator force u1 on the moving mass; work done on the
+    # actuator (the mass running downhill) is not recovered
+    return np.maximum(u1 * rp1_dot, 0.0) / energy.MOVING_MASS_EFFICIENCY
+
+
+def fly_leg(var, z0, duration, energy, rtol=RTOL, scales=None):
+    # One leg of the 2D model with the pump and moving mass energies (J)
+    # integrated along as two extra states, at the tolerances of the 2D legs
+    # (glider_model_2D.integrate_leg). Returns the state and the two energies
+    # at the end of the leg.
+    eom = PlanarDynamics(var)
+    i = STATE_2D.index
+
+    def rhs(t, y):
+        D = eom.set_eom(t, y[:-2])
+        return D + [
+            pump_power(D[i["mb"]], y[i["z"]], energy, eom.g),
+            moving_mass_power(eom.u1, D[i["rp1"]], energy),
+        ]
+
+    sol = solve_ivp(
+        rhs,
+        t_span=(0.0, duration),
+        y0=np.concatenate([z0, [0.0, 0.0]]),
+        method="RK45",
+        atol=np.append(
+            absolute_tolerances(STATE_2D, rtol, scales, steady_glide(var, z0, 0.0)),
+            [rtol * ENERGY_SCALE] * 2,
+        ),
+        rtol=rtol,
+    )
+
+    return sol.y[:-2, -1], sol.y[-2:, -1]
+
+
+class Energy_Budget:
+    # Energy use, range and endurance of a mission plan of yos between depth
+    # bands. Every leg is taken to be the steady glide of utils.glide_equilibrium
+    # (the closed form of the 2D set_desired_trajectory) and the actuators only
+    # work at the turns, so a plan of any length is costed with a few array
+    # operations over its legs. The first yos of the plan are also flown in
+    # full with the 2D dynamics to check the estimate.
+    def __init__(self, args):
+        self.args = args
+        self.mode = self.args.mode
+        self.glider_name = self.args.glider
+        self.info = self.args.info
+        self.checked_yos = self.args.cycle
+        self.pid_control = self.args.pid
+        self.density_file = self.args.density
+        self.hydro_table_file = self.args.hydrotable
+        self.checkpoints = self.args.checkpoints
+        self.rtol = RTOL
+        self.scales = load_tolerances(self.args.tolerances, "2D")
+
+        self.initialization()
+        self.load_plan()
+
+    def initialization(self):
+        self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
+
+        P = load_glider(self.glider_name, "2D")
+        self.params = P
+
+        self.mass_params = P.GLIDER_CONFIG
+        self.hydro_params = P.HYDRODYNAMICS
+        self.vars = P.VARIABLES
+        self.energy = P.ENERGY
+
+        self.mh = self.mass_params.HULL_MASS
+        self.mw = self.mass_params.FIXED_POINT_MASS
+        self.mm = self.mass_params.INT_MOVABLE_MASS
+        self.m = self.mass_params.FLUID_DISP_MASS
+
+        self.Mf = P.Mf
+        self.Jf = P.Jf
+
+        self.M = P.M
+        self.J = P.J  # J = Jf + Jh
+
+        self.density = load_density_profile(self.density_file)
+
+        self.var = {
+            "Mf": self.Mf,
+            "M": self.M,
+            "J": self.J,
+            "KL": self.hydro_params.KL,
+            "KL0": self.hydro_params.KL0,
+            "KD": self.hydro_params.KD,
+            "KD0": self.hydro_params.KD0,
+            "KM": self.hydro_params.KM,
+            "KM0": self.hydro_params.KM0,
+            "KOmega1": self.hydro_params.KOmega1,
+            "KOmega2": self.hydro_params.KOmega2,
+            "mh": self.mh,
+            "mw": self.mw,
+            "mm": self.mm,
+            "m": self.m,
+            "rp3": self.vars.rp3,
+            "rb1": self.vars.rb1,
+            "rb3": self.vars.rb3,
+            "rw1": self.vars.rw1,
+            "rw3": self.vars.rw3,
+            "rho_ref": self.mass_params.REF_DENSITY,
+            "hull_compressibility": self.mass_params.HULL_COMPRESSIBILITY,
+            "glider": self.glider_name,
+            "density_file": self.density_file,
+            "hydro_table_file": self.hydro_table_file,
+            "ballast_rate": self.vars.BALLAST_RATE,
+            "pid_control": self.pid_control,
+        }
+
+    def load_plan(self):
+        if self.args.mission is None:
+            # 30 days of yos between 5 and 100 m at the desired glide
+            plan = {
+                "segments": [
+                    {
+                        "glide_angle": self.args.angle,
+                        "speed": self.args.speed,
+                        "depth_band": [5.0, 100.0],
+                        "days": 30.0,
+                    }
+                ]
+            }
+        else:
+            plan = utils.load_json(self.args.mission)
+
+        segments = plan["segments"]
+
+        def column(key, default=None):
+            return np.array(
+                [segment.get(key, default) for segment in segments], dtype=float
+            )
+
+        self.glide_angle = np.radians(column("glide_angle", self.vars.GLIDE_ANGLE))
+        self.speed = column("speed", self.vars.SPEED)
+        band = np.array([segment["depth_band"] for segment in segments], dtype=float)
+        self.min_depth, self.max_depth = band.T
+
+        # Segments run for a number of yos, or for as many as fit in `days`
+        yo_time = (
+            2
+            * (self.max_depth - self.min_depth)
+            / (self.speed * np.sin(self.glide_angle))
+        )
+        yos = column("yos", np.nan)
+        days = column("days", np.nan)
+        self.yos = np.where(
+            np.isnan(yos),
+            np.maximum(np.round(days * SECONDS_PER_DAY / yo_time), 1),
+            yos,
+        ).astype(int)
+
+    def legs(self):
+        # Dive and climb legs of every yo of the plan, in order
+        k = np.repeat(np.arange(len(self.yos)), 2 * self.yos)
+        dive = np.arange(len(k)) % 2 == 0
+
+        return {
+            "e_i_d": np.where(dive, -1, 1) * self.glide_angle[k],
+            "speed": self.speed[k],
+            "z_start": np.where(dive, self.min_depth[k], self.max_depth[k]),
+            "z_end": np.where(dive, self.max_depth[k], self.min_depth[k]),
+        }
+
+    def equilibrium(self, legs):
+        # Trim of every leg for the water displaced where it starts, as
+        # glider_model_2D.set_leg
+        m_local = displaced_mass_batch(
+            self.m,
+            legs["z_start"],
+            self.density,
+            self.var["rho_ref"],
+            self.var["hull_compressibility"],
+            self.g,
+        )
+
+        return utils.glide_equilibrium(
+            legs["e_i_d"], legs["speed"], self.var, m=m_local
+        )
+
+    def estimate(self, legs):
+        # Energies (J), duration (s) and horizontal distance (m) of every leg
+        eq = self.equilibrium(legs)
+        V = legs["speed"]
+        e_i_d = legs["e_i_d"]
+
+        duration = np.abs(legs["z_end"] - legs["z_start"]) / (V * np.abs(np.sin(e_i_d)))
+
+        # Turn at the start of each leg from the trim of the previous one; the
+        # first leg starts trimmed
+        mb_prev = np.concatenate([eq["mb_d"][:1], eq["mb_d"][:-1]])
+        rp1_prev = np.concatenate([eq["rp1_d"][:1], eq["rp1_d"][:-1]])
+        theta_prev = np.concatenate([eq["theta_d"][:1], eq["theta_d"][:-1]])
+
+        # The pump runs at the depth of the turn. The moving mass is shifted
+        # uphill against mm g sin(theta) before the glider has pitched over.
+        pump = (
+            np.maximum(mb_prev - eq["mb_d"], 0.0)
+            * self.g
+            * np.maximum(legs["z_start"], 0.0)
+            / self.energy.PUMP_EFFICIENCY
+        )
+        moving_mass = (
+            self.mm
+            * self.g
+            * np.abs(np.sin(theta_prev))
+            * np.abs(eq["rp1_d"] - rp1_prev)
+            / self.energy.MOVING_MASS_EFFICIENCY
+        )
+
+        return {
+            "pump": pump,
+            "moving_mass": moving_mass,
+            "hotel": self.energy.HOTEL_LOAD * duration,
+            "duration": duration,
+            "distance": V * np.cos(e_i_d) * duration,
+        }
+
+    def set_desired_trajectory(self):
+        start = time.perf_counter()
+        legs = self.legs()
+        self.budget = self.estimate(legs)
+        elapsed = time.perf_counter() - start
+
+        self.print_summary(self.budget, elapsed)
+
+        if self.checked_yos > 0:
+            self.check(legs, min(self.checked_yos, self.yos[0]))
+
+    def print_summary(self, budget, elapsed):
+        energy = budget["pump"] + budget["moving_mass"] + budget["hotel"]
+        duration = np.sum(budget["duration"])
+        distance = np.sum(budget["distance"])
+        total = np.sum(energy)
+        capacity = self.energy.BATTERY_CAPACITY
+
+        print(
+            "\nMission plan: {} yos in {:.2f} days, {:.1f} km (estimated in {:.2f} ms)".format(
+                np.sum(self.yos),
+                duration / SECONDS_PER_DAY,
+                distance / 1000,
+                elapsed * 1000,
+            )
+        )
+        for name in ("pump", "moving_mass", "hotel"):
+            print(
+                "{}: {:.1f} kJ ({:.1f} %)".format(
+                    name,
+                    np.sum(budget[name]) / 1000,
+                    100 * np.sum(budget[name]) / total,
+                )
+            )
+        print(
+            "Total: {:.1f} kJ, {:.1f} % of the battery".format(
+                total / 1000, 100 * total / capacity
+            )
+        )
+
+        # The battery runs out during the plan, or the plan is flown over and
+        # over at its mean power and speed
+        used = np.cumsum(energy)
+        if used[-1] > capacity:
+            k = np.searchsorted(used, capacity)
+            print(
+                "Battery empty in leg {} of {}, after {:.2f} days and {:.1f} km".format(
+                    k,
+                    len(used),
+                    np.sum(budget["duration"][:k]) / SECONDS_PER_DAY,
+                    np.sum(budget["distance"][:k]) / 1000,
+                )
+            )
+        endurance = capacity / total * duration
+        print(
+            "Endurance: {:.1f} days, range: {:.0f} km".format(
+                endurance / SECONDS_PER_DAY, endurance * distance / duration / 1000
+            )
+        )
+
+    def check(self, legs, yos):
+        # Flies the first yos of the plan with the full 2D dynamics, each leg
+        # for its estimated duration, and compares the energies
+        n = 2 * yos
+        legs = {name: value[:n] for name, value in legs.items()}
+        eq = self.equilibrium(legs)
+        estimate = self.estimate(legs)
+
+        z = STATE_2D.pack(
+            {
+                "n1": [0.0, 0.0, legs["z_start"][0]],
+                "Omega": [0.0, 0.0, 0.0],
+                "v": [eq["v1_d"][0], 0.0, eq["v3_d"][0]],
+                "rp": [eq["rp1_d"][0], 0.0, self.var["rp3"]],
+                "rp_dot": [0.0, 0.0, 0.0],
+                "mb": eq["mb_d"][0],
+                "n2": [0.0, eq["theta_d"][0], 0.0],
+            }
+        )
+
+        # Legs whose inputs are unchanged since an earlier run with the same -ck
+        # directory are restored from their checkpoints, so editing the later
+        # segments of a plan only flies the legs from the first edited one on
+        cache = SegmentCache(
+            self.checkpoints,
+            {
+                "glider": self.params.definition(),
+                "files": [
+                    file_signature(self.density_file),
+                    file_signature(self.hydro_table_file),
+                ],
+                "z0": z,
+                "tolerances": [self.rtol, self.scales],
+            },
+        )
+
+        simulated = np.zeros((n, 2))
+        depth = np.zeros(n)
+        distance = np.zeros(n)
+        for k in range(n):
+            var = dict(self.var)
+            var.update(
+                glide_dir="D" if legs["e_i_d"][k] < 0 else "U",
+                theta_d=eq["theta_d"][k],
+                rp1_d=eq["rp1_d"][k],
+                mb_d=eq["mb_d"][k],
+                v1_d=eq["v1_d"][k],
+                v3_d=eq["v3_d"][k],
+            )
+            # The moving mass starts every leg from rest, as in the 2D mode
+            z[STATE_2D.index["rp1_dot"]] = 0.0
+            x0 = z[STATE_2D.index["x"]]
+            duration = estimate["duration"][k]
+            z, simulated[k] = cache.run(
+                {"leg": var, "duration": duration},
+                lambda: fly_leg(var, z, duration, self.energy, self.rtol, self.scales),
+            )
+            depth[k] = z[STATE_2D.index["z"]]
+            distance[k] = z[STATE_2D.index["x"]] - x0
+
+        cache.report("legs")
+
+        print("\nFirst {} yos flown in full, estimated / simulated".format(yos))
+        for k in range(n):
+            print(
+                "Leg {} | end depth {:.1f} / {:.1f} m | distance {:.1f} / {:.1f} m | pump {:.1f} / {:.1f} J | moving mass {:.2f} / {:.2f} J".format(
+                    k,
+                    legs["z_end"][k],
+                    depth[k],
+                    estimate["distance"][k],
+                    distance[k],
+                    estimate["pump"][k],
+                    simulated[k, 0],
+                    estimate["moving_mass"][k],
+                    simulated[k, 1],
+                )
+            )
+
+        total = {
+            "pump": (np.sum(estimate["pump"]), np.sum(simulated[:, 0])),
+            "moving_mass": (np.sum(estimate["moving_mass"]), np.sum(simulated[:, 1])),
+            "distance": (np.sum(estimate["distance"]), np.sum(distance)),
+        }
+        for name, (a, b) in total.items():
+            print(
+                "{}: estimated {:.2f}, simulated {:.2f} ({:+.1f} %)".format(
+                    name, a, b, 100 * (a - b) / b if b != 0 else 0.0
+                )
+            )
+        self.checked = total
+
+
+if __name__ == "__main__":
+    Z = Energy_Budget()
+    Z.set_desired_trajectory()
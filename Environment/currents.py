@@ -0,0 +1,128 @@
+import itertools
+import json
+import os
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+
+class CurrentField:
+    # Gridded, time-varying ocean current (inertial frame, m/s) on a uniform
+    # (t, x, y, z) grid. The header is a small JSON file, the samples live in a
+    # .npy file of shape (nt, nx, ny, nz, 3) that is memory-mapped, so only the
+    # cells that are actually visited are ever read from disk.
+    def __init__(self, path):
+        with open(path, encoding="utf-8") as file:
+            header = json.load(file)
+
+        data_path = os.path.join(os.path.dirname(os.path.abspath(path)), header["data"])
+        self.u = np.load(data_path, mmap_mode="r")
+
+        self.origin = np.array(header["origin"], dtype=float)  # t0, x0, y0, z0
+        self.spacing = np.array(header["spacing"], dtype=float)  # dt, dx, dy, dz
+
+        if self.u.ndim != 5 or self.u.shape[-1] != 3:
+            raise ValueError(
+                "Current field data must have shape (nt, nx, ny, nz, 3), got {}".format(
+                    self.u.shape
+                )
+            )
+        if len(self.origin) != 4 or len(self.spacing) != 4:
+            raise ValueError(
+                "Current field origin and spacing need 4 entries (t, x, y, z)"
+            )
+
+        self.shape = np.array(self.u.shape[:4])
+        self.upper = self.shape - 1
+        self.last_cell = np.maximum(self.shape - 2, 0)
+
+        self._shape = tuple(int(n) for n in self.shape)
+        self._origin = tuple(float(o) for o in self.origin)
+        self._spacing = tuple(float(s) for s in self.spacing)
+
+        # Corner values of the last visited cell. Consecutive RHS evaluations
+        # almost always fall in the same cell, so the memory-mapped file is only
+        # touched when the glider crosses a grid line. The field is shared by
+        # every run that loads the same file (load_current_field), so each
+        # thread keeps its own cell.
+        self._last = threading.local()
+
+    def _locate(self, q):
+        cell = []
+        frac = []
+        for k in range(4):
+            n = self._shape[k]
+            f = (q[k] - self._origin[k]) / self._spacing[k]
+            f = min(max(f, 0.0), n - 1)
+            i = min(int(f), max(n - 2, 0))
+            cell.append(i)
+            frac.append(f - i)
+
+        return tuple(cell), frac
+
+    def sample(self, t, x, y, z):
+        cell, frac = self._locate((t, x, y, z))
+
+        last = self._last
+        if cell != getattr(last, "cell", None):
+            index = [[i, min(i + 1, n - 1)] for i, n in zip(cell, self._shape)]
+            last.corners = np.array(self.u[np.ix_(*index)], dtype=float)
+            last.cell = cell
+
+        c = last.corners
+        for f in frac:
+            c = c[0] + f * (c[1] - c[0])
+
+        return c
+
+    def sample_batch(self, t, positions):
+        positions = np.atleast_2d(positions)
+        q = np.empty((len(positions), 4))
+        q[:, 0] = t
+        q[:, 1:] = positions
+
+        f = np.clip((q - self.origin) / self.spacing, 0.0, self.upper)
+        i0 = np.minimum(f.astype(int), self.last_cell)
+        i1 = np.minimum(i0 + 1, self.upper)
+        w = f - i0
+
+        out = np.zeros((len(positions), 3))
+        for corner in itertools.product((0, 1), repeat=4):
+            weight = np.ones(len(positions))
+            index = []
+            for k, c in enumerate(corner):
+                if c:
+                    weight = weight * w[:, k]
+                    index.append(i1[:, k])
+                else:
+                    weight = weight * (1 - w[:, k])
+                    index.append(i0[:, k])
+            out += weight[:, None] * self.u[tuple(index)]
+
+        return out
+
+
+@lru_cache(maxsize=None)
+def load_current_field(path):
+    if path is None:
+        return None
+
+    return CurrentField(path)
+
+
+def save_current_field(path, u, origin, spacing):
+    u = np.asarray(u, dtype=float)
+    if u.ndim == 4:
+        u = u[None]  # steady field
+
+    data = os.path.splitext(os.path.basename(path))[0] + ".npy"
+    np.save(os.path.join(os.path.dirname(os.path.abspath(path)), data), u)
+
+    header = {
+        "data": data,
+        "origin": list(origin),
+        "spacing": list(spacing),
+    }
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(header, file, indent=4)
@@ -0,0 +1,91 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+
+
+class DensityProfile:
+    # CTD-style water column read from a CSV file with columns
+    # depth (m), density (kg/m3) and optionally temperature (degC), salinity (PSU).
+    # The cast is resampled once onto a uniform depth table so that a lookup in
+    # the RHS is an index computation plus one linear blend.
+    def __init__(self, path, spacing=0.5):
+        data = np.loadtxt(path, delimiter=",", comments="#", ndmin=2)
+        if data.shape[1] < 2:
+            raise ValueError(
+                "Density profile needs at least depth and density columns: {}".format(
+                    path
+                )
+            )
+
+        order = np.argsort(data[:, 0])
+        depth = data[order, 0]
+
+        self.z0 = float(depth[0])
+        self.dz = float(spacing)
+        self.n = max(int(math.ceil((depth[-1] - self.z0) / self.dz)) + 1, 2)
+
+        grid = self.z0 + self.dz * np.arange(self.n)
+        self.tables = [
+            np.interp(grid, depth, data[order, k])
+            for k in range(1, 4)
+            if k < data.shape[1]
+        ]
+        self._tables = [table.tolist() for table in self.tables]
+
+    def _lookup(self, table, z):
+        f = (z - self.z0) / self.dz
+        f = min(max(f, 0.0), self.n - 1)
+        i = min(int(f), self.n - 2)
+        f -= i
+
+        return table[i] + f * (table[i + 1] - table[i])
+
+    def density(self, z):
+        return self._lookup(self._tables[0], z)
+
+    def density_batch(self, z):
+        f = np.clip((np.asarray(z, dtype=float) - self.z0) / self.dz, 0.0, self.n - 1)
+        i = np.minimum(f.astype(int), self.n - 2)
+        f = f - i
+        table = self.tables[0]
+
+        return table[i] + f * (table[i + 1] - table[i])
+
+    def temperature(self, z):
+        if len(self._tables) < 2:
+            return None
+
+        return self._lookup(self._tables[1], z)
+
+    def salinity(self, z):
+        if len(self._tables) < 3:
+            return None
+
+        return self._lookup(self._tables[2], z)
+
+
+@lru_cache(maxsize=None)
+def load_density_profile(path):
+    if path is None:
+        return None
+
+    return DensityProfile(path)
+
+
+def displaced_mass(m, z, profile=None, rho_ref=1025.0, compressibility=0.0, g=9.816):
+    # m is the displaced mass at the surface in water of density rho_ref. The hull
+    # shrinks with the hydrostatic pressure by `compressibility` (1/Pa).
+    rho = rho_ref if profile is None else profile.density(z)
+    volume_ratio = 1.0 - compressibility * rho_ref * g * max(z, 0.0)
+
+    return m * (rho / rho_ref) * volume_ratio
+
+
+def displaced_mass_batch(
+    m, z, profile=None, rho_ref=1025.0, compressibility=0.0, g=9.816
+):
+    rho = rho_ref if profile is None else profile.density_batch(z)
+    volume_ratio = 1.0 - compressibility * rho_ref * g * np.maximum(z, 0.0)
+
+    return m * (rho / rho_ref) * volume_ratio
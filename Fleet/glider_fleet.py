@@ -0,0 +1,560 @@
+import numpy as np
+import math
+import time
+from scipy.integrate import solve_ivp
+import utils
+from Environment.density import load_density_profile, displaced_mass_batch
+from Modeling3d.batch_dynamics import BatchDynamics, rotation
+from State.state_schema import STATE_3D
+from State.recording import DenseTrajectory, adaptive_times
+from State.checkpoints import SegmentCache, file_signature
+from State.tolerances import absolute_tolerances, load_tolerances
+from State.channels import channel_recorder
+from Turning.turn_table import load_turn_table
+from Parameters.registry import load_glider
+
+# Hybrid propagation: a glider is handed to the reduced-order propagator once
+# its rates and body acceleration are below RATE_TOL and ACCELERATION_TOL and
+# the ballast and moving mass have stopped, and back
+# to the full dynamics HANDOFF_HORIZON seconds before an inflection, a turn of
+# more than HEADING_TOL or a waypoint capture
+HANDOFF_HORIZON = 100.0
+HEADING_TOL = math.radians(2.0)
+RATE_TOL = 1e-5
+ACCELERATION_TOL = 1e-6
+
+# Relative tolerance of the fleet (solve_ivp's default); the absolute
+# tolerances follow from the state scales (State/tolerances.py)
+RTOL = 1e-3
+
+
+class Fleet_Motion:
+    def __init__(self, args):
+        self.args = args
+        self.mode = self.args.mode
+        self.glider_name = self.args.glider
+        self.info = self.args.info
+        self.plots = self.args.plot
+        self.current_file = self.args.current
+        self.density_file = self.args.density
+        self.hydro_table_file = self.args.hydrotable
+        self.output = self.args.output
+        self.propagation = self.args.propagation
+        self.checkpoints = self.args.checkpoints
+        self.rtol = RTOL
+        self.scales = load_tolerances(self.args.tolerances, "3D")
+        self.dense = DenseTrajectory()
+
+        self.initialization()
+        self.load_fleet()
+
+        self.trajectory = np.array([])
+        self.total_time = np.array([])
+
+    def initialization(self):
+        self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
+
+        P = load_glider(self.glider_name, "3D")
+        self.params = P
+
+        self.mass_params = P.GLIDER_CONFIG
+        self.hydro_params = P.HYDRODYNAMICS
+        self.vars = P.VARIABLES
+
+        self.mh = self.mass_params.HULL_MASS
+        self.mw = self.mass_params.FIXED_POINT_MASS
+        self.mb = self.mass_params.BALLAST_MASS
+        self.mm = self.mass_params.INT_MOVABLE_MASS
+        self.m = self.mass_params.FLUID_DISP_MASS
+
+        self.Mf = P.Mf
+        self.Jf = P.Jf
+
+        self.M = P.M
+        self.J = P.J  # J = Jf + Jh
+
+        self.density = load_density_profile(self.density_file)
+
+        # Same variables the single-glider models pass to their dynamics
+        # (glider_variables): the whole fleet shares one parameter set.
+        self.var = {
+            "Mf": self.Mf,
+            "M": self.M,
+            "J": self.J,
+            "KL": self.hydro_params.KL,
+            "KL0": self.hydro_params.KL0,
+            "KD": self.hydro_params.KD,
+            "KD0": self.hydro_params.KD0,
+            "K_beta": self.hydro_params.K_beta,
+            "KM": self.hydro_params.KM,
+            "KM0": self.hydro_params.KM0,
+            "K_MY": self.hydro_params.K_MY,
+            "K_MR": self.hydro_params.K_MR,
+            "KOmega11": self.hydro_params.KOmega11,
+            "KOmega12": self.hydro_params.KOmega12,
+            "KOmega13": self.hydro_params.KOmega13,
+            "mh": self.mh,
+            "mw": self.mw,
+            "mm": self.mm,
+            "m": self.m,
+            "rp2": 0.0,
+            "rp3": self.vars.rp3,
+            "rb1": self.vars.rb1,
+            "rb2": self.vars.rb2,
+            "rb3": self.vars.rb3,
+            "rw1": self.vars.rw1,
+            "rw2": self.vars.rw2,
+            "rw3": self.vars.rw3,
+            "rho_ref": self.mass_params.REF_DENSITY,
+            "hull_compressibility": self.mass_params.HULL_COMPRESSIBILITY,
+            "ballast_rate": self.vars.BALLAST_RATE,
+            "rudder": "enable",
+            "rudder_angle": 0.0,
+            "current_file": self.current_file,
+            "glider": self.glider_name,
+            "density_file": self.density_file,
+            "hydro_table_file": self.hydro_table_file,
+        }
+
+        self.beta_d = math.radians(self.vars.BETA)
+        self.phi0 = math.radians(self.vars.PHI)
+        self.theta0 = -math.radians(self.vars.THETA)
+
+    def load_fleet(self):
+        if self.args.fleet is None:
+            # Line abreast, 20 m apart, all heading for the waypoint-mode target
+            config = {
+                "gliders": [
+                    {
+                        "start": [0.0, 20.0 * k, 0.0],
+                        "waypoints": [[200.0, 70.0 + 20.0 * k]],
+                    }
+                    for k in range(self.args.gliders)
+                ]
+            }
+        else:
+            config = utils.load_json(self.args.fleet)
+
+        gliders = config["gliders"]
+        self.n = len(gliders)
+
+        self.duration = config.get("duration", 2000.0)
+        self.window = config.get("window", 50.0)
+        self.samples = config.get("samples_per_window", 25)
+        self.capture_radius = config.get("capture_radius", 20.0)
+        self.min_depth, self.max_depth = config.get("depth_band", [5.0, 100.0])
+
+        def column(key, default):
+            return np.array(
+                [glider.get(key, default) for glider in gliders], dtype=float
+            )
+
+        self.start = np.array(
+            [glider.get("start", [0.0, 0.0, 0.0]) for glider in gliders], dtype=float
+        )
+        self.psi0 = np.radians(column("psi0", self.vars.PSI))
+        self.glide_angle = np.radians(column("glide_angle", self.vars.GLIDE_ANGLE))
+        self.V_d = column("speed", self.vars.SPEED)
+        self.kp = column("kp", 3.5)
+        self.kd = column("kd", 0.5)
+        self.rudder_limit = np.radians(column("rudder_limit", 30.0))
+
+        # A waypoint inside the tightest turn the glider can fly is circled
+        # rather than reached, so the capture radius is at least the turn
+        # radius at full rudder, diving or climbing, from the turn table
+        self.capture_radius = np.full(self.n, float(self.capture_radius))
+        turns = load_turn_table(self.args.turntable)
+        if turns is not None:
+            radius = np.fmax(
+                np.abs(turns.radius(self.rudder_limit, 0.0, -self.glide_angle)),
+                np.abs(turns.radius(self.rudder_limit, 0.0, self.glide_angle)),
+            )
+            self.capture_radius = np.fmax(self.capture_radius, radius)
+            if self.info == True:
+                print("Capture radius (m): {}".format(np.round(self.capture_radius, 1)))
+
+        # Ragged waypoint lists padded with their last entry
+        self.n_wp = np.array([len(glider["waypoints"]) for glider in gliders])
+        self.waypoints = np.empty((self.n, self.n_wp.max(), 2))
+        for k, glider in enumerate(gliders):
+            wps = np.array(glider["waypoints"], dtype=float)[:, :2]
+            self.waypoints[k, : len(wps)] = wps
+            self.waypoints[k, len(wps) :] = wps[-1]
+        self.wp_index = np.zeros(self.n, dtype=int)
+        self.done = np.zeros(self.n, dtype=bool)
+
+    def set_equilibrium(self, mask, Z):
+        c = self.batch.controls
+
+        m_local = displaced_mass_batch(
+            self.m,
+            Z[mask, STATE_3D.index["z"]],
+            self.density,
+            self.var["rho_ref"],
+            self.var["hull_compressibility"],
+            self.g,
+        )
+        e_i_d = -c.glide_dir[mask] * self.glide_angle[mask]
+        eq = utils.glide_equilibrium(
+            e_i_d, self.V_d[mask], self.var, m=m_local, beta_d=self.beta_d
+        )
+
+        c.mb_d[mask] = eq["mb_d"]
+        c.rp1_d[mask] = eq["rp1_d"]
+
+        return eq
+
+    def update_controls(self, Z):
+        c = self.batch.controls
+        S = STATE_3D
+
+        x, y, z = Z[:, S.slice("n1")].T
+        distance = np.hypot(c.target[:, 0] - x, c.target[:, 1] - y)
+        captured = distance < self.capture_radius
+        self.done |= captured & (self.wp_index == self.n_wp - 1)
+        c.heading_control[self.done] = False  # fly on straight
+        advance = captured & (self.wp_index < self.n_wp - 1)
+        self.wp_index[advance] += 1
+        c.target = self.waypoints[np.arange(self.n), self.wp_index]
+
+        # Yo between the depth band limits
+        flip = ((c.glide_dir > 0) & (z >= self.max_depth)) | (
+            (c.glide_dir < 0) & (z <= self.min_depth)
+        )
+        if flip.any():
+            c.glide_dir[flip] = -c.glide_dir[flip]
+            self.set_equilibrium(flip, Z)
+
+        if self.info == True:
+            print(
+                "Gliders diving: {} | climbing: {} | waypoints reached: {}".format(
+                    np.sum(c.glide_dir > 0),
+                    np.sum(c.glide_dir < 0),
+                    np.sum(self.wp_index + self.done),
+                )
+            )
+
+    def set_desired_trajectory(self):
+        if self.propagation == "compare":
+            # The full run goes first, so the summary below is the hybrid one
+            full_time, full = self.fly(hybrid=False)
+
+        # With -rc or -rs the windows go to the record, and the full
+        # trajectory is only kept to compare the propagations
+        self.record = channel_recorder(self.args, STATE_3D)
+        start = time.perf_counter()
+        self.total_time, self.trajectory = self.fly(
+            hybrid=self.propagation != "full",
+            record=self.record,
+            keep=self.record is None or self.propagation == "compare",
+        )
+        elapsed = time.perf_counter() - start
+
+        for i in range(self.n):
+            print(
+                "Glider {} | final position (x, y, z) = ({:.1f}, {:.1f}, {:.1f}) m | waypoints reached: {}/{}".format(
+                    i,
+                    *self.final[i, 0:3],
+                    self.wp_index[i] + self.done[i],
+                    self.n_wp[i],
+                )
+            )
+
+        if self.propagation != "full":
+            print(
+                "\nReduced-order propagation for {:.1f} % of the glider time, {:.1f} s".format(
+                    100 * self.kinematic_time / (self.n * self.total_time[-1]),
+                    elapsed,
+                )
+            )
+        if self.propagation == "compare":
+            self.compare(full_time, full)
+
+        if self.record is not None:
+            self.record.close(self.args.trajectory)
+        if self.trajectory is not None:
+            utils.fleet_plots(self.total_time, self.trajectory, self.plots)
+
+    def fly(self, hybrid, record=None, keep=True):
+        # Returns the output times and the (N, STATE_3D.size, T) trajectory.
+        # With hybrid, gliders in a settled straight glide are moved on
+        # kinematically (see update_propagation) and only the others are
+        # integrated. The windows are also appended to `record`
+        # (State/channels.ChannelRecorder); without keep the trajectory is
+        # not stored and None is returned in its place.
+        self.batch = BatchDynamics(self.var, self.n, model=self.params)
+        c = self.batch.controls
+        c.heading_control[:] = True
+        c.kp, c.kd, c.rudder_limit = self.kp, self.kd, self.rudder_limit
+        c.capture_radius[:] = self.capture_radius
+        c.target = self.waypoints[:, 0].copy()
+        self.wp_index = np.zeros(self.n, dtype=int)
+        self.done = np.zeros(self.n, dtype=bool)
+        self.kinematic = np.zeros(self.n, dtype=bool)
+        self.kinematic_time = 0.0
+        self.kinematic_distance = np.zeros(self.n)
+
+        S = STATE_3D
+        Z = np.zeros((self.n, S.size))
+        Z[:, S.slice("n1")] = self.start
+        eq = self.set_equilibrium(np.ones(self.n, dtype=bool), Z)
+        Z[:, S.index["v1"]] = eq["v1_d"]
+        Z[:, S.index["v2"]] = eq["v2_d"]
+        Z[:, S.index["v3"]] = eq["v3_d"]
+        Z[:, S.index["rp3"]] = self.var["rp3"]
+        Z[:, S.index["mb"]] = eq["mb_d"]
+        Z[:, S.index["phi"]] = self.phi0
+        Z[:, S.index["theta"]] = self.theta0
+        Z[:, S.index["psi"]] = self.psi0
+        # The tolerances are scaled to the fleet's desired steady glide
+        self.trim = Z.copy()
+
+        windows = int(math.ceil(self.duration / self.window))
+        # The kinematic gliders are sampled on the output grid
+        adaptive = self.output == "adaptive" and not hybrid
+        if adaptive:
+            # Window lengths vary, so the chunks are joined at the end
+            chunks = [Z[:, :, None]]
+            time_chunks = [np.zeros(1)]
+        else:
+            trajectory = None
+            if keep:
+                trajectory = np.empty((self.n, S.size, windows * self.samples + 1))
+                trajectory[:, :, 0] = Z
+            total_time = np.empty(windows * self.samples + 1)
+            total_time[0] = 0.0
+        if record is not None:
+            record.append(np.zeros(1), Z[:, :, None])
+        self.final = Z
+
+        # Windows whose inputs are unchanged since an earlier run with the same
+        # -ck directory are restored from their checkpoints. Besides the fleet
+        # settings, a window only reads the waypoints the gliders are heading
+        # for, so editing the later waypoints of a route keeps the windows
+        # flown before any glider turns for them.
+        cache = SegmentCache(self.checkpoints, self.fleet_inputs(hybrid, adaptive))
+
+        for k in range(windows):
+            t = np.linspace(k * self.window, (k + 1) * self.window, self.samples + 1)
+
+            window = cache.run(
+                {"target": c.target, "last": self.wp_index == self.n_wp - 1},
+                lambda: self.fly_window(t, Z, adaptive),
+            )
+            if window is None:
+                if not adaptive:
+                    end = k * self.samples + 1
+                    if keep:
+                        trajectory = trajectory[:, :, :end]
+                    total_time = total_time[:end]
+                break
+
+            t, Y, sol = window
+            if adaptive:
+                self.dense.append(sol)
+
+            if np.any(self.kinematic):
+                distance = np.hypot(
+                    *(Y[self.kinematic, 0:2, -1] - Y[self.kinematic, 0:2, 0]).T
+                )
+                self.kinematic_distance[self.kinematic] += distance
+                self.kinematic_time += np.sum(self.kinematic) * self.window
+
+            if record is not None:
+                record.append(t[1:], Y[:, :, 1:])
+            if adaptive:
+                if keep:
+                    chunks.append(Y[:, :, 1:])
+                time_chunks.append(t[1:])
+            else:
+                end = (k + 1) * self.samples + 1
+                if keep:
+                    trajectory[:, :, k * self.samples + 1 : end] = Y[:, :, 1:]
+                total_time[k * self.samples + 1 : end] = t[1:]
+
+            Z = Y[:, :, -1].copy()
+            self.final = Z
+            self.update_controls(Z)
+            if hybrid:
+                self.update_propagation(t[-1], Z)
+
+        if adaptive:
+            trajectory = np.concatenate(chunks, axis=2) if keep else None
+            total_time = np.concatenate(time_chunks)
+
+        cache.report("windows")
+
+        return total_time, trajectory
+
+    def fly_window(self, t, Z, adaptive):
+        # Flies the fleet from the states Z over the output times t: the
+        # gliders on full dynamics are integrated, the kinematic ones moved
+        # on. Returns the output times, the (N, STATE_3D.size, T) states and,
+        # with adaptive, the solver solution for the dense output, or None if
+        # the integration fails.
+        S = STATE_3D
+        active = np.flatnonzero(~self.kinematic)
+        Y = np.empty((self.n, S.size, len(t)))
+        sol = None
+        if len(active):
+            batch = self.batch
+            if len(active) < self.n:
+                batch = BatchDynamics(
+                    self.var,
+                    len(active),
+                    controls=self.batch.controls.subset(active),
+                    model=self.params,
+                )
+
+            # LSODA switches to stiff steps through the yo inflections,
+            # where the forward speed briefly collapses. Gliders are
+            # uncoupled, so the Jacobian is banded (block diagonal) and
+            # costs 2 * S.size - 1 RHS calls whatever the fleet size.
+            sol = solve_ivp(
+                batch.derivatives,
+                t_span=(t[0], t[-1]),
+                y0=Z[active].ravel(),
+                method="LSODA",
+                lband=S.size - 1,
+                uband=S.size - 1,
+                t_eval=None if adaptive else t,
+                dense_output=adaptive,
+                atol=np.tile(
+                    absolute_tolerances(S, self.rtol, self.scales, self.trim.T),
+                    len(active),
+                ),
+                rtol=self.rtol,
+            )
+
+            if not sol.success:
+                print(
+                    "Fleet integration stopped at t = {} s: {}".format(
+                        sol.t[-1], sol.message
+                    )
+                )
+                return None
+
+            if adaptive:
+                t, y = adaptive_times(sol)
+                Y = y.reshape(self.n, S.size, -1)
+            else:
+                # (N * size, T) -> (N, size, T) is a view of the solver output
+                Y[active] = sol.y.reshape(len(active), S.size, -1)
+
+        if np.any(self.kinematic):
+            Y[self.kinematic] = self.glide(Z[self.kinematic], t)
+
+        return t, Y, sol if adaptive else None
+
+    def fleet_inputs(self, hybrid, adaptive):
+        # Everything but the waypoints that the flight of a window depends on
+        return {
+            "glider": self.params.definition(),
+            "var": self.var,
+            "files": [
+                file_signature(self.current_file),
+                file_signature(self.density_file),
+                file_signature(self.hydro_table_file),
+            ],
+            "fleet": [
+                self.window,
+                self.samples,
+                self.capture_radius,
+                [self.min_depth, self.max_depth],
+                self.start,
+                self.psi0,
+                self.glide_angle,
+                self.V_d,
+                self.kp,
+                self.kd,
+                self.rudder_limit,
+                [self.beta_d, self.phi0, self.theta0],
+            ],
+            "hybrid": hybrid,
+            "adaptive": adaptive,
+            "tolerances": [self.rtol, self.scales],
+        }
+
+    def glide(self, Z, t):
+        # Reduced-order propagator: the body state of a settled glider is
+        # frozen and its position moves on with the steady world velocity
+        # R v (plus the current where the window starts)
+        S = STATE_3D
+        R = rotation(Z[:, S.index["phi"]], Z[:, S.index["theta"]], Z[:, S.index["psi"]])
+        velocity = np.einsum("nij,nj->ni", R, Z[:, S.slice("v")])
+        if self.batch.current is not None:
+            velocity += self.batch.current.sample_batch(t[0], Z[:, S.slice("n1")])
+
+        Y = np.repeat(Z[:, :, None], len(t), axis=2)
+        Y[:, S.slice("n1")] += velocity[:, :, None] * (t - t[0])
+
+        return Y
+
+    def update_propagation(self, t, Z):
+        # Hand-off between the full dynamics and the reduced-order propagator.
+        # A glider is flown kinematically while it is settled and no
+        # inflection, turn or waypoint capture is due within HANDOFF_HORIZON
+        # seconds.
+        c = self.batch.controls
+        S = STATE_3D
+
+        D = self.batch.set_eom(t, Z)
+        velocity = D[:, S.slice("n1")]
+        x, y, z = Z[:, S.slice("n1")].T
+        horizon = HANDOFF_HORIZON
+
+        z_next = z + horizon * velocity[:, 2]
+        inflection = ((c.glide_dir > 0) & (z_next >= self.max_depth)) | (
+            (c.glide_dir < 0) & (z_next <= self.min_depth)
+        )
+
+        dx, dy = c.target[:, 0] - x, c.target[:, 1] - y
+        error = np.angle(np.exp(1j * (np.arctan2(dy, dx) - Z[:, S.index["psi"]])))
+        capture = np.hypot(dx, dy) < c.capture_radius + horizon * np.hypot(
+            velocity[:, 0], velocity[:, 1]
+        )
+        turn = c.heading_control & ((np.abs(error) > HEADING_TOL) | capture)
+
+        rp1, mb = Z[:, S.index["rp1"]], Z[:, S.index["mb"]]
+        settled = (
+            (np.linalg.norm(Z[:, S.slice("Omega")], axis=1) < RATE_TOL)
+            & (np.linalg.norm(D[:, S.slice("v")], axis=1) < ACCELERATION_TOL)
+            & (c.glide_dir * (rp1 - c.rp1_d) >= 0)
+            & (c.glide_dir * (mb - c.mb_d) >= 0)
+        )
+
+        self.kinematic = settled & ~inflection & ~turn
+
+    def compare(self, full_time, full):
+        # Error of the hybrid run against the full dynamics at the hybrid
+        # output times. With -o adaptive the full run records its own times,
+        # so its positions are interpolated onto those of the hybrid run.
+        position = np.array(
+            [
+                [np.interp(self.total_time, full_time, axis) for axis in glider[0:3]]
+                for glider in full
+            ]
+        )
+        error = np.linalg.norm(position - self.trajectory[:, 0:3], axis=1)
+        worst = np.max(error, axis=1)
+        km = self.kinematic_distance / 1000
+
+        print("\nHybrid against full dynamics")
+        for i in range(self.n):
+            print(
+                "Glider {} | position error max {:.2f} m, final {:.2f} m | {:.1f} km flown kinematically".format(
+                    i, worst[i], error[i, -1], km[i]
+                )
+            )
+        rate = np.max(worst / np.maximum(km, 1e-3))
+        print(
+            "Error bound: {:.2f} m, {:.3f} m per km flown kinematically".format(
+                np.max(worst), rate
+            )
+        )
+        self.error = error
+
+    def glider_trajectory(self, i):
+        # (STATE_3D.size, T) view of one glider, laid out like solver_array.T
+        # of the single-glider models: utils.plots(t, STATE_3D.view(...), plot)
+        return self.trajectory[i]
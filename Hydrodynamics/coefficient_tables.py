@@ -0,0 +1,172 @@
+import json
+import math
+from functools import lru_cache
+
+import numpy as np
+from scipy.interpolate import CubicSpline, RectBivariateSpline
+
+
+class UniformTable1D:
+    # Cubic spline through the tabulated points, sampled once onto a fine
+    # uniform grid. Lookups are then an index computation and a linear blend.
+    def __init__(self, x, y, resolution):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        order = np.argsort(x)
+        x, y = x[order], y[order]
+
+        if len(x) < 2:
+            raise ValueError("A coefficient table needs at least two points")
+
+        self.n = max(int(math.ceil((x[-1] - x[0]) / resolution)) + 1, 2)
+        self.x0 = float(x[0])
+        self.dx = float(x[-1] - x[0]) / (self.n - 1)
+
+        grid = self.x0 + self.dx * np.arange(self.n)
+        if len(x) > 2:
+            self.values = CubicSpline(x, y)(grid)
+        else:
+            self.values = np.interp(grid, x, y)
+        self._values = self.values.tolist()
+
+    def __call__(self, x):
+        f = (x - self.x0) / self.dx
+        f = min(max(f, 0.0), self.n - 1)
+        i = min(int(f), self.n - 2)
+        f -= i
+        v = self._values
+
+        return v[i] + f * (v[i + 1] - v[i])
+
+    def batch(self, x):
+        f = np.clip((np.asarray(x, dtype=float) - self.x0) / self.dx, 0.0, self.n - 1)
+        i = np.minimum(f.astype(int), self.n - 2)
+        f = f - i
+
+        return self.values[i] + f * (self.values[i + 1] - self.values[i])
+
+
+class UniformTable2D:
+    def __init__(self, x, y, z, resolution):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        z = np.asarray(z, dtype=float)
+
+        if len(x) < 2 or len(y) < 2 or z.shape != (len(x), len(y)):
+            raise ValueError(
+                "A 2D coefficient table needs shape ({}, {}), got {}".format(
+                    len(x), len(y), z.shape
+                )
+            )
+
+        spline = RectBivariateSpline(
+            x, y, z, kx=min(3, len(x) - 1), ky=min(3, len(y) - 1), s=0
+        )
+
+        self.nx = max(int(math.ceil((x[-1] - x[0]) / resolution)) + 1, 2)
+        self.ny = max(int(math.ceil((y[-1] - y[0]) / resolution)) + 1, 2)
+        self.x0 = float(x[0])
+        self.y0 = float(y[0])
+        self.dx = float(x[-1] - x[0]) / (self.nx - 1)
+        self.dy = float(y[-1] - y[0]) / (self.ny - 1)
+
+        self.values = spline(
+            self.x0 + self.dx * np.arange(self.nx),
+            self.y0 + self.dy * np.arange(self.ny),
+        )
+        self._values = self.values.tolist()
+
+    def __call__(self, x, y):
+        fx = (x - self.x0) / self.dx
+        fx = min(max(fx, 0.0), self.nx - 1)
+        i = min(int(fx), self.nx - 2)
+        fx -= i
+
+        fy = (y - self.y0) / self.dy
+        fy = min(max(fy, 0.0), self.ny - 1)
+        j = min(int(fy), self.ny - 2)
+        fy -= j
+
+        v = self._values
+        a = v[i][j] + fy * (v[i][j + 1] - v[i][j])
+        b = v[i + 1][j] + fy * (v[i + 1][j + 1] - v[i + 1][j])
+
+        return a + fx * (b - a)
+
+    def batch(self, x, y):
+        fx = np.clip((np.asarray(x, dtype=float) - self.x0) / self.dx, 0.0, self.nx - 1)
+        i = np.minimum(fx.astype(int), self.nx - 2)
+        fx = fx - i
+
+        fy = np.clip((np.asarray(y, dtype=float) - self.y0) / self.dy, 0.0, self.ny - 1)
+        j = np.minimum(fy.astype(int), self.ny - 2)
+        fy = fy - j
+
+        v = self.values
+        a = v[i, j] + fy * (v[i, j + 1] - v[i, j])
+        b = v[i + 1, j] + fy * (v[i + 1, j + 1] - v[i + 1, j])
+
+        return a + fx * (b - a)
+
+
+class HydroTable:
+    # Table-driven replacement for the linear/quadratic hydrodynamic model.
+    # The JSON file holds the axes "alpha", "beta" and "delta" (radians, or
+    # degrees with "angle_units": "deg") and the coefficients
+    #   CL, CD, CM        over alpha          (required)
+    #   CD_delta          over delta          (optional rudder drag)
+    #   CMR               over beta           (optional, lateral)
+    #   CSF, CMY          over (beta, delta)  (optional, lateral)
+    # Every coefficient multiplies V^2, like KL, KD, KM in Parameters/.
+    def __init__(self, path, resolution=math.radians(0.1)):
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+
+        scale = math.pi / 180 if data.get("angle_units", "rad") == "deg" else 1.0
+        axes = {
+            name: np.asarray(data[name], dtype=float) * scale
+            for name in ("alpha", "beta", "delta")
+            if name in data
+        }
+
+        self.CL = UniformTable1D(axes["alpha"], data["CL"], resolution)
+        self.CD = UniformTable1D(axes["alpha"], data["CD"], resolution)
+        self.CM = UniformTable1D(axes["alpha"], data["CM"], resolution)
+
+        self.CD_delta = None
+        if "CD_delta" in data:
+            self.CD_delta = UniformTable1D(axes["delta"], data["CD_delta"], resolution)
+
+        self.lateral = all(name in data for name in ("CMR", "CSF", "CMY"))
+        if self.lateral:
+            self.CMR = UniformTable1D(axes["beta"], data["CMR"], resolution)
+            self.CSF = UniformTable2D(
+                axes["beta"], axes["delta"], data["CSF"], resolution
+            )
+            self.CMY = UniformTable2D(
+                axes["beta"], axes["delta"], data["CMY"], resolution
+            )
+
+    def longitudinal(self, alpha):
+        return self.CL(alpha), self.CD(alpha), self.CM(alpha)
+
+    def longitudinal_batch(self, alpha):
+        return self.CL.batch(alpha), self.CD.batch(alpha), self.CM.batch(alpha)
+
+    def lateral_coefficients(self, beta, delta):
+        return self.CSF(beta, delta), self.CMR(beta), self.CMY(beta, delta)
+
+    def lateral_batch(self, beta, delta):
+        return (
+            self.CSF.batch(beta, delta),
+            self.CMR.batch(beta),
+            self.CMY.batch(beta, delta),
+        )
+
+
+@lru_cache(maxsize=None)
+def load_hydro_table(path):
+    if path is None:
+        return None
+
+    return HydroTable(path)
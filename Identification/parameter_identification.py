@@ -0,0 +1,469 @@
+import numpy as np
+import math
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import least_squares
+import utils
+from Modeling3d.batch_dynamics import BatchDynamics, MIN_SPEED, fly_batch
+from State.state_schema import STATE_3D
+from Parameters.registry import load_glider
+
+# Coefficients fitted to the log: HYDRODYNAMICS, then the GLIDER_CONFIG added
+# masses and inertias
+HYDRODYNAMICS = (
+    "KL",
+    "KL0",
+    "KD",
+    "KD0",
+    "K_beta",
+    "KM",
+    "KM0",
+    "K_MY",
+    "K_MR",
+    "KOmega11",
+    "KOmega12",
+    "KOmega13",
+)
+ADDED_MASS = ("MF1", "MF2", "MF3", "J1", "J2", "J3")
+FIT = HYDRODYNAMICS + ADDED_MASS
+
+# Lower bounds; drag and the added masses and inertias stay positive
+LOWER = {"KD": 0.0, "KD0": 0.0, "MF1": 0.1, "MF2": 0.1, "MF3": 0.1}
+LOWER.update({"J1": 0.1, "J2": 0.1, "J3": 0.1})
+
+# Forward difference step of the Jacobian, relative to the scale of each
+# unknown (max(|p|, 1) for the coefficients)
+RELATIVE_STEP = 1e-3
+
+# Prior on the coefficients: within PRIOR_SPREAD (relative to max(|p|, 1)) of
+# the values of the parameter file, one standard deviation. Keeps the
+# coefficients the log does not excite (most of the lateral ones in a log of
+# straight glides) where they are instead of letting them drift.
+PRIOR_SPREAD = 0.5
+
+# Scale (m/s) of the initial body velocities of the segments, which are
+# fitted along with the coefficients
+VELOCITY_SCALE = 0.1
+
+# Residual units: 1 m of depth weighs as much as 1 degree of attitude
+DEPTH_SCALE = 1.0
+ANGLE_SCALE = math.radians(1.0)
+
+# Segment simulations kept, keyed by segment, coefficients and initial velocity
+CACHE_SIZE = 4096
+
+# Seconds of log at the start of a segment the initial rates are fitted to
+RATE_WINDOW = 10.0
+
+# Integration tolerances of the segment simulations. The copies differenced
+# for the Jacobian share a batch and so a step sequence, which keeps the
+# integration error out of the differences at these tolerances.
+RTOL = 1e-7
+ATOL = 1e-9
+
+LOG_COLUMNS = ("time", "depth", "pitch", "roll", "heading", "pump", "battery")
+
+
+class DiveLog:
+    # Glider log read from a CSV file with columns time (s), depth (m), pitch,
+    # roll, heading (deg), pump (cm3 of water taken on, relative to the
+    # neutral BALLAST_MASS) and battery (cm, position rp1 of the movable mass).
+    # Rows with a missing value are dropped and the rest resampled every
+    # `spacing` seconds.
+    def __init__(self, path, spacing=2.0):
+        data = np.loadtxt(path, delimiter=",", comments="#", ndmin=2)
+        if data.shape[1] < len(LOG_COLUMNS):
+            raise ValueError(
+                "Dive log needs the columns {}: {}".format(", ".join(LOG_COLUMNS), path)
+            )
+
+        data = data[np.all(np.isfinite(data[:, : len(LOG_COLUMNS)]), axis=1)]
+        data = data[np.argsort(data[:, 0])]
+
+        self.time = np.arange(data[0, 0], data[-1, 0], spacing)
+        columns = {
+            name: np.interp(self.time, data[:, 0], data[:, k])
+            for k, name in enumerate(LOG_COLUMNS)
+        }
+
+        self.depth = columns["depth"]
+        self.phi = np.radians(columns["roll"])
+        self.theta = np.radians(columns["pitch"])
+        # Unwrapped before resampling would blend 359 and 1 deg into 180
+        self.psi = np.interp(self.time, data[:, 0], np.unwrap(np.radians(data[:, 4])))
+        self.pump = columns["pump"] * 1e-6
+        self.rp1 = columns["battery"] / 100
+
+    def segments(self, length):
+        # Start indices and the common relative sample times of the
+        # consecutive windows of `length` seconds
+        spacing = self.time[1] - self.time[0]
+        samples = int(round(length / spacing)) + 1
+        starts = np.arange(0, len(self.time) - samples + 1, samples - 1)
+
+        return starts, self.time[:samples] - self.time[0]
+
+
+def parameter_variables(var, X):
+    # Glider variables with one entry per parameter set X (rows)
+    var = dict(var)
+    for j, name in enumerate(FIT):
+        var[name] = X[:, j]
+
+    MF = X[:, [FIT.index(name) for name in ("MF1", "MF2", "MF3")]]
+    J = X[:, [FIT.index(name) for name in ("J1", "J2", "J3")]]
+    var["Mf"] = MF[:, :, None] * np.eye(3)
+    var["M"] = var["mh"] * np.eye(3) + var["Mf"]
+    var["J"] = J[:, :, None] * np.eye(3)
+
+    return var
+
+
+def simulate_segments(job):
+    # Flies every (segment, parameter set) pair of the job as one BatchDynamics
+    # fleet and returns depth, phi, theta, psi, shape (n, 4, len(tau)), NaN
+    # where a copy has stalled. Runs in a worker process, so it takes plain
+    # arrays and dicts only.
+    var, X, Z, controls, tau = job
+
+    def make_batch(active):
+        batch = BatchDynamics(parameter_variables(var, X[active]), len(active))
+        for name, value in controls.items():
+            getattr(batch.controls, name)[:] = value[active]
+
+        return batch
+
+    Y = fly_batch(make_batch, Z, tau, method="RK45", rtol=RTOL, atol=ATOL)
+
+    return Y[:, [STATE_3D.index[name] for name in ("z", "phi", "theta", "psi")]]
+
+
+class Parameter_Identification:
+    def __init__(self, args):
+        self.args = args
+        self.mode = self.args.mode
+        self.glider_name = self.args.glider
+        self.info = self.args.info
+        self.log_file = self.args.log
+        self.output_module = self.args.parammodule
+        self.segment_length = self.args.segment
+        self.workers = self.args.workers
+        self.current_file = self.args.current
+        self.density_file = self.args.density
+
+        self.cache = OrderedDict()
+        self.simulations = 0
+
+        self.initialization()
+        self.load_log()
+
+    def initialization(self):
+        self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
+
+        P = load_glider(self.glider_name, "3D")
+        self.P = P
+        self.mass_params = P.GLIDER_CONFIG
+        self.hydro_params = P.HYDRODYNAMICS
+        self.vars = P.VARIABLES
+
+        self.x0 = np.array(
+            [
+                getattr(
+                    self.mass_params if name in ADDED_MASS else self.hydro_params,
+                    name,
+                )
+                for name in FIT
+            ],
+            dtype=float,
+        )
+        self.scale = np.maximum(np.abs(self.x0), 1.0)
+        self.lower = np.array([LOWER.get(name, -np.inf) for name in FIT])
+
+        self.mh = self.mass_params.HULL_MASS
+        self.var = {
+            "mh": self.mh,
+            "mw": self.mass_params.FIXED_POINT_MASS,
+            "mm": self.mass_params.INT_MOVABLE_MASS,
+            "m": self.mass_params.FLUID_DISP_MASS,
+            "rp2": self.vars.rp2,
+            "rp3": self.vars.rp3,
+            "rb1": self.vars.rb1,
+            "rb2": self.vars.rb2,
+            "rb3": self.vars.rb3,
+            "rw1": self.vars.rw1,
+            "rw2": self.vars.rw2,
+            "rw3": self.vars.rw3,
+            "rho_ref": self.mass_params.REF_DENSITY,
+            "hull_compressibility": self.mass_params.HULL_COMPRESSIBILITY,
+            "ballast_rate": self.vars.BALLAST_RATE,
+            "rudder": "enable",
+            "rudder_angle": 0.0,
+            "current_file": self.current_file,
+            "glider": self.glider_name,
+            "density_file": self.density_file,
+        }
+
+    def load_log(self):
+        self.log = DiveLog(self.log_file)
+        self.starts, self.tau = self.log.segments(self.segment_length)
+        if len(self.starts) == 0:
+            raise ValueError(
+                "Dive log is shorter than one {} s segment".format(self.segment_length)
+            )
+
+        log, k = self.log, self.starts
+        end = k + len(self.tau) - 1
+        mb = self.mass_params.BALLAST_MASS + self.mass_params.REF_DENSITY * log.pump
+
+        # Initial state of every segment: logged position, attitude, ballast
+        # and movable mass, with the rates fitted over the first RATE_WINDOW
+        # seconds giving the body rates, the speed of the movable mass and a
+        # forward speed that matches the depth rate
+        window = self.tau[self.tau <= RATE_WINDOW]
+
+        def rate(values):
+            return np.polyfit(window, values[k[:, None] + np.arange(len(window))].T, 1)[
+                0
+            ]
+
+        phi, theta = log.phi[k], log.theta[k]
+        phi_dot, theta_dot, psi_dot = rate(log.phi), rate(log.theta), rate(log.psi)
+        sin_theta = np.where(np.abs(theta) > 0.05, -np.sin(theta), 1.0)
+
+        S = STATE_3D
+        self.Z = np.zeros((len(k), S.size))
+        self.Z[:, S.index["z"]] = log.depth[k]
+        self.Z[:, S.index["p"]] = phi_dot - psi_dot * np.sin(theta)
+        self.Z[:, S.index["q"]] = theta_dot * np.cos(phi) + psi_dot * np.cos(
+            theta
+        ) * np.sin(phi)
+        self.Z[:, S.index["r"]] = -theta_dot * np.sin(phi) + psi_dot * np.cos(
+            theta
+        ) * np.cos(phi)
+        self.Z[:, S.index["v1"]] = np.clip(rate(log.depth) / sin_theta, 0.05, 1.0)
+        self.Z[:, S.index["rp1"]] = log.rp1[k]
+        self.Z[:, S.index["rp2"]] = self.vars.rp2
+        self.Z[:, S.index["rp3"]] = self.vars.rp3
+        self.Z[:, S.index["rp1_dot"]] = rate(log.rp1)
+        self.Z[:, S.index["mb"]] = mb[k]
+        self.Z[:, S.index["phi"]] = phi
+        self.Z[:, S.index["theta"]] = theta
+        self.Z[:, S.index["psi"]] = log.psi[k]
+
+        # The actuators are driven to their logged values at the end of the
+        # segment, at the rates of the simulator. The glider is diving while
+        # the pump takes on water (or, with the pump at rest, while it sinks).
+        diving = np.where(
+            mb[end] != mb[k], mb[end] > mb[k], log.depth[end] >= log.depth[k]
+        )
+        self.controls = {
+            "glide_dir": np.where(diving, 1.0, -1.0),
+            "mb_d": mb[end],
+            "rp1_d": log.rp1[end],
+            "rp2_d": self.vars.rp2,
+        }
+
+        self.measured = np.stack(
+            [
+                log.depth[k[:, None] + np.arange(len(self.tau))],
+                log.phi[k[:, None] + np.arange(len(self.tau))],
+                log.theta[k[:, None] + np.arange(len(self.tau))],
+                log.psi[k[:, None] + np.arange(len(self.tau))],
+            ],
+            axis=1,
+        )
+
+    def simulate(self, X, pairs, cached=True):
+        # Depth and attitude of the (row of X, segment) pairs, shape
+        # (len(pairs), 4, len(tau)). A row of X holds the coefficients FIT
+        # followed by the initial body velocity of every segment. Pairs flown
+        # before come from the cache (unless cached is False); the others are
+        # shared out by segment between `workers` processes, each flying all
+        # pairs of its segments as one batch.
+        n = len(FIT)
+        keys = {
+            (a, i): (
+                i,
+                X[a, :n].tobytes(),
+                X[a, n + 3 * i : n + 3 * i + 3].tobytes(),
+            )
+            for a, i in pairs
+        }
+        out = {
+            pair: self.cache[key]
+            for pair, key in keys.items()
+            if cached and key in self.cache
+        }
+        missing = [pair for pair in keys if pair not in out]
+
+        if missing:
+            segments = np.unique([i for a, i in missing])
+            chunks = np.array_split(segments, min(max(self.workers, 1), len(segments)))
+            jobs = [[(a, i) for a, i in missing if i in chunk] for chunk in chunks]
+            args = [self.job(X, job) for job in jobs]
+
+            if self.workers > 0:
+                with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    results = list(pool.map(simulate_segments, args))
+            else:
+                results = [simulate_segments(arg) for arg in args]
+
+            for job, Y in zip(jobs, results):
+                for pair, y in zip(job, Y):
+                    out[pair] = self.cache[keys[pair]] = y
+                    if len(self.cache) > CACHE_SIZE:
+                        self.cache.popitem(last=False)
+
+            self.simulations += len(missing)
+
+        return np.array([out[pair] for pair in pairs])
+
+    def job(self, X, pairs):
+        a = np.array([a for a, i in pairs])
+        i = np.array([i for a, i in pairs])
+
+        Z = self.Z[i]
+        v = len(FIT) + 3 * i[:, None] + np.arange(3)
+        Z[:, STATE_3D.slice("v")] = X[a[:, None], v]
+
+        controls = {
+            name: np.broadcast_to(value, (len(self.starts),))[i]
+            for name, value in self.controls.items()
+        }
+
+        return self.var, X[a, : len(FIT)], Z, controls, self.tau
+
+    def select_segments(self, keep):
+        self.starts = self.starts[keep]
+        self.Z = self.Z[keep]
+        self.measured = self.measured[keep]
+        self.controls = {
+            name: np.broadcast_to(value, keep.shape)[keep]
+            for name, value in self.controls.items()
+        }
+        self.cache.clear()
+
+    def residuals(self, Y, segments):
+        # Y: (n, 4, len(tau)) of the given segments -> weighted residuals,
+        # shape (n, 4 * len(tau))
+        error = Y - self.measured[segments]
+        error[:, 1:] = np.angle(np.exp(1j * error[:, 1:])) / ANGLE_SCALE
+        error[:, 0] /= DEPTH_SCALE
+
+        # A stalled segment counts as 100 m or degrees off
+        error = np.where(np.isfinite(error), error, 100.0)
+
+        return error.reshape(len(error), -1)
+
+    def fun(self, x):
+        segments = np.arange(len(self.starts))
+        Y = self.simulate(x[None], [(0, i) for i in segments])
+        prior = (x[: len(FIT)] - self.x0) / (PRIOR_SPREAD * self.scale)
+
+        return np.concatenate([self.residuals(Y, segments).ravel(), prior])
+
+    def jac(self, x):
+        # Forward differences. A coefficient moves every segment, an initial
+        # velocity only its own, so only that segment is flown again for it.
+        # The nominal row is flown again together with the perturbed ones
+        # so that all of them take the same steps.
+        n, segments = len(FIT), np.arange(len(self.starts))
+        h = RELATIVE_STEP * self.x_scale
+        X = x + np.vstack([np.zeros(len(x)), np.diag(h)])
+
+        pairs = [(a, i) for a in range(n + 1) for i in segments]
+        pairs += [(n + 1 + 3 * i + k, i) for i in segments for k in range(3)]
+        r = self.residuals(self.simulate(X, pairs, cached=False), [i for a, i in pairs])
+
+        J = np.zeros((len(segments), r.shape[1], len(x)))
+        for (a, i), residual in zip(pairs[len(segments) :], r[len(segments) :]):
+            J[i, :, a - 1] = (residual - r[i]) / h[a - 1]
+
+        prior = np.zeros((n, len(x)))
+        prior[:, :n] = np.diag(1 / (PRIOR_SPREAD * self.scale))
+
+        return np.vstack([J.reshape(-1, len(x)), prior])
+
+    def set_desired_trajectory(self):
+        # Segments the initial parameters cannot fly (typically ones that start
+        # in a dive-climb transition, where the initial speed is guessed
+        # badly) say nothing about the parameters
+        segments = np.arange(len(self.starts))
+        x0 = np.concatenate([self.x0, self.Z[:, STATE_3D.slice("v")].ravel()])
+        Y = self.simulate(x0[None], [(0, i) for i in segments])
+        stalled = np.any(np.isnan(Y), axis=(1, 2))
+        if np.any(stalled):
+            print(
+                "Left out {} segments that stall with the initial parameters, "
+                "starting at t = {} s".format(
+                    np.sum(stalled), self.log.time[self.starts[stalled]]
+                )
+            )
+            self.select_segments(~stalled)
+
+        # The initial body velocities of the segments are fitted along
+        v0 = self.Z[:, STATE_3D.slice("v")]
+        x0 = np.concatenate([self.x0, v0.ravel()])
+        self.x_scale = np.concatenate([self.scale, np.full(v0.size, VELOCITY_SCALE)])
+        v_lower = np.tile([MIN_SPEED, -np.inf, -np.inf], len(v0))
+        lower = np.concatenate([self.lower, v_lower])
+
+        start = self.fun(x0)
+        print(
+            "Segments: {} x {:.0f} s | initial RMS error: {:.4g}".format(
+                len(self.starts), self.tau[-1], np.sqrt(np.mean(start**2))
+            )
+        )
+
+        fit = least_squares(
+            self.fun,
+            x0,
+            jac=self.jac,
+            bounds=(lower, np.inf),
+            x_scale=self.x_scale,
+            verbose=2 if self.info else 0,
+        )
+        self.x = fit.x[: len(FIT)]
+        self.velocities = fit.x[len(FIT) :].reshape(-1, 3)
+
+        print(
+            "Final RMS error: {:.4g} | segment simulations: {}".format(
+                np.sqrt(np.mean(fit.fun**2)), self.simulations
+            )
+        )
+        for name, before, after in zip(FIT, self.x0, self.x):
+            print("{} = {:.6g} (was {:.6g})".format(name, after, before))
+
+        write_parameter_module(
+            self.output_module, self.P, dict(zip(FIT, self.x)), self.log_file
+        )
+        print("\nParameters written to {}".format(self.output_module))
+
+
+def write_parameter_module(path, P, values, source):
+    # Copy of the glider definition P (Parameters/registry) with `values`
+    # substituted, as a parameter module laid out like Parameters/slocum3D.py
+    # that -g takes in its place
+    lines = ["class SLOCUM_PARAMS:"]
+    for group in P.groups:
+        lines.append("    class {}:".format(group))
+        for name, value in vars(getattr(P, group)).items():
+            if name.startswith("__"):
+                continue
+            if name in values:
+                lines.append(
+                    "        {} = {!r}  # identified from {}".format(
+                        name, float(values[name]), source
+                    )
+                )
+            else:
+                lines.append("        {} = {!r}".format(name, value))
+        lines.append("")
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines).rstrip() + "\n")
+
+
+if __name__ == "__main__":
+    Z = Parameter_Identification()
+    Z.set_desired_trajectory()
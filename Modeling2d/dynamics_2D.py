@@ -1,28 +1,28 @@
 import numpy as np
 import math
 import utils
-from Parameters.slocum import SLOCUM_PARAMS
+from Control.control_transformation import solve_control_forces
+from Environment.density import load_density_profile, displaced_mass
+from Hydrodynamics.coefficient_tables import load_hydro_table
+from Parameters.registry import load_glider
+from State.state_schema import STATE_2D
 
 
 class Dynamics:
-    def __init__(self, z):
-        self.initialization()
-
-        self.n1 = np.array([z[0:3]]).T
-        self.Omega = np.array([z[3:6]]).T
-        self.v = np.array([z[6:9]]).T
-        self.rp = np.array([z[9:12]]).T
-        self.rb = np.array([z[12:15]]).T
-        # self.Pp = np.array([z[15:18]]).T
-        # self.Pb = np.array([z[18:21]]).T
-        self.rp_dot = np.array([z[15:18]]).T
-        self.rb_dot = np.array([z[18:21]]).T
-        self.mb = z[21]
-        self.theta = z[25]
+    def __init__(self, var, z, pid=None):
+        self.initialization(var, pid)
+
+        self.n1 = STATE_2D.column(z, "n1")
+        self.Omega = STATE_2D.column(z, "Omega")
+        self.v = STATE_2D.column(z, "v")
+        self.rp = STATE_2D.column(z, "rp", {"rp3": self.rp3})
+        self.rb = np.array([[self.rb1, 0.0, self.rb3]]).T
+        self.rp_dot = STATE_2D.column(z, "rp_dot")
+        self.rb_dot = np.zeros((3, 1))
+        self.mb = z[STATE_2D.index["mb"]]
+        self.theta = z[STATE_2D.index["theta"]]
 
         self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
-        
-        print(math.degrees(self.theta))
 
         if self.pid_control == "enable":
             self.w1, self.theta_prev, self.error = utils.PID(
@@ -35,19 +35,13 @@ class Dynamics:
                 0.1,
                 -self.Omega[1],
             )
-            
-            # breakpoint()
-            # print(self.rp1)
 
-            pid_vars = {
-                "theta_prev": self.theta_prev.tolist(),
-            }
-            utils.save_json(pid_vars, "vars/pid_variables.json")
+            pid["theta_prev"] = self.theta_prev.tolist()
 
         else:
-            self.rp1 = 0.0
+            self.w1 = None
 
-        self.controls = SLOCUM_PARAMS.CONTROLS
+        self.controls = load_glider(self.glider, "2D").CONTROLS
 
         self.rp_c = utils.unit_vecs(self.rp)
         self.rb_c = utils.unit_vecs(self.rb)
@@ -56,6 +50,15 @@ class Dynamics:
 
         self.R, self.R_T = self.transformation()
 
+        self.m = displaced_mass(
+            self.m,
+            self.n1[2][0],
+            self.density,
+            self.rho_ref,
+            self.hull_compressibility,
+            self.g,
+        )
+
         self.m0 = self.mh + self.mw + self.mb + self.mm - self.m
 
         if self.glide_dir == "U":
@@ -65,10 +68,10 @@ class Dynamics:
             if self.mb >= self.mb_d:
                 self.ballast_rate = 0
 
-    def initialization(self):
-        var = utils.load_json("vars/2d_glider_variables.json")
-        pid_var = utils.load_json("vars/pid_variables.json")
-
+    def initialization(self, var, pid):
+        # var: the glider variables of the model (glider_variables); pid: the
+        # pitch PID state of the run, updated in place
+        self.glider = var.get("glider", "slocum")
         self.pid_control = var["pid_control"]
         self.alpha_d = var["alpha_d"]
         self.glide_dir = var["glide_dir"]
@@ -84,6 +87,7 @@ class Dynamics:
         self.rp3 = var["rp3"]
         self.rb1 = var["rb1"]
         self.rb3 = var["rb3"]
+        self.rw = np.array([[var["rw1"], 0.0, var["rw3"]]]).T
         self.phi = var["phi"]
         self.theta0 = var["theta0"]
         self.psi = var["psi"]
@@ -110,22 +114,30 @@ class Dynamics:
         self.m0 = var["m0"]
         self.mt = var["mt"]
 
-        self.theta_prev = pid_var["theta_prev"]
+        self.rho_ref = var["rho_ref"]
+        self.hull_compressibility = var["hull_compressibility"]
+        self.density = load_density_profile(var.get("density_file"))
+        self.hydro_table = load_hydro_table(var.get("hydro_table_file"))
+
+        self.theta_prev = pid["theta_prev"] if pid is not None else None
 
     def set_force_torque(self):
         self.alpha = math.atan(self.v[2][0] / self.v[0][0])
 
-        L = (self.KL0 + self.KL * self.alpha) * (
-            math.pow(self.v[0][0], 2) + math.pow(self.v[2][0], 2)
-        )
-        D = (self.KD0 + self.KD * (math.pow(self.alpha, 2))) * (
-            math.pow(self.v[0][0], 2) + math.pow(self.v[2][0], 2)
-        )
-        MDL = (self.KM0 + self.KM * self.alpha) * (
-            math.pow(self.v[0][0], 2) + math.pow(self.v[2][0], 2)
+        if self.hydro_table is None:
+            CL = self.KL0 + self.KL * self.alpha
+            CD = self.KD0 + self.KD * (math.pow(self.alpha, 2))
+            CM = self.KM0 + self.KM * self.alpha
+        else:
+            CL, CD, CM = self.hydro_table.longitudinal(self.alpha)
+
+        L = CL * (math.pow(self.v[0][0], 2) + math.pow(self.v[2][0], 2))
+        D = CD * (math.pow(self.v[0][0], 2) + math.pow(self.v[2][0], 2))
+        MDL = (
+            CM * (math.pow(self.v[0][0], 2) + math.pow(self.v[2][0], 2))
+            + self.KOmega1 * self.Omega[1][0]
+            + self.KOmega2 * math.pow(self.Omega[1][0], 2)
         )
-        +self.KOmega1 * self.Omega[1][0]
-        +self.KOmega2 * math.pow(self.Omega[1][0], 2)
 
         self.F_ext = np.array([[-D, 0, -L]]).transpose()  # same as X, Y, Z
 
@@ -156,6 +168,14 @@ class Dynamics:
         return R, R_T
 
     def control_transformation(self):
+        if self.w1 is None:
+            # Without pitch control the moving mass runs at wp1 to rp1_d
+            self.w1 = self.controls.wp1
+            if (self.glide_dir == "D" and self.rp[0] >= self.rp1_d) or (
+                self.glide_dir == "U" and self.rp[0] <= self.rp1_d
+            ):
+                self.w1 = 0.0
+                self.rp_dot = np.array([[0, 0, 0]]).transpose()
 
         if self.glide_dir == "D":
             self.wp = np.array(
@@ -170,61 +190,6 @@ class Dynamics:
 
         self.ww = np.array([[0, 0, 0]]).transpose()
 
-        # 3x3 matrix when mw != 0
-        # self.F = np.array(
-        #     [
-        #         [
-        #             np.linalg.inv(self.M)
-        #             - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rp_c)
-        #             + (1 / self.mm) * self.I3,
-        #             np.linalg.inv(self.M)
-        #             - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rb_c),
-        #             np.linalg.inv(self.M)
-        #             - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rw_c)
-        #         ],
-        #         [
-        #             np.linalg.inv(self.M)
-        #             - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rp_c),
-        #             np.linalg.inv(self.M)
-        #             - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rb_c)
-        #             + (1 / self.mb) * self.I3,
-        #             np.linalg.inv(self.M)
-        #             - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rw_c)
-        #         ],
-        #         [
-        #             np.linalg.inv(self.M)
-        #             - self.rw_c @ (np.linalg.inv(self.J)) @ (self.rp_c),
-        #             np.linalg.inv(self.M)
-        #             - self.rw_c @ (np.linalg.inv(self.J)) @ (self.rb_c),
-        #             np.linalg.inv(self.M)
-        #             - self.rw_c @ (np.linalg.inv(self.J)) @ (self.rw_c)
-        #             + (1 / self.mw) * self.I3,
-        #         ]
-        #     ]
-        # )
-
-        # 2x2 matrix when mw = 0
-        self.F = np.array(
-            [
-                [
-                    np.linalg.inv(self.M)
-                    - self.rp_c @ (np.linalg.inv(self.J) @ self.rp_c)
-                    + (1 / self.mm) * self.I3,
-                    np.linalg.inv(self.M)
-                    - self.rp_c @ (np.linalg.inv(self.J) @ self.rb_c),
-                ],
-                [
-                    np.linalg.inv(self.M)
-                    - self.rb_c @ (np.linalg.inv(self.J) @ self.rp_c),
-                    np.linalg.inv(self.M)
-                    - self.rb_c @ (np.linalg.inv(self.J) @ self.rb_c)
-                    + (1 / self.mb) * self.I3,
-                ],
-            ]
-        )
-
-        self.H = np.linalg.inv(self.F)
-
         Zp = (
             -np.linalg.inv(self.M)
             @ (
@@ -233,20 +198,22 @@ class Dynamics:
                 + self.F_ext
             )
             - np.cross(self.Omega, self.rp_dot, axis=0)
-            - np.linalg.inv(self.J)
-            @ np.cross(
-                np.cross(
-                    self.J @ self.Omega + self.rp_c @ self.Pp + self.rb_c @ self.Pb,
-                    self.Omega,
-                    axis=0,
-                )
-                + np.cross(self.M @ self.v, self.v, axis=0)
-                + self.T_ext
-                + np.cross(np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0)
-                + np.cross(np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0)
-                + (self.mm * self.rp_c + self.mb * self.rb_c)
-                * self.g
-                @ (self.R_T @ self.k_hat),
+            - np.cross(
+                np.linalg.inv(self.J)
+                @ (
+                    np.cross(
+                        self.J @ self.Omega + self.rp_c @ self.Pp + self.rb_c @ self.Pb,
+                        self.Omega,
+                        axis=0,
+                    )
+                    + np.cross(self.M @ self.v, self.v, axis=0)
+                    + self.T_ext
+                    + np.cross(np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0)
+                    + np.cross(np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0)
+                    + (self.mm * self.rp_c + self.mb * self.rb_c)
+                    * self.g
+                    @ (self.R_T @ self.k_hat)
+                ),
                 self.rp,
                 axis=0,
             )
@@ -260,71 +227,74 @@ class Dynamics:
                 + self.F_ext
             )
             - np.cross(self.Omega, self.rb_dot, axis=0)
-            - np.linalg.inv(self.J)
-            @ np.cross(
-                np.cross(
-                    self.J @ self.Omega + self.rp_c @ self.Pp + self.rb_c @ self.Pb,
-                    self.Omega,
-                    axis=0,
-                )
-                + np.cross(self.M @ self.v, self.v, axis=0)
-                + self.T_ext
-                + np.cross(np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0)
-                + np.cross(np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0)
-                + (self.mm * self.rp_c + self.mb * self.rb_c)
-                * self.g
-                @ (self.R_T @ self.k_hat),
+            - np.cross(
+                np.linalg.inv(self.J)
+                @ (
+                    np.cross(
+                        self.J @ self.Omega + self.rp_c @ self.Pp + self.rb_c @ self.Pb,
+                        self.Omega,
+                        axis=0,
+                    )
+                    + np.cross(self.M @ self.v, self.v, axis=0)
+                    + self.T_ext
+                    + np.cross(np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0)
+                    + np.cross(np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0)
+                    + (self.mm * self.rp_c + self.mb * self.rb_c)
+                    * self.g
+                    @ (self.R_T @ self.k_hat)
+                ),
                 self.rb,
                 axis=0,
             )
         )
 
-        # Uncomment below if mw is not equal to 0
-        # Zw = (
-        #     -np.linalg.inv(self.M)
-        #     @ (
-        #         np.cross(self.M @ (self.v) + self.Pp + self.Pb, self.Omega, axis=0)
-        #         + self.m0 * self.g * np.matmul(self.R_T, self.k_hat)
-        #         + self.F_ext
-        #     )
-        #     - np.cross(self.Omega, self.rp_dot, axis=0)
-        #     - np.cross(
-        #         np.linalg.inv(self.J)
-        #         @ (
-        #             np.cross(
-        #                 np.matmul(self.J, self.Omega)
-        #                 + np.matmul(self.rp_c, self.Pp)
-        #                 + np.matmul(self.rb_c, self.Pb),
-        #                 self.Omega,
-        #                 axis=0,
-        #             )
-        #             + np.cross(np.matmul(self.M, self.v), self.v, axis=0)
-        #             + self.T_ext
-        #             + np.cross(np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0)
-        #             + np.cross(np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0)
-        #             + (self.mm * self.rp_c + self.mb * self.rb_c)
-        #             * self.g
-        #             @ (self.R_T @ self.k_hat)
-        #         ),
-        #         self.rw,
-        #         axis=0,
-        #     )
-        # )
-
-        self.H = np.concatenate(
-            (
-                np.concatenate((self.H[0][0], self.H[0][1]), axis=0),
-                np.concatenate((self.H[1][0], self.H[1][1]), axis=0),
-            ),
-            axis=1,
-        )
+        if self.mw != 0:
+            Zw = (
+                -np.linalg.inv(self.M)
+                @ (
+                    np.cross(self.M @ self.v + self.Pp + self.Pb, self.Omega, axis=0)
+                    + self.m0 * self.g * (self.R_T @ self.k_hat)
+                    + self.F_ext
+                )
+                - np.cross(self.Omega, self.rb_dot, axis=0)
+                - np.cross(
+                    np.linalg.inv(self.J)
+                    @ (
+                        np.cross(
+                            self.J @ self.Omega
+                            + self.rp_c @ self.Pp
+                            + self.rb_c @ self.Pb,
+                            self.Omega,
+                            axis=0,
+                        )
+                        + np.cross(self.M @ self.v, self.v, axis=0)
+                        + self.T_ext
+                        + np.cross(
+                            np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0
+                        )
+                        + np.cross(
+                            np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0
+                        )
+                        + (self.mm * self.rp_c + self.mb * self.rb_c)
+                        * self.g
+                        @ (self.R_T @ self.k_hat)
+                    ),
+                    self.rw,
+                    axis=0,
+                )
+            )
+
+        masses = [self.mm, self.mb]
+        positions = [self.rp, self.rb]
+        rhs = [-Zp + self.wp, -Zb + self.wb]
 
-        # self.u = self.H @ np.array(
-        #     [(-Zp + self.wp).flatten(), (-Zb + self.wb).flatten(), (-Zw + self.ww).flatten()]
-        # ).reshape(9,1) # uncomment if mw is not 0
+        if self.mw != 0:
+            masses.append(self.mw)
+            positions.append(self.rw)
+            rhs.append(-Zw + self.ww)
 
-        self.u = self.H @ np.array(((-Zp + self.wp), (-Zb + self.wb))).ravel()
-        self.u = self.u.reshape(2, 3)
+        # Solves F u = rhs without forming or inverting F
+        self.u = solve_control_forces(self.M, self.J, masses, positions, rhs)
 
         self.u_bar = np.array([self.u[0]]).T
 
@@ -395,26 +365,17 @@ class Dynamics:
 
         rp_ddot = self.wp
 
-        rb_ddot = self.wb
-
-        mb_dot = np.array([[self.ballast_rate, 0, 0]]).T
-
-        return np.concatenate(
-            [
-                n1_dot,
-                Omega_dot,
-                v1_dot,
-                self.rp_dot,
-                self.rb_dot,
-                # Pp_dot,
-                # Pb_dot,
-                rp_ddot,
-                rb_ddot,
-                mb_dot,
-                np.array([self.n2_dot[1]]).T,
-                self.wp,
-            ]
-        ).ravel()
+        return STATE_2D.pack(
+            {
+                "n1": n1_dot,
+                "Omega": Omega_dot,
+                "v": v1_dot,
+                "rp": self.rp_dot,
+                "rp_dot": rp_ddot,
+                "mb": self.ballast_rate,
+                "theta": self.n2_dot[1][1],
+            }
+        )
 
 
 if __name__ == "__main__":
@@ -2,7 +2,28 @@ import numpy as np
 import math
 from scipy.integrate import solve_ivp
 import utils
-from Modeling2d.dynamics_2D import Dynamics
+from Environment.density import load_density_profile, displaced_mass
+from Control.scheduler import Scheduler
+from Modeling2d.planar_dynamics import PlanarDynamics
+from State.state_schema import STATE_2D
+from State.recording import DenseTrajectory, adaptive_times
+from State.checkpoints import SegmentCache, file_signature
+from State.tolerances import absolute_tolerances, load_tolerances
+from State.channels import channel_recorder
+from Numerics.solvers import solver_setting
+from Analysis.trajectory_analysis import (
+    Trajectory,
+    print_yos,
+    save_trajectory,
+    yo_statistics,
+)
+from Parallel.parareal import parareal
+from Visualization.live_view import LiveStream
+from Parameters.registry import load_glider
+
+# Relative tolerance of the legs; the absolute tolerances follow from the state
+# scales (State/tolerances.py)
+RTOL = 1e-4
 
 
 class Vertical_Motion:
@@ -18,6 +39,16 @@ class Vertical_Motion:
         self.info = self.args.info
         self.pid_control = self.args.pid
         self.plots = self.args.plot
+        self.output = self.args.output
+        self.trajectory_file = self.args.trajectory
+        self.live = self.args.live
+        self.stream = None
+        self.workers = self.args.workers
+        self.control = self.args.control
+        self.checkpoints = self.args.checkpoints
+        self.method, self.rtol = solver_setting(self.args.solver, RTOL)
+        self.scales = load_tolerances(self.args.tolerances, "2D")
+        self.dense = DenseTrajectory()
 
         self.initialization()
 
@@ -27,11 +58,8 @@ class Vertical_Motion:
     def initialization(self):
         self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
 
-        if self.glider_name == ("slocum") and self.mode == "2D":
-            from Parameters.slocum import SLOCUM_PARAMS as P
-        else:
-            print("Invalid glider model")
-            raise ImportError
+        P = load_glider(self.glider_name, "2D")
+        self.params = P
 
         self.mass_params = P.GLIDER_CONFIG
         self.hydro_params = P.HYDRODYNAMICS
@@ -50,15 +78,17 @@ class Vertical_Motion:
         self.m = self.mass_params.FLUID_DISP_MASS
         self.m0 = self.mt - self.m
 
-        self.Mf = np.diag(
-            [self.mass_params.MF1, self.mass_params.MF2, self.mass_params.MF3]
-        )
-        self.Jf = np.diag(
-            [self.mass_params.J1, self.mass_params.J2, self.mass_params.J3]
-        )
+        self.rho_ref = self.mass_params.REF_DENSITY
+        self.hull_compressibility = self.mass_params.HULL_COMPRESSIBILITY
+        self.density_file = self.args.density
+        self.density = load_density_profile(self.density_file)
+        self.hydro_table_file = self.args.hydrotable
 
-        self.M = self.mh * self.I3 + self.Mf
-        self.J = self.Jf  # J = Jf + Jh
+        self.Mf = P.Mf
+        self.Jf = P.Jf
+
+        self.M = P.M
+        self.J = P.J  # J = Jf + Jh
 
         self.KL = self.hydro_params.KL
         self.KL0 = self.hydro_params.KL0
@@ -72,6 +102,8 @@ class Vertical_Motion:
         self.rp3 = self.vars.rp3
         self.rb1 = self.vars.rb1
         self.rb3 = self.vars.rb3
+        self.rw1 = self.vars.rw1
+        self.rw3 = self.vars.rw3
 
         self.glide_angle_deg = self.args.angle
         self.V_d = self.args.speed
@@ -85,6 +117,41 @@ class Vertical_Motion:
         self.psi = self.vars.PSI
 
     def set_desired_trajectory(self):
+        self.set_glide_angles()
+
+        if self.workers > 0:
+            self.solve_parareal()
+        else:
+            self.solve_cycles()
+
+        if self.info == True:
+            trajectory = Trajectory(
+                self.total_time, self.solver_array.T, STATE_2D, {"rp3": self.rp3}
+            )
+            print_yos(yo_statistics(trajectory))
+
+        # Selected channels (-rc, -rs) replace the full trajectory file
+        self.record = channel_recorder(self.args, STATE_2D, {"rp3": self.rp3})
+        if self.record is not None:
+            self.record.append(self.total_time, self.solver_array.T)
+            self.record.close(self.trajectory_file)
+        elif self.trajectory_file is not None:
+            save_trajectory(
+                self.trajectory_file,
+                self.total_time,
+                self.solver_array.T,
+                STATE_2D,
+                {"rp3": self.rp3},
+            )
+
+        utils.plots(
+            self.total_time,
+            STATE_2D.view(self.solver_array.T, {"rp3": self.rp3}),
+            self.plots,
+        )
+
+    def set_glide_angles(self):
+        # Desired glide angle of every cycle, dives and climbs in turn
         self.E_i_d = np.array(
             [
                 math.radians(math.pow(-1, k + 1) * self.glide_angle_deg)
@@ -92,84 +159,115 @@ class Vertical_Motion:
             ]
         )
 
-        self.lim1 = math.degrees(
-            math.atan(
-                2
-                * (self.KD / self.KL)
-                * (
-                    self.KL0 / self.KL
-                    + math.sqrt(math.pow(self.KL0 / self.KL, 2) + self.KD0 / self.KD)
+        self.lim1 = self.params.lim1
+        self.lim2 = self.params.lim2
+
+    def set_leg(self, i, z):
+        # Desired steady glide of cycle i, with the ballast trimmed for the
+        # water displaced at depth z where the cycle starts
+        self.e_i_d = self.E_i_d[i]
+
+        if (self.e_i_d) > 0:
+            self.glider_direction = "U"
+            self.ballast_rate = -abs(self.ballast_rate)
+
+        elif (self.e_i_d) < 0:
+            self.glider_direction = "D"
+            self.ballast_rate = abs(self.ballast_rate)
+
+        self.alpha_d = (
+            (1 / 2)
+            * (self.KL / self.KD)
+            * math.tan(self.e_i_d)
+            * (
+                -1
+                + math.sqrt(
+                    1
+                    - 4
+                    * (self.KD / math.pow(self.KL, 2))
+                    * (1 / math.tan(self.e_i_d))
+                    * (self.KD0 * (1 / math.tan(self.e_i_d)) + self.KL0)
                 )
             )
         )
 
-        self.lim2 = math.degrees(
-            math.atan(
-                2
-                * (self.KD / self.KL)
-                * (
-                    self.KL0 / self.KL
-                    - math.sqrt(math.pow(self.KL0 / self.KL, 2) + self.KD0 / self.KD)
-                )
-            )
+        self.m_local = displaced_mass(
+            self.m,
+            z,
+            self.density,
+            self.rho_ref,
+            self.hull_compressibility,
+            self.g,
         )
 
-        l = len(self.E_i_d)
-        l = 1
-        for i in range(l):
-            self.e_i_d = self.E_i_d[i]
-        
-            print(
-                "\nIteration {} | Desired glide angle in deg = {}".format(
-                    i, math.degrees(self.e_i_d)
-                )
-            )
+        self.mb_d = (self.m_local - self.mh - self.mm) + (1 / self.g) * (
+            -math.sin(self.e_i_d) * (self.KD0 + self.KD * math.pow(self.alpha_d, 2))
+            + math.cos(self.e_i_d) * (self.KL0 + self.KL * self.alpha_d)
+        ) * math.pow(self.V_d, 2)
 
-            if (self.e_i_d) > 0:
-                self.glider_direction = "U"
-                self.ballast_rate = -abs(self.ballast_rate)
-                print("Glider moving in upward direction")
+        self.m0_d = self.mb_d + self.mh + self.mm - self.m_local
 
-            elif (self.e_i_d) < 0:
-                self.glider_direction = "D"
-                self.ballast_rate = abs(self.ballast_rate)
-                print("Glider moving in downward direction")
+        self.theta_d = self.e_i_d + self.alpha_d
 
-            self.alpha_d = (
-                (1 / 2)
-                * (self.KL / self.KD)
-                * math.tan(self.e_i_d)
-                * (
-                    -1
-                    + math.sqrt(
-                        1
-                        - 4
-                        * (self.KD / math.pow(self.KL, 2))
-                        * (1 / math.tan(self.e_i_d))
-                        * (self.KD0 * (1 / math.tan(self.e_i_d)) + self.KL0)
-                    )
-                )
-            )
+        self.v1_d = self.V_d * math.cos(self.alpha_d)
+        self.v3_d = self.V_d * math.sin(self.alpha_d)
+
+        self.rp1_d = -self.rp3 * math.tan(self.theta_d) + (
+            1 / (self.mm * self.g * math.cos(self.theta_d))
+        ) * (
+            (self.Mf[2, 2] - self.Mf[0, 0]) * self.v1_d * self.v3_d
+            + (self.KM0 + self.KM * self.alpha_d) * math.pow(self.V_d, 2)
+        )
 
-            self.mb_d = (self.m - self.mh - self.mm) + (1 / self.g) * (
-                -math.sin(self.e_i_d) * (self.KD0 + self.KD * math.pow(self.alpha_d, 2))
-                + math.cos(self.e_i_d) * (self.KL0 + self.KL * self.alpha_d)
-            ) * math.pow(self.V_d, 2)
+    def initial_state(self):
+        return STATE_2D.pack(
+            {
+                "n1": [0.0, 0.0, 0.0],
+                "Omega": [0.0, 0.0, 0.0],
+                "v": [self.v1_d, 0.0, self.v3_d],
+                "rp": [0.0, 0.0, self.rp3],
+                "rp_dot": [0.0, 0.0, 0.0],
+                "mb": self.mb_d,
+                "n2": [0.0, self.theta0, 0.0],
+            }
+        )
 
-            self.m0_d = self.mb_d + self.mh + self.mm - self.m
+    def solve_cycles(self):
+        # Cycles whose inputs are unchanged since an earlier run with the same
+        # -ck directory are restored from their checkpoints
+        cache = SegmentCache(
+            self.checkpoints,
+            {
+                "glider": self.params.definition(),
+                "files": [
+                    file_signature(self.density_file),
+                    file_signature(self.hydro_table_file),
+                ],
+                "output": self.output,
+                "control": self.control,
+                "tolerances": [self.rtol, self.scales],
+                "solver": self.args.solver,
+            },
+        )
 
-            self.theta_d = self.e_i_d + self.alpha_d
+        if self.live:
+            self.stream = LiveStream(STATE_2D, {"rp3": self.rp3})
 
-            self.v1_d = self.V_d * math.cos(self.alpha_d)
-            self.v3_d = self.V_d * math.sin(self.alpha_d)
+        for i in range(self.cycles):
+            z = 0.0 if i == 0 else self.solver_array[-1][STATE_2D.index["z"]]
+            self.set_leg(i, z)
 
-            self.rp1_d = -self.rp3 * math.tan(self.theta_d) + (
-                1 / (self.mm * self.g * math.cos(self.theta_d))
-            ) * (
-                (self.Mf[2, 2] - self.Mf[0, 0]) * self.v1_d * self.v3_d
-                + (self.KM0 + self.KM * self.alpha_d) * math.pow(self.V_d, 2)
+            print(
+                "\nIteration {} | Desired glide angle in deg = {}".format(
+                    i, math.degrees(self.e_i_d)
+                )
             )
 
+            if self.glider_direction == "U":
+                print("Glider moving in upward direction")
+            else:
+                print("Glider moving in downward direction")
+
             if self.info == True:
                 print(
                     "Desired angle of attack in deg = {}".format(
@@ -183,31 +281,24 @@ class Vertical_Motion:
                     )
                 )
 
-            self.save_json()
-
             # Initial conditions at every peak of the sawtooth trajectory
 
             if i == 0:
-                self.z_in = np.concatenate(
-                    [
-                        [0.0, 0.0, 0.0],
-                        [0.0, 0.0, 0.0],
-                        [self.v1_d, 0.0, self.v3_d],
-                        [0.0, 0.0, self.rp3],
-                        [self.rb1, 0.0, self.rb3],
-                        [0.0, 0.0, 0.0],
-                        [0.0, 0.0, 0.0],
-                        [self.mb_d, 0, 0],
-                        [0, self.theta0, 0],
-                    ]
-                ).ravel()
-
+                self.z_in = self.initial_state()
             else:
-                self.z_in = self.solver_array[-1]
+                self.z_in = leg_start(self.solver_array[-1])
 
             self.t = np.linspace(400 * (i), 400 * (i + 1), 200)
 
-            sol, w = self.solve_ode(self.z_in, self.t)
+            sol, w = cache.run(
+                {"leg": self.glider_variables(), "time": self.t},
+                lambda: self.solve_ode(self.z_in, self.t),
+            )
+            if self.output == "adaptive":
+                self.dense.append(sol)
+            if self.stream is not None:
+                # Restored cycles were not streamed while integrated
+                self.stream.record(sol.t, sol.y)
 
             if i == 0:
                 self.solver_array = sol.y.T
@@ -218,10 +309,133 @@ class Vertical_Motion:
                 self.total_time = np.concatenate((self.total_time, sol.t))
                 self.wp = np.concatenate((self.wp, w))
 
-        utils.plots(self.total_time, self.solver_array.T, self.plots)
+        cache.report("cycles")
+
+        if self.stream is not None:
+            self.stream.close()
+
+    def solve_parareal(self):
+        # The cycles are parareal time slices: steady glides predict the state
+        # at every peak of the sawtooth, and full legs integrated in
+        # self.workers processes correct the predictions until they converge
+        # to the tolerances of the legs.
+        def leg(k, z0):
+            self.set_leg(k, z0[STATE_2D.index["z"]])
+            return self.glider_variables()
+
+        def job(k, z0):
+            z0 = leg_start(z0) if k > 0 else z0
+            time = np.linspace(400 * k, 400 * (k + 1), 200)
+            return (
+                leg(k, z0),
+                z0,
+                time,
+                self.output == "adaptive",
+                self.control == "sampled",
+                None,
+                self.rtol,
+                self.scales,
+                self.method,
+            )
+
+        def coarse(k, z0):
+            return steady_glide(leg(k, z0), z0, 400.0)
+
+        self.set_leg(0, 0.0)
+        results, peaks = parareal(
+            fine_leg,
+            coarse,
+            job,
+            self.initial_state(),
+            self.cycles,
+            self.workers,
+            rtol=self.rtol,
+            atol=absolute_tolerances(STATE_2D, self.rtol, self.scales),
+            info=self.info,
+        )
+
+        for sol, w in results:
+            if self.output == "adaptive":
+                self.dense.append(sol)
+
+        self.solver_array = np.concatenate([sol.y.T for sol, w in results])
+        self.total_time = np.concatenate([sol.t for sol, w in results])
+        self.wp = np.concatenate([w for sol, w in results])
+
+        self.set_leg(self.cycles - 1, peaks[-2][STATE_2D.index["z"]])
+
+    def sweep(self, angles, speeds, duration=400.0, samples=200):
+        # One glide leg per (angle, speed) pair (degrees, negative diving, and
+        # m/s), started like the first leg of set_desired_trajectory and
+        # integrated together with the batched planar kernel. Returns the
+        # output times and an (N, STATE_2D.size, T) array.
+        e_i_d = np.radians(np.asarray(angles, dtype=float)).ravel()
+        V_d = np.broadcast_to(np.asarray(speeds, dtype=float), e_i_d.shape)
+        n = len(e_i_d)
+
+        var = {
+            "Mf": self.Mf,
+            "M": self.M,
+            "J": self.J,
+            "KL": self.KL,
+            "KL0": self.KL0,
+            "KD": self.KD,
+            "KD0": self.KD0,
+            "KM": self.KM,
+            "KM0": self.KM0,
+            "KOmega1": self.KOmega1,
+            "KOmega2": self.KOmega2,
+            "mh": self.mh,
+            "mw": self.mw,
+            "mm": self.mm,
+            "m": self.m,
+            "rp3": self.rp3,
+            "rb1": self.rb1,
+            "rb3": self.rb3,
+            "rw1": self.rw1,
+            "rw3": self.rw3,
+            "rho_ref": self.rho_ref,
+            "hull_compressibility": self.hull_compressibility,
+            "glider": self.glider_name,
+            "density_file": self.density_file,
+            "hydro_table_file": self.hydro_table_file,
+            "ballast_rate": self.ballast_rate,
+            "pid_control": self.pid_control,
+            "glide_dir": np.where(e_i_d > 0, "U", "D"),
+        }
+
+        m_local = displaced_mass(
+            self.m,
+            0.0,
+            self.density,
+            self.rho_ref,
+            self.hull_compressibility,
+            self.g,
+        )
+        eq = utils.glide_equilibrium(e_i_d, V_d, var, m=m_local)
+        var.update(theta_d=eq["theta_d"], rp1_d=eq["rp1_d"], mb_d=eq["mb_d"])
+
+        Z = np.zeros((n, STATE_2D.size))
+        Z[:, STATE_2D.index["v1"]] = eq["v1_d"]
+        Z[:, STATE_2D.index["v3"]] = eq["v3_d"]
+        Z[:, STATE_2D.index["mb"]] = eq["mb_d"]
+        Z[:, STATE_2D.index["theta"]] = self.theta0
+
+        eom = PlanarDynamics(var, n)
+        sol = solve_ivp(
+            eom.set_eom,
+            t_span=(0.0, duration),
+            y0=Z.ravel(),
+            method="RK45",
+            t_eval=np.linspace(0.0, duration, samples),
+            atol=np.tile(absolute_tolerances(STATE_2D, RTOL, self.scales, Z.T), n),
+            rtol=RTOL,
+        )
 
-    def save_json(self):
-        glide_vars = {
+        return sol.t, sol.y.reshape(n, STATE_2D.size, -1)
+
+    def glider_variables(self):
+        return {
             "alpha_d": self.alpha_d,
             "glide_dir": self.glider_direction,
             "glide_angle_deg": self.glide_angle_deg,
@@ -236,6 +450,8 @@ class Vertical_Motion:
             "rp3": self.rp3,
             "rb1": self.rb1,
             "rb3": self.rb3,
+            "rw1": self.rw1,
+            "rw3": self.rw3,
             "phi": self.phi,
             "theta0": self.theta0,
             "psi": self.psi,
@@ -260,45 +476,116 @@ class Vertical_Motion:
             "m": self.m,
             "m0": self.m0,
             "mt": self.mt,
+            "rho_ref": self.rho_ref,
+            "hull_compressibility": self.hull_compressibility,
+            "glider": self.glider_name,
+            "density_file": self.density_file,
+            "hydro_table_file": self.hydro_table_file,
             "pid_control": self.pid_control,
         }
 
-        pid_var = {
-            "theta_prev": self.theta0,
-        }
-
-        utils.save_json(glide_vars)
-        utils.save_json(pid_var, "vars/pid_variables.json")
-
     def solve_ode(self, z0, time):
-        def dvdt(t, y):
-            global inner_func
-
-            def inner_func(t, y):
-                eom = Dynamics(y)
-                D = eom.set_eom()
-                return D
-
-            Dr = inner_func(t, y)
-            return Dr[:-3]
-
-        sol = solve_ivp(
-            dvdt,
-            t_span=(min(time), max(time)),
-            y0=z0,
-            method="RK45",
-            t_eval=time,
-            atol=1e-7,
-            rtol=1e-4,
+        sol, w = integrate_leg(
+            self.glider_variables(),
+            z0,
+            time,
+            self.output == "adaptive",
+            self.control == "sampled",
+            self.stream,
+            self.rtol,
+            self.scales,
+            self.method,
         )
 
-        w = np.array([inner_func(time[i], sol.y.T[i, :]) for i in range(len(time))])[
-            :, -3
-        ]
-
         return sol, w
 
 
+def integrate_leg(
+    var,
+    z0,
+    time,
+    adaptive=False,
+    sampled=False,
+    stream=None,
+    rtol=RTOL,
+    scales=None,
+    method="RK45",
+):
+    # With sampled, the controllers run as discrete-time tasks (see
+    # PlanarDynamics.controller_tasks) and the leg is integrated between
+    # their ticks. A live view stream sees the states as they are integrated.
+    # The absolute tolerances are scaled to the leg's steady glide.
+    eom = PlanarDynamics(var)
+    fun = eom.set_eom if stream is None else stream.wrap(eom.set_eom)
+
+    def moving_mass_acceleration(t, y, held=None):
+        eom.held = held
+        eom.set_eom(t, y)
+        return eom.w1
+
+    solve = solve_ivp
+    if sampled:
+        scheduler = Scheduler(eom.controller_tasks())
+        eom.held = scheduler.held
+        solve = scheduler.solve
+
+    sol = solve(
+        fun,
+        t_span=(min(time), max(time)),
+        y0=z0,
+        method=method,
+        t_eval=None if adaptive else time,
+        dense_output=adaptive,
+        atol=absolute_tolerances(STATE_2D, rtol, scales, steady_glide(var, z0, 0.0)),
+        rtol=rtol,
+    )
+
+    if adaptive:
+        sol.t, sol.y = adaptive_times(sol)
+
+    held = [scheduler.held_at(t) if sampled else None for t in sol.t]
+    w = np.array(
+        [moving_mass_acceleration(*point) for point in zip(sol.t, sol.y.T, held)]
+    )
+
+    return sol, w
+
+
+def leg_start(z0):
+    # The moving mass is parked at rp1_d at the end of a leg: the next leg
+    # starts it from rest
+    z1 = np.array(z0, dtype=float)
+    z1[STATE_2D.index["rp1_dot"]] = 0.0
+
+    return z1
+
+
+def fine_leg(job):
+    # Parareal fine propagator, evaluated in a worker process
+    sol, w = integrate_leg(*job)
+
+    return sol.y[:, -1], (sol, w)
+
+
+def steady_glide(var, z0, duration):
+    # Parareal coarse propagator: the leg flown at its desired steady glide
+    i = STATE_2D.index
+    z1 = np.array(z0, dtype=float)
+    ct, st = math.cos(var["theta_d"]), math.sin(var["theta_d"])
+
+    z1[i["x"]] += duration * (ct * var["v1_d"] + st * var["v3_d"])
+    z1[i["z"]] += duration * (-st * var["v1_d"] + ct * var["v3_d"])
+    z1[i["q"]] = 0.0
+    z1[i["v1"]] = var["v1_d"]
+    z1[i["v3"]] = var["v3_d"]
+    z1[i["rp1"]] = var["rp1_d"]
+    z1[i["rp1_dot"]] = 0.0
+    z1[i["mb"]] = var["mb_d"]
+    z1[i["theta"]] = var["theta_d"]
+
+    return z1
+
+
 if __name__ == "__main__":
     Z = Vertical_Motion()
     Z.set_desired_trajectory()
@@ -0,0 +1,258 @@
+import math
+import numpy as np
+import utils
+from Environment.density import (
+    load_density_profile,
+    displaced_mass,
+    displaced_mass_batch,
+)
+from Hydrodynamics.coefficient_tables import load_hydro_table
+from Control.scheduler import Task
+from Parameters.registry import load_glider
+from State.state_schema import STATE_2D
+
+# Pitch PID of Modeling2d/dynamics_2D (utils.PID with ki = 0)
+PITCH_KP = 0.05
+PITCH_KD = 0.0005
+
+
+class PlanarDynamics:
+    # Vertical-plane equations of motion of Modeling2d/dynamics_2D.Dynamics
+    # written out in scalars: with Omega = (0, q, 0) and every vector in the
+    # x-z plane, the cross products reduce to the two in-plane force and the
+    # pitch moment components, and the control transformation to a 3x3
+    # system (Control/control_transformation restricted to a1, a3, beta2).
+    #
+    # With n = None one glider is integrated and the formulas run on Python
+    # floats. With n profiles the state is an (n, STATE_2D.size) array and any
+    # glider variable may be an array of length n, as in
+    # Modeling3d/batch_dynamics.
+    def __init__(self, var, n=None):
+        self.n = n
+        self.g = utils.constants()[0]
+
+        if n is None:
+            self.cos, self.sin, self.atan = math.cos, math.sin, math.atan
+            value = float
+        else:
+            self.cos, self.sin, self.atan = np.cos, np.sin, np.arctan
+
+            def value(x):
+                return np.asarray(x, dtype=float)
+
+        M = np.asarray(var["M"], dtype=float)
+        J = np.asarray(var["J"], dtype=float)
+        self.m1 = value(M[..., 0, 0])
+        self.m3 = value(M[..., 2, 2])
+        self.J2 = value(J[..., 1, 1])
+
+        for name in (
+            "KL",
+            "KL0",
+            "KD",
+            "KD0",
+            "KM",
+            "KM0",
+            "KOmega1",
+            "KOmega2",
+            "mh",
+            "mw",
+            "mm",
+            "m",
+            "rp3",
+            "rb1",
+            "rb3",
+            "rw1",
+            "rw3",
+            "theta_d",
+            "rp1_d",
+            "mb_d",
+            "rho_ref",
+            "hull_compressibility",
+        ):
+            setattr(self, name, value(var[name]))
+
+        # +1 diving ("D"), -1 climbing ("U")
+        glide_dir = np.where(np.asarray(var["glide_dir"]) == "U", -1.0, 1.0)
+        self.s = value(glide_dir)
+        self.ballast_rate = self.s * abs(value(var["ballast_rate"]))
+        self.pid = var["pid_control"] == "enable"
+        self.params = load_glider(var.get("glider", "slocum"), "2D")
+        self.wp1 = self.params.CONTROLS.wp1
+
+        self.density = load_density_profile(var.get("density_file"))
+        self.hydro_table = load_hydro_table(var.get("hydro_table_file"))
+
+        # Commanded moving mass acceleration and force of the actuator on the
+        # moving mass along the body axis of the last call
+        self.w1 = 0.0
+        self.u1 = 0.0
+
+        # Outputs of the sampled-data controllers (see controller_tasks), held
+        # between ticks. None runs the controllers continuously in the RHS.
+        self.held = None
+
+    def displaced_mass(self, z):
+        args = (
+            self.m,
+            z,
+            self.density,
+            self.rho_ref,
+            self.hull_compressibility,
+            self.g,
+        )
+
+        if self.n is None:
+            return displaced_mass(*args)
+
+        return displaced_mass_batch(*args)
+
+    def coefficients(self, alpha):
+        if self.hydro_table is not None:
+            if self.n is None:
+                return self.hydro_table.longitudinal(alpha)
+            return self.hydro_table.longitudinal_batch(alpha)
+
+        return (
+            self.KL0 + self.KL * alpha,
+            self.KD0 + self.KD * alpha * alpha,
+            self.KM0 + self.KM * alpha,
+        )
+
+    def controller_tasks(self):
+        # Pitch PID and ballast pump of one glider (n = None) as discrete-time
+        # controllers for Control/scheduler, at the rates of the glider's
+        # CONTROL_PERIODS
+        i = STATE_2D.index
+        periods = self.params.CONTROL_PERIODS
+
+        def pitch(t, y):
+            return PITCH_KP * (self.theta_d - y[i["theta"]]) - PITCH_KD * y[i["q"]]
+
+        def ballast(t, y):
+            # Rate that reaches mb_d at the next tick, within the pump rate,
+            # so that the held command does not overshoot
+            rate = (self.mb_d - y[i["mb"]]) / periods.BALLAST
+            return min(max(rate, -abs(self.ballast_rate)), abs(self.ballast_rate))
+
+        tasks = [Task("ballast", periods.BALLAST, ballast)]
+        if self.pid:
+            tasks.append(Task("pitch", periods.PITCH, pitch))
+
+        return tasks
+
+    def set_eom(self, t, y):
+        if self.n is None:
+            y = y.tolist()
+        else:
+            y = y.reshape(self.n, STATE_2D.size).T
+
+        i = STATE_2D.index
+        z, q, theta = y[i["z"]], y[i["q"]], y[i["theta"]]
+        v1, v3 = y[i["v1"]], y[i["v3"]]
+        rp1, rp1_dot, mb = y[i["rp1"]], y[i["rp1_dot"]], y[i["mb"]]
+
+        g, s = self.g, self.s
+        m1, m3, mm, rp3 = self.m1, self.m3, self.mm, self.rp3
+        ct, st = self.cos(theta), self.sin(theta)
+
+        V2 = v1 * v1 + v3 * v3
+        CL, CD, CM = self.coefficients(self.atan(v3 / v1))
+        L = CL * V2
+        D = CD * V2
+        MDL = CM * V2 + self.KOmega1 * q + self.KOmega2 * q * q
+
+        m0 = self.mh + self.mw + mb + mm - self.displaced_mass(z)
+
+        if self.held is None:
+            ballast_rate = self.ballast_rate * (s * (mb - self.mb_d) < 0)
+        else:
+            ballast_rate = self.held["ballast"]
+
+        # Moving mass momentum, before the mass is stopped at rp1_d
+        Pp1 = mm * (-s * v1 + q * rp3 + rp1_dot)
+        Pp3 = mm * (-s * v3 - q * rp1)
+
+        moving = s * (rp1 - self.rp1_d) < 0
+        if self.pid and self.held is not None:
+            w1 = self.held["pitch"]
+        elif self.pid:
+            w1 = PITCH_KP * (self.theta_d - theta) - PITCH_KD * q
+        else:
+            w1 = self.wp1 * moving
+            rp1_dot = rp1_dot * moving
+        self.w1 = s * w1
+
+        # (M v + Pp) x Omega + m0 g R^T k + F_ext
+        F1 = -(m3 * v3 + Pp3) * q - m0 * g * st - D
+        F3 = (m1 * v1 + Pp1) * q + m0 * g * ct - L
+
+        # Pitch component of T_bar before the control force
+        T2 = (
+            (m3 - m1) * v1 * v3
+            - q * (rp1 * Pp1 + rp3 * Pp3)
+            - g * ((mm * rp1 + mb * self.rb1) * ct + (mm * rp3 + mb * self.rb3) * st)
+            + MDL
+        )
+
+        # Z_i = -inv(M) F - Omega x r_i_dot - (inv(J) T) x r_i
+        JT = T2 / self.J2
+        Z1 = -F1 / m1
+        Z3 = -F3 / m3
+
+        masses = [mm, mb]
+        r1 = [rp1, self.rb1]
+        r3 = [rp3, self.rb3]
+        y1 = [mm * (self.w1 - Z1 + JT * rp3), -mb * (Z1 - JT * self.rb3)]
+        y3 = [mm * (-Z3 - q * rp1_dot - JT * rp1), -mb * (Z3 + JT * self.rb1)]
+
+        if self.n is not None or self.mw != 0:
+            masses.append(self.mw)
+            r1.append(self.rw1)
+            r3.append(self.rw3)
+            y1.append(-self.mw * (Z1 - JT * self.rw3))
+            y3.append(-self.mw * (Z3 + JT * self.rw1))
+
+        # K [a1, a3, beta2] = [sum y1, sum y3, sum (y x r)_2], solved through
+        # the Schur complement of the translational block
+        m_total = sum(masses)
+        c1 = sum(m * r for m, r in zip(masses, r1))
+        c3 = sum(m * r for m, r in zip(masses, r3))
+        K22 = self.J2 + sum(m * (a * a + b * b) for m, a, b in zip(masses, r1, r3))
+        h1 = sum(y1)
+        h3 = sum(y3)
+        h2 = sum(a * r - b * p for a, b, r, p in zip(y3, y1, r1, r3))
+
+        A1 = m1 + m_total
+        A3 = m3 + m_total
+        beta = (h2 + c3 * h1 / A1 - c1 * h3 / A3) / (K22 - c3 * c3 / A1 - c1 * c1 / A3)
+        a1 = (h1 + c3 * beta) / A1
+        a3 = (h3 - c1 * beta) / A3
+
+        # Force on the moving mass, zero once it has reached rp1_d
+        u1 = (y1[0] - mm * (a1 - rp3 * beta)) * moving
+        u3 = (y3[0] - mm * (a3 + rp1 * beta)) * moving
+
+        # u1 is Pp_dot; the actuator also holds the mass against gravity and
+        # the turning frame: u = Pp_dot + Omega x Pp - mm g R^T k
+        self.u1 = (u1 + q * Pp3 + mm * g * st) * moving
+
+        derivatives = {
+            "x": ct * v1 + st * v3,
+            "z": -st * v1 + ct * v3,
+            "q": (T2 - rp3 * u1 + rp1 * u3) / self.J2,
+            "v1": (F1 - u1) / m1,
+            "v3": (F3 - u3) / m3,
+            "rp1": rp1_dot,
+            "rp1_dot": self.w1,
+            "mb": ballast_rate,
+            "theta": q,
+        }
+
+        if self.n is None:
+            return [derivatives[name] for name in STATE_2D.names]
+
+        return np.stack(
+            np.broadcast_arrays(*[derivatives[name] for name in STATE_2D.names]),
+            axis=1,
+        ).ravel()
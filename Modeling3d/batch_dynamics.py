@@ -0,0 +1,363 @@
+import copy
+import numpy as np
+from scipy.integrate import solve_ivp
+import utils
+from Control.control_transformation import solve_control_forces_batch
+from Environment.currents import load_current_field
+from Environment.density import load_density_profile, displaced_mass_batch
+from Hydrodynamics.coefficient_tables import load_hydro_table
+from Parameters.registry import load_glider
+from State.state_schema import STATE_3D
+
+# Rudder coefficients, as in the scalar dynamics
+KD_DELTA = 2.0
+KFS_DELTA = 5.0
+KMY_DELTA = 1.0
+
+# Forward speed (m/s) below which fly_batch takes a glider out
+MIN_SPEED = 0.02
+
+SCALAR_PARAMS = (
+    "KL",
+    "KL0",
+    "KD",
+    "KD0",
+    "K_beta",
+    "KM",
+    "KM0",
+    "K_MY",
+    "K_MR",
+    "KOmega11",
+    "KOmega12",
+    "KOmega13",
+    "mh",
+    "mw",
+    "mm",
+    "m",
+    "rho_ref",
+    "hull_compressibility",
+)
+
+
+def cross(a, b):
+    out = np.empty(np.broadcast_shapes(a.shape, b.shape))
+    out[..., 0] = a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1]
+    out[..., 1] = a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2]
+    out[..., 2] = a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+    return out
+
+
+def rotation(phi, theta, psi):
+    cphi, sphi = np.cos(phi), np.sin(phi)
+    cth, sth = np.cos(theta), np.sin(theta)
+    cpsi, spsi = np.cos(psi), np.sin(psi)
+
+    R = np.empty(np.shape(phi) + (3, 3))
+    R[..., 0, 0] = cpsi * cth
+    R[..., 0, 1] = -spsi * cphi + cpsi * sth * sphi
+    R[..., 0, 2] = spsi * sphi + cpsi * cphi * sth
+    R[..., 1, 0] = spsi * cth
+    R[..., 1, 1] = cpsi * cphi + sphi * sth * spsi
+    R[..., 1, 2] = -cpsi * sphi + sth * spsi * cphi
+    R[..., 2, 0] = -sth
+    R[..., 2, 1] = cth * sphi
+    R[..., 2, 2] = cth * cphi
+
+    return R
+
+
+class GliderControls:
+    # Per-glider control settings, one entry per glider. The fleet model
+    # rewrites them between integration windows (new waypoint, new yo leg).
+    def __init__(self, n, var):
+        ones = np.ones(n)
+
+        self.glide_dir = ones.copy()  # +1 diving ("D"), -1 climbing ("U")
+        self.mb_d = var.get("mb_d", 0.0) * ones
+        self.rp1_d = var.get("rp1_d", 0.0) * ones
+        self.rp2_d = var.get("rp2", 0.0) * ones
+        self.ballast_rate = abs(var["ballast_rate"]) * ones
+
+        self.rudder = np.full(n, var.get("rudder", "disable") == "enable")
+        self.rudder_angle = var.get("rudder_angle", 0.0) * ones
+        self.heading_control = np.zeros(n, dtype=bool)
+        self.kp = 3.5 * ones
+        self.kd = 0.5 * ones
+        self.rudder_limit = np.inf * ones
+        self.target = np.zeros((n, 2))
+        self.capture_radius = np.zeros(n)
+
+    def subset(self, index):
+        # Copy of the controls of the gliders at index
+        controls = copy.copy(self)
+        for name, value in vars(self).items():
+            setattr(controls, name, value[index])
+
+        return controls
+
+
+class BatchDynamics:
+    # Vectorized counterpart of Modeling3d/dynamics_3D.Dynamics and
+    # Waypoint/dynamics_waypoint.Dynamics for N gliders stacked in an
+    # (N, STATE_3D.size) state array. Glider variables may be scalars (shared)
+    # or arrays of length N (one value per glider). M and J are taken to be
+    # diagonal, as built by the glider models. With the compiled glider model
+    # (Parameters/registry.GliderModel) that var was built from, its inverses
+    # are used; without it, as for fitted masses, they are taken from var.
+    def __init__(self, var, n, controls=None, model=None):
+        self.n = n
+        self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
+
+        self.M = np.diagonal(np.asarray(var["M"], dtype=float), axis1=-2, axis2=-1)
+        self.J = np.diagonal(np.asarray(var["J"], dtype=float), axis1=-2, axis2=-1)
+        if model is None:
+            model = load_glider(var.get("glider", "slocum"), "3D")
+            self.M_inv = 1 / self.M
+            self.J_inv = 1 / self.J
+        else:
+            self.M_inv = np.diagonal(model.M_inv)
+            self.J_inv = np.diagonal(model.J_inv)
+        self.M_mat = self.M[..., None] * np.eye(3)
+        self.J_mat = self.J[..., None] * np.eye(3)
+
+        for name in SCALAR_PARAMS:
+            setattr(self, name, np.asarray(var[name], dtype=float))
+
+        self.mm_col = np.broadcast_to(self.mm, (n,))[:, None]
+        self.rb = np.broadcast_to(
+            np.array([var["rb1"], var["rb2"], var["rb3"]], dtype=float).T, (n, 3)
+        )
+        self.rw = np.array([var["rw1"], var["rw2"], var["rw3"]], dtype=float).T
+
+        self.controls = GliderControls(n, var) if controls is None else controls
+        self.wp = model.CONTROLS
+
+        self.current = load_current_field(var.get("current_file"))
+        self.density = load_density_profile(var.get("density_file"))
+        self.hydro_table = load_hydro_table(var.get("hydro_table_file"))
+
+        self.delta = np.zeros(n)
+
+    def set_rudder(self, Z, Omega):
+        c = self.controls
+
+        # Heading PD towards the active waypoint (utils.PID with ki = 0). Inside
+        # the capture radius the bearing swings round as the glider passes the
+        # waypoint, so the rudder is held there instead.
+        dx = c.target[:, 0] - Z[:, STATE_3D.index["x"]]
+        dy = c.target[:, 1] - Z[:, STATE_3D.index["y"]]
+        psi_d = np.arctan2(dy, dx)
+        error = np.angle(np.exp(1j * (psi_d - Z[:, STATE_3D.index["psi"]])))
+        delta = np.clip(
+            c.kp * error - c.kd * Omega[:, 2], -c.rudder_limit, c.rudder_limit
+        )
+
+        steering = c.heading_control & (np.hypot(dx, dy) > c.capture_radius)
+        delta = np.where(steering, delta, c.rudder_angle)
+
+        return np.where(c.rudder, delta, 0.0)
+
+    def set_force_torque(self, v_r, Omega, delta):
+        V2 = np.sum(v_r * v_r, axis=1)
+        V = np.sqrt(V2)
+        alpha = np.arctan(v_r[:, 2] / v_r[:, 0])
+        beta = np.arcsin(v_r[:, 1] / V)
+
+        rudder = self.controls.rudder
+
+        if self.hydro_table is None:
+            CL = self.KL0 + self.KL * alpha
+            CD = self.KD0 + self.KD * alpha**2
+            CM = self.KM0 + self.KM * alpha
+        else:
+            CL, CD, CM = self.hydro_table.longitudinal_batch(alpha)
+
+        if self.hydro_table is not None and self.hydro_table.CD_delta is not None:
+            CD = CD + self.hydro_table.CD_delta.batch(delta)
+        else:
+            CD = CD + np.where(rudder, KD_DELTA, 0.0) * delta**2
+
+        if self.hydro_table is not None and self.hydro_table.lateral:
+            CSF, CMR, CMY = self.hydro_table.lateral_batch(beta, delta)
+        else:
+            CSF = self.K_beta * beta + np.where(rudder, KFS_DELTA, 0.0) * delta
+            CMR = self.K_MR * beta
+            CMY = self.K_MY * beta + np.where(rudder, KMY_DELTA, 0.0) * delta
+
+        F_ext = np.stack([-CD * V2, CSF * V2, -CL * V2], axis=1)
+        T_ext = np.stack(
+            [
+                (CMR + self.KOmega11 * Omega[:, 0]) * V2,
+                (CM + self.KOmega12 * Omega[:, 1]) * V2,
+                (CMY + self.KOmega13 * Omega[:, 2]) * V2,
+            ],
+            axis=1,
+        )
+
+        return F_ext, T_ext
+
+    def set_eom(self, t, Z):
+        c = self.controls
+        g = self.g
+
+        S = STATE_3D
+        n1 = Z[:, S.slice("n1")]
+        Omega = Z[:, S.slice("Omega")]
+        v = Z[:, S.slice("v")]
+        rp = Z[:, S.slice("rp")]
+        rb = self.rb
+        rp_dot = Z[:, S.slice("rp_dot")]
+        mb = Z[:, S.index["mb"]]
+        phi, theta, psi = (
+            Z[:, S.index["phi"]],
+            Z[:, S.index["theta"]],
+            Z[:, S.index["psi"]],
+        )
+
+        down = c.glide_dir > 0
+        s = c.glide_dir[:, None]
+
+        R = rotation(phi, theta, psi)
+        k_body = R[:, 2, :]  # R_T @ k_hat
+
+        # v is the velocity relative to the water, on which the hydrodynamic
+        # forces act; the current only carries the gliders along (n1_dot)
+        if self.current is None:
+            v_c = np.zeros_like(n1)
+        else:
+            v_c = self.current.sample_batch(t, n1)
+
+        self.delta = self.set_rudder(Z, Omega)
+        F_ext, T_ext = self.set_force_torque(v, Omega, self.delta)
+
+        m = displaced_mass_batch(
+            self.m, n1[:, 2], self.density, self.rho_ref, self.hull_compressibility, g
+        )
+        m0 = (self.mh + self.mw + mb + self.mm - m)[:, None]
+
+        ballast_rate = np.where(
+            down,
+            np.where(mb >= c.mb_d, 0.0, c.ballast_rate),
+            np.where(mb <= c.mb_d, 0.0, -c.ballast_rate),
+        )
+
+        Pp = self.mm_col * (-s * v + cross(Omega, rp) + rp_dot)
+
+        # control_transformation: drive rp1 (and rp2 without rudder) to target.
+        # Each axis stops at its own target; the mass is parked once both have.
+        reached = np.where(down, rp[:, 0] >= c.rp1_d, rp[:, 0] <= c.rp1_d)
+        roll_hold = c.rudder | (rp[:, 1] >= c.rp2_d)
+        parked = reached & roll_hold
+
+        rp_dot = np.where(down[:, None], rp_dot, -rp_dot)
+        rp_dot = np.where(np.stack([reached, roll_hold, parked], axis=1), 0.0, rp_dot)
+
+        w1 = np.where(reached, 0.0, c.glide_dir * self.wp.wp1)
+        w2 = np.where(roll_hold, 0.0, self.wp.wp2)
+        wp = s * np.stack([w1, w2, np.full(self.n, self.wp.wp3)], axis=1)
+
+        Mv = self.M * v
+        F_common = cross(Mv + Pp, Omega) + m0 * g * k_body + F_ext
+        T_common = (
+            cross(self.J * Omega + cross(rp, Pp), Omega)
+            + cross(Mv, v)
+            + T_ext
+            + cross(cross(Omega, rp), Pp)
+            + g * (self.mm_col * cross(rp, k_body) + mb[:, None] * cross(rb, k_body))
+        )
+
+        Z_common = -self.M_inv * F_common - cross(Omega, rp_dot)
+        JT = self.J_inv * T_common
+        Zp = Z_common - cross(JT, rp)
+        Zb = Z_common - cross(JT, rb)
+
+        masses = [self.mm, mb]
+        positions = [rp, rb]
+        rhs = [wp - Zp, -Zb]
+
+        if np.any(self.mw != 0):
+            masses.append(self.mw)
+            positions.append(np.broadcast_to(self.rw, (self.n, 3)))
+            rhs.append(cross(JT, self.rw) - Z_common)
+
+        u_bar = solve_control_forces_batch(
+            self.M_mat, self.J_mat, masses, positions, rhs
+        )[0]
+        u_bar = np.where(parked[:, None], 0.0, u_bar)
+
+        T_bar = T_common - cross(rp, u_bar)
+        F_bar = F_common - u_bar
+
+        cphi, sphi = np.cos(phi), np.sin(phi)
+        cth, tth = np.cos(theta), np.tan(theta)
+        p, q, r = Omega[:, 0], Omega[:, 1], Omega[:, 2]
+
+        D = np.empty_like(Z)
+        D[:, S.slice("n1")] = np.einsum("nij,nj->ni", R, v) + v_c
+        D[:, S.slice("Omega")] = self.J_inv * T_bar
+        D[:, S.slice("v")] = self.M_inv * F_bar
+        D[:, S.slice("rp")] = rp_dot
+        D[:, S.slice("rp_dot")] = wp
+        D[:, S.index["mb"]] = ballast_rate
+        D[:, S.index["phi"]] = p + sphi * tth * q + cphi * tth * r
+        D[:, S.index["theta"]] = cphi * q - sphi * r
+        D[:, S.index["psi"]] = sphi / cth * q + cphi / cth * r
+
+        return D
+
+    def derivatives(self, t, y):
+        return self.set_eom(t, y.reshape(self.n, STATE_3D.size)).ravel()
+
+
+def fly_batch(make_batch, Z, t_eval, **options):
+    # Integrates the gliders Z (n, STATE_3D.size) with solve_ivp (options)
+    # and returns their states at t_eval, shape (n, STATE_3D.size, len(t_eval)).
+    # A glider whose forward speed drops below MIN_SPEED (it stalls; the model
+    # does not fly backwards) or whose body z axis stops pointing down (it
+    # tumbles) is taken out and left NaN from there on, and the others fly on. make_batch(active) returns the
+    # BatchDynamics of the gliders with the indices active.
+    n = len(Z)
+    S = STATE_3D
+
+    Y = np.full((n, S.size, len(t_eval)), np.nan)
+    active = np.arange(n)
+    t0, y0 = t_eval[0], Z.ravel()
+    k = 0
+
+    def margin(Y):
+        return np.minimum(
+            Y[:, S.index["v1"]] - MIN_SPEED,
+            np.cos(Y[:, S.index["phi"]]) * np.cos(Y[:, S.index["theta"]]),
+        )
+
+    def stall(t, y):
+        return np.min(margin(y.reshape(-1, S.size)))
+
+    stall.terminal = True
+    stall.direction = -1
+
+    while len(active) and k < len(t_eval):
+        batch = make_batch(active)
+        sol = solve_ivp(
+            batch.derivatives,
+            t_span=(t0, t_eval[-1]),
+            y0=y0,
+            t_eval=t_eval[k:],
+            events=stall,
+            **options
+        )
+        if len(sol.t):
+            Y[active, :, k : k + len(sol.t)] = sol.y.reshape(len(active), S.size, -1)
+            k += len(sol.t)
+
+        if sol.status != 1:
+            break
+
+        # Restart from the stall with the stalled glider removed
+        y = sol.y_events[0][0].reshape(len(active), S.size)
+        keep = np.arange(len(active)) != np.argmin(margin(y))
+        active, y0 = active[keep], y[keep].ravel()
+        t0 = sol.t_events[0][0]
+
+    return Y
@@ -1,38 +1,46 @@
 import numpy as np
 import math
 import utils
-from Parameters.slocum3D import SLOCUM_PARAMS
+from Control.control_transformation import solve_control_forces
+from Environment.density import load_density_profile, displaced_mass
+from Hydrodynamics.coefficient_tables import load_hydro_table
+from Environment.currents import load_current_field
+from Parameters.registry import load_glider
+from State.attitude import (
+    attitude_schema,
+    quaternion_rate,
+    quaternion_rotation,
+    quaternion_to_euler,
+)
 
 
 class Dynamics:
-    def __init__(self, z):
-        self.initialization()
-
-        self.n1 = np.array([z[0:3]]).T
-        self.Omega = np.array([z[3:6]]).T
-        self.v = np.array([z[6:9]]).T
-        self.rp = np.array([z[9:12]]).T
-        self.rb = np.array([z[12:15]]).T
-        # self.Pp = np.array([z[15:18]]).T
-        # self.Pb = np.array([z[18:21]]).T
-        self.rp_dot = np.array([z[15:18]]).T
-        self.rb_dot = np.array([z[18:21]]).T
-        self.mb = z[21]
-        self.phi = z[24]
-        self.theta = z[25]
-        self.psi = z[26]
-
-        self.V = math.sqrt(
-            math.pow(self.v[0][0], 2)
-            + math.pow(self.v[1][0], 2)
-            + math.pow(self.v[2][0], 2)
-        )
+    def __init__(self, var, z, t=0.0, model=None):
+        self.t = t
+
+        self.initialization(var, model)
+
+        self.n1 = self.schema.column(z, "n1")
+        self.Omega = self.schema.column(z, "Omega")
+        self.v = self.schema.column(z, "v")
+        self.rp = self.schema.column(z, "rp")
+        self.rb = np.array([[self.rb1, self.rb2, self.rb3]]).T
+        self.rp_dot = self.schema.column(z, "rp_dot")
+        self.rb_dot = np.zeros((3, 1))
+        self.mb = z[self.schema.index["mb"]]
+        if self.attitude == "quaternion":
+            self.e = self.schema.get(z, "quaternion")
+            self.phi, self.theta, self.psi = quaternion_to_euler(self.e)
+        else:
+            self.phi, self.theta, self.psi = self.schema.get(z, "n2")
 
         self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
 
+        self.v_c = self.current_velocity()
+
         self.set_force_torque()
 
-        self.controls = SLOCUM_PARAMS.CONTROLS
+        self.controls = self.model.CONTROLS
 
         self.rp_c = utils.unit_vecs(self.rp)
         self.rb_c = utils.unit_vecs(self.rb)
@@ -43,14 +51,26 @@ class Dynamics:
 
         # self.rb_dot = np.array([self.Z3]).transpose()
 
+        self.m = displaced_mass(
+            self.m,
+            self.n1[2][0],
+            self.density,
+            self.rho_ref,
+            self.hull_compressibility,
+            self.g,
+        )
+
         self.m0 = self.mh + self.mw + self.mb + self.mm - self.m
 
         if self.glide_dir == "D":
             if self.mb >= self.mb_d:
                 self.ballast_rate = 0
 
-    def initialization(self):
-        var = utils.load_json("vars/3d_glider_variables.json")
+    def initialization(self, var, model):
+        # var: the glider variables of the model (ThreeD_Motion.glider_variables)
+        self.glider = var.get("glider", "slocum")
+        self.attitude = var.get("attitude", "euler")
+        self.schema = attitude_schema(self.attitude)
 
         self.pid_control = var["pid_control"]
         self.alpha_d = var["alpha_d"]
@@ -71,28 +91,22 @@ class Dynamics:
         self.rb1 = var["rb1"]
         self.rb2 = var["rb2"]
         self.rb3 = var["rb3"]
+        self.rw = np.array([[var["rw1"], var["rw2"], var["rw3"]]]).T
         self.phi0 = var["phi0"]
         self.theta0 = var["theta0"]
         self.psi0 = var["psi0"]
 
-        self.Mf = np.array(var["Mf"])
-        self.M = np.array(var["M"])
-        self.J = np.array(var["J"])
-        self.KL = var["KL"]
-        self.KL0 = var["KL0"]
-        self.KM = var["KM"]
-        self.KM0 = var["KM0"]
-        self.K_beta = var["K_beta"]
-        self.KD = var["KD"]
-        self.KD0 = var["KD0"]
-        self.K_MY = var["K_MY"]
-        self.K_MR = var["K_MR"]
-        self.KOmega11 = var["KOmega11"]
-        self.KOmega12 = var["KOmega12"]
-        self.KOmega13 = var["KOmega13"]
-        self.KOmega21 = var["KOmega21"]
-        self.KOmega22 = var["KOmega22"]
-        self.KOmega23 = var["KOmega23"]
+        # Mass matrices, their inverses and the hydrodynamic coefficients of
+        # the compiled glider model (Parameters/registry.GliderModel)
+        self.model = model or load_glider(self.glider, "3D")
+        self.Mf = self.model.Mf
+        self.M = self.model.M
+        self.J = self.model.J
+        self.M_inv = self.model.M_inv
+        self.J_inv = self.model.J_inv
+        self.__dict__.update(
+            zip(self.model.coefficients, self.model.hydrodynamics.tolist())
+        )
         self.V_d = var["desired_glide_speed"]
         self.ballast_rate = var["ballast_rate"]
         self.mh = var["mh"]
@@ -104,12 +118,35 @@ class Dynamics:
         self.m0 = var["m0"]
         self.mt = var["mt"]
 
+        self.rho_ref = var["rho_ref"]
+        self.hull_compressibility = var["hull_compressibility"]
+        self.density = load_density_profile(var.get("density_file"))
+        self.hydro_table = load_hydro_table(var.get("hydro_table_file"))
+
         self.rudder = var["rudder"]
         self.rudder_angle = var["rudder_angle"]
 
+        self.current = load_current_field(var.get("current_file"))
+
+    def current_velocity(self):
+        if self.current is None:
+            return np.array([self.Z3]).T
+
+        return np.array([self.current.sample(self.t, *self.n1[:, 0])]).T
+
     def set_force_torque(self):
-        self.alpha = math.atan(self.v[2][0] / self.v[0][0])
-        self.beta = math.asin(self.v[1][0] / self.V)
+        # v is the velocity relative to the water, on which the hydrodynamic
+        # forces act; the current only carries the glider along (n1_dot)
+        self.v_r = self.v
+
+        self.V = math.sqrt(
+            math.pow(self.v_r[0][0], 2)
+            + math.pow(self.v_r[1][0], 2)
+            + math.pow(self.v_r[2][0], 2)
+        )
+
+        self.alpha = math.atan(self.v_r[2][0] / self.v_r[0][0])
+        self.beta = math.asin(self.v_r[1][0] / self.V)
 
         if self.rudder == "enable":
             KD_delta = 2.0
@@ -138,25 +175,34 @@ class Dynamics:
             KFS_delta = 0.0
             KMY_delta = 0.0
 
-        L = (self.KL0 + self.KL * self.alpha) * (math.pow(self.V, 2))
-        D = (
-            self.KD0
-            + self.KD * (math.pow(self.alpha, 2))
-            + KD_delta * (math.pow(self.delta, 2))
-        ) * (math.pow(self.V, 2))
-        SF = (self.K_beta * self.beta + KFS_delta * self.delta) * math.pow(self.V, 2)
+        if self.hydro_table is None:
+            CL = self.KL0 + self.KL * self.alpha
+            CD = self.KD0 + self.KD * (math.pow(self.alpha, 2))
+            CM = self.KM0 + self.KM * self.alpha
+        else:
+            CL, CD, CM = self.hydro_table.longitudinal(self.alpha)
+
+        if self.hydro_table is not None and self.hydro_table.CD_delta is not None:
+            CD += self.hydro_table.CD_delta(self.delta)
+        else:
+            CD += KD_delta * (math.pow(self.delta, 2))
+
+        if self.hydro_table is not None and self.hydro_table.lateral:
+            CSF, CMR, CMY = self.hydro_table.lateral_coefficients(
+                self.beta, self.delta
+            )
+        else:
+            CSF = self.K_beta * self.beta + KFS_delta * self.delta
+            CMR = self.K_MR * self.beta
+            CMY = self.K_MY * self.beta + KMY_delta * self.delta
 
-        MDL1 = (self.K_MR * self.beta + self.KOmega11 * self.Omega[0][0]) * math.pow(
-            self.V, 2
-        )
-        MDL2 = (self.KM0 + self.KM * self.alpha + self.KOmega12 * self.Omega[1][0]) * (
-            math.pow(self.V, 2)
-        )
-        MDL3 = (
-            self.K_MY * self.beta
-            + self.KOmega13 * self.Omega[2][0]
-            + KMY_delta * self.delta
-        ) * math.pow(self.V, 2)
+        L = CL * (math.pow(self.V, 2))
+        D = CD * (math.pow(self.V, 2))
+        SF = CSF * math.pow(self.V, 2)
+
+        MDL1 = (CMR + self.KOmega11 * self.Omega[0][0]) * math.pow(self.V, 2)
+        MDL2 = (CM + self.KOmega12 * self.Omega[1][0]) * (math.pow(self.V, 2))
+        MDL3 = (CMY + self.KOmega13 * self.Omega[2][0]) * math.pow(self.V, 2)
 
         self.F_ext = np.array([[-D, SF, -L]]).transpose()  # same as X, Y, Z
 
@@ -176,12 +222,17 @@ class Dynamics:
             [tau1.transpose(), tau2.transpose()], dtype=np.float32
         ).transpose()
 
-        self.J1_n2, self.J2_n2 = utils.transformationMatrix(
-            self.phi, self.theta, self.psi
-        )
+        # The quaternion rates have no singularity at theta = +-90 deg
+        if self.attitude == "quaternion":
+            self.J1_n2 = quaternion_rotation(self.e)
+            self.n2_dot = quaternion_rate(self.e, self.Omega[:, 0])
+        else:
+            self.J1_n2, self.J2_n2 = utils.transformationMatrix(
+                self.phi, self.theta, self.psi
+            )
+            self.n2_dot = self.J2_n2 @ self.Omega
 
-        self.n1_dot = self.J1_n2 @ self.v
-        self.n2_dot = self.J2_n2 @ self.Omega
+        self.n1_dot = self.J1_n2 @ self.v + self.v_c
 
         R = self.J1_n2
         R_T = R.T  # same as np.linalg.inv(self.R)
@@ -189,22 +240,19 @@ class Dynamics:
         return R, R_T
 
     def control_transformation(self):
+        self.parked = False
         if self.glide_dir == "D":
-            if self.rp[0] >= self.rp1_d:
-                self.w1 = 0.0
-                self.rp_dot = np.array([[0, 0, 0]]).transpose()
-            elif self.rp[0] < self.rp1_d:
-                self.w1 = self.controls.wp1
-
-            if self.rudder == "disable":
-                if self.rp[1] >= self.rp2_d:
-                    self.w2 = 0.0
-                    self.rp_dot = np.array([[0, 0, 0]]).transpose()
-                elif self.rp[1] < self.rp2_d:
-                    self.w2 = self.controls.wp2
-
-            elif self.rudder == "enable":
-                self.w2 = 0.0
+            # Each axis stops at its own target, as in BatchDynamics; the mass
+            # is parked once both have. Stopping both axes when rp1 arrived
+            # left rp2 short of its target with its velocity growing.
+            reached = self.rp[0, 0] >= self.rp1_d
+            roll_hold = self.rudder == "enable" or self.rp[1, 0] >= self.rp2_d
+            self.parked = reached and roll_hold
+            stopped = np.array([[reached], [roll_hold], [self.parked]])
+            self.rp_dot = np.where(stopped, 0.0, self.rp_dot)
+
+            self.w1 = 0.0 if reached else self.controls.wp1
+            self.w2 = 0.0 if roll_hold else self.controls.wp2
 
         if self.glide_dir == "D":
             self.wp = np.array([[self.w1, self.w2, self.controls.wp3]]).transpose()
@@ -213,63 +261,8 @@ class Dynamics:
 
         self.ww = np.array([[0, 0, 0]]).transpose()
 
-        # 3x3 matrix when mw != 0
-        # self.F = np.array(
-        #     [
-        #         [
-        #             np.linalg.inv(self.M)
-        #             - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rp_c)
-        #             + (1 / self.mm) * self.I3,
-        #             np.linalg.inv(self.M)
-        #             - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rb_c),
-        #             np.linalg.inv(self.M)
-        #             - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rw_c)
-        #         ],
-        #         [
-        #             np.linalg.inv(self.M)
-        #             - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rp_c),
-        #             np.linalg.inv(self.M)
-        #             - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rb_c)
-        #             + (1 / self.mb) * self.I3,
-        #             np.linalg.inv(self.M)
-        #             - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rw_c)
-        #         ],
-        #         [
-        #             np.linalg.inv(self.M)
-        #             - self.rw_c @ (np.linalg.inv(self.J)) @ (self.rp_c),
-        #             np.linalg.inv(self.M)
-        #             - self.rw_c @ (np.linalg.inv(self.J)) @ (self.rb_c),
-        #             np.linalg.inv(self.M)
-        #             - self.rw_c @ (np.linalg.inv(self.J)) @ (self.rw_c)
-        #             + (1 / self.mw) * self.I3,
-        #         ]
-        #     ]
-        # )
-
-        # 2x2 matrix when mw = 0
-        self.F = np.array(
-            [
-                [
-                    np.linalg.inv(self.M)
-                    - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rp_c)
-                    + (1 / self.mm) * self.I3,
-                    np.linalg.inv(self.M)
-                    - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rb_c),
-                ],
-                [
-                    np.linalg.inv(self.M)
-                    - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rp_c),
-                    np.linalg.inv(self.M)
-                    - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rb_c)
-                    + (1 / self.mb) * self.I3,
-                ],
-            ]
-        )
-
-        self.H = np.linalg.inv(self.F)
-
         Zp = (
-            -np.linalg.inv(self.M)
+            -self.M_inv
             @ (
                 np.cross(self.M @ (self.v) + self.Pp + self.Pb, self.Omega, axis=0)
                 + self.m0 * self.g * np.matmul(self.R_T, self.k_hat)
@@ -277,7 +270,7 @@ class Dynamics:
             )
             - np.cross(self.Omega, self.rp_dot, axis=0)
             - np.cross(
-                np.linalg.inv(self.J)
+                self.J_inv
                 @ (
                     np.cross(
                         np.matmul(self.J, self.Omega)
@@ -300,7 +293,7 @@ class Dynamics:
         )
 
         Zb = (
-            -np.linalg.inv(self.M)
+            -self.M_inv
             @ (
                 np.cross(self.M @ (self.v) + self.Pp + self.Pb, self.Omega, axis=0)
                 + self.m0 * self.g * np.matmul(self.R_T, self.k_hat)
@@ -308,7 +301,7 @@ class Dynamics:
             )
             - np.cross(self.Omega, self.rp_dot, axis=0)
             - np.cross(
-                np.linalg.inv(self.J)
+                self.J_inv
                 @ (
                     np.cross(
                         np.matmul(self.J, self.Omega)
@@ -330,52 +323,53 @@ class Dynamics:
             )
         )
 
-        # Uncomment below if mw is not equal to 0
-        # Zw = (
-        #     -np.linalg.inv(self.M)
-        #     @ (
-        #         np.cross(self.M @ (self.v) + self.Pp + self.Pb, self.Omega, axis=0)
-        #         + self.m0 * self.g * np.matmul(self.R_T, self.k_hat)
-        #         + self.F_ext
-        #     )
-        #     - np.cross(self.Omega, self.rp_dot, axis=0)
-        #     - np.cross(
-        #         np.linalg.inv(self.J)
-        #         @ (
-        #             np.cross(
-        #                 np.matmul(self.J, self.Omega)
-        #                 + np.matmul(self.rp_c, self.Pp)
-        #                 + np.matmul(self.rb_c, self.Pb),
-        #                 self.Omega,
-        #                 axis=0,
-        #             )
-        #             + np.cross(np.matmul(self.M, self.v), self.v, axis=0)
-        #             + self.T_ext
-        #             + np.cross(np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0)
-        #             + np.cross(np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0)
-        #             + (self.mm * self.rp_c + self.mb * self.rb_c)
-        #             * self.g
-        #             @ (self.R_T @ self.k_hat)
-        #         ),
-        #         self.rw,
-        #         axis=0,
-        #     )
-        # )
-
-        self.H = np.concatenate(
-            (
-                np.concatenate((self.H[0][0], self.H[0][1]), axis=0),
-                np.concatenate((self.H[1][0], self.H[1][1]), axis=0),
-            ),
-            axis=1,
-        )
+        if self.mw != 0:
+            Zw = (
+                -self.M_inv
+                @ (
+                    np.cross(self.M @ (self.v) + self.Pp + self.Pb, self.Omega, axis=0)
+                    + self.m0 * self.g * np.matmul(self.R_T, self.k_hat)
+                    + self.F_ext
+                )
+                - np.cross(self.Omega, self.rp_dot, axis=0)
+                - np.cross(
+                    self.J_inv
+                    @ (
+                        np.cross(
+                            np.matmul(self.J, self.Omega)
+                            + np.matmul(self.rp_c, self.Pp)
+                            + np.matmul(self.rb_c, self.Pb),
+                            self.Omega,
+                            axis=0,
+                        )
+                        + np.cross(np.matmul(self.M, self.v), self.v, axis=0)
+                        + self.T_ext
+                        + np.cross(
+                            np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0
+                        )
+                        + np.cross(
+                            np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0
+                        )
+                        + (self.mm * self.rp_c + self.mb * self.rb_c)
+                        * self.g
+                        @ (self.R_T @ self.k_hat)
+                    ),
+                    self.rw,
+                    axis=0,
+                )
+            )
+
+        masses = [self.mm, self.mb]
+        positions = [self.rp, self.rb]
+        rhs = [-Zp + self.wp, -Zb + self.wb]
 
-        # self.u = self.H @ np.array(
-        #     [(-Zp + self.wp).flatten(), (-Zb + self.wb).flatten(), (-Zw + self.ww).flatten()]
-        # ).reshape(9,1) # uncomment if mw is not 0
+        if self.mw != 0:
+            masses.append(self.mw)
+            positions.append(self.rw)
+            rhs.append(-Zw + self.ww)
 
-        self.u = self.H @ np.array(((-Zp + self.wp), (-Zb + self.wb))).ravel()
-        self.u = self.u.reshape(2, 3)
+        # Solves F u = rhs without forming or inverting F
+        self.u = solve_control_forces(self.M, self.J, masses, positions, rhs)
 
         self.u_bar = np.array([self.u[0]]).T
 
@@ -385,7 +379,7 @@ class Dynamics:
         self.control_transformation()
 
         if self.glide_dir == "D":
-            if self.rp[0] >= self.rp1_d:
+            if self.parked:
                 self.u_bar = np.array([self.Z3]).T
 
         if self.glide_dir == "U":
@@ -432,11 +426,11 @@ class Dynamics:
             - (self.u_b)
         )
 
-        n1_dot = self.R @ self.v
+        n1_dot = self.R @ self.v + self.v_c
 
-        Omega_dot = np.linalg.inv(self.J) @ T_bar
+        Omega_dot = self.J_inv @ T_bar
 
-        v1_dot = np.linalg.inv(self.M) @ F_bar
+        v1_dot = self.M_inv @ F_bar
 
         # Pp_dot = self.u_bar
 
@@ -446,27 +440,17 @@ class Dynamics:
 
         rp_ddot = self.wp
 
-        rb_ddot = self.wb
-
-        mb_dot = np.array([[self.ballast_rate, 0, 0]]).T
-
-        return np.concatenate(
-            [
-                n1_dot,
-                Omega_dot,
-                v1_dot,
-                self.rp_dot,
-                self.rb_dot,
-                # Pp_dot,
-                # Pb_dot,
-                rp_ddot,
-                rb_ddot,
-                mb_dot,
-                self.n2_dot,
-                np.array([[self.delta, 0.0, 0.0]]).T
-                # self.wp
-            ]
-        ).ravel()
+        return self.schema.pack(
+            {
+                "n1": n1_dot,
+                "Omega": Omega_dot,
+                "v": v1_dot,
+                "rp": self.rp_dot,
+                "rp_dot": rp_ddot,
+                "mb": self.ballast_rate,
+                "quaternion" if self.attitude == "quaternion" else "n2": self.n2_dot,
+            }
+        )
 
 
 if __name__ == "__main__":
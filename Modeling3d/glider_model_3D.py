@@ -2,7 +2,21 @@ import numpy as np
 import math
 from scipy.integrate import solve_ivp
 import utils
+from Environment.density import load_density_profile, displaced_mass
 from Modeling3d.dynamics_3D import Dynamics
+from State.state_schema import STATE_3D
+from State.recording import DenseTrajectory, adaptive_times
+from Analysis.trajectory_analysis import flight_state, save_trajectory
+from Parameters.registry import load_glider
+from Visualization.live_view import LiveStream
+from State.attitude import attitude_schema, euler_states, quaternion_states
+from State.tolerances import absolute_tolerances, load_tolerances
+from State.channels import channel_recorder
+from Numerics.solvers import solver_setting
+
+# Relative tolerance of the spiral (solve_ivp's default); the absolute
+# tolerances follow from the state scales (State/tolerances.py)
+RTOL = 1e-3
 
 
 class ThreeD_Motion:
@@ -17,9 +31,20 @@ class ThreeD_Motion:
         else:
             self.cycles = self.args.cycle
         self.glider_name = self.args.glider
+        self.current_file = self.args.current
         self.info = self.args.info
         self.pid_control = self.args.pid
         self.plots = self.args.plot
+        self.output = self.args.output
+        self.trajectory_file = self.args.trajectory
+        self.live = self.args.live
+        self.stream = None
+        self.attitude = self.args.attitude
+        self.method, self.rtol = solver_setting(self.args.solver, RTOL)
+        self.scales = load_tolerances(self.args.tolerances, "3D")
+        self.dense = DenseTrajectory(
+            euler_states if self.attitude == "quaternion" else None
+        )
 
         self.initialization()
 
@@ -29,11 +54,8 @@ class ThreeD_Motion:
     def initialization(self):
         self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
 
-        if self.glider_name == ("slocum") and self.mode == "3D":
-            from Parameters.slocum3D import SLOCUM_PARAMS as P
-        else:
-            print("Invalid glider model")
-            raise ImportError
+        P = load_glider(self.glider_name, "3D")
+        self.params = P
 
         self.mass_params = P.GLIDER_CONFIG
         self.hydro_params = P.HYDRODYNAMICS
@@ -52,15 +74,17 @@ class ThreeD_Motion:
         self.m = self.mass_params.FLUID_DISP_MASS
         self.m0 = self.mt - self.m
 
-        self.Mf = np.diag(
-            [self.mass_params.MF1, self.mass_params.MF2, self.mass_params.MF3]
-        )
-        self.Jf = np.diag(
-            [self.mass_params.J1, self.mass_params.J2, self.mass_params.J3]
-        )
+        self.rho_ref = self.mass_params.REF_DENSITY
+        self.hull_compressibility = self.mass_params.HULL_COMPRESSIBILITY
+        self.density_file = self.args.density
+        self.density = load_density_profile(self.density_file)
+        self.hydro_table_file = self.args.hydrotable
 
-        self.M = self.mh * self.I3 + self.Mf
-        self.J = self.Jf  # J = Jf + Jh
+        self.Mf = P.Mf
+        self.Jf = P.Jf
+
+        self.M = P.M
+        self.J = P.J  # J = Jf + Jh
 
         self.KL = self.hydro_params.KL
         self.KL0 = self.hydro_params.KL0
@@ -87,6 +111,9 @@ class ThreeD_Motion:
         self.rb1 = self.vars.rb1
         self.rb2 = self.vars.rb2
         self.rb3 = self.vars.rb3
+        self.rw1 = self.vars.rw1
+        self.rw2 = self.vars.rw2
+        self.rw3 = self.vars.rw3
 
         self.glide_angle_deg = self.vars.GLIDE_ANGLE
         self.V_d = self.vars.SPEED
@@ -101,38 +128,18 @@ class ThreeD_Motion:
         self.Omega0 = [0.0046, 0.0025, 0.0077]
 
     def set_desired_trajectory(self):
-        self.E_i_d = np.array(
-            [
-                math.radians(math.pow(-1, k + 1) * self.glide_angle_deg)
-                for k in range(self.cycles)
-            ]
-        )
+        self.set_glide_angles()
 
-        self.lim1 = math.degrees(
-            math.atan(
-                2
-                * (self.KD / self.KL)
-                * (
-                    self.KL0 / self.KL
-                    + math.sqrt(math.pow(self.KL0 / self.KL, 2) + self.KD0 / self.KD)
-                )
+        if self.live:
+            self.stream = LiveStream(
+                STATE_3D,
+                convert=euler_states if self.attitude == "quaternion" else None,
             )
-        )
-
-        self.lim2 = math.degrees(
-            math.atan(
-                2
-                * (self.KD / self.KL)
-                * (
-                    self.KL0 / self.KL
-                    - math.sqrt(math.pow(self.KL0 / self.KL, 2) + self.KD0 / self.KD)
-                )
-            )
-        )
 
         l = len(self.E_i_d)
         for i in range(l):
-            self.e_i_d = self.E_i_d[i]
+            z = 0.0 if i == 0 else self.solver_array[-1][STATE_3D.index["z"]]
+            self.set_cycle(i, z)
 
             print(
                 "\nIteration {} | Desired glide angle in deg = {}".format(
@@ -140,54 +147,11 @@ class ThreeD_Motion:
                 )
             )
 
-            if (self.e_i_d) > 0:
-                self.glider_direction = "U"
-                self.ballast_rate = -abs(self.ballast_rate)
+            if self.glider_direction == "U":
                 print("Glider moving in upward direction")
-
-            elif (self.e_i_d) < 0:
-                self.glider_direction = "D"
-                self.ballast_rate = abs(self.ballast_rate)
+            else:
                 print("Glider moving in downward direction")
 
-            self.alpha_d = (
-                (1 / 2)
-                * (self.KL / self.KD)
-                * math.tan(self.e_i_d)
-                * (
-                    -1
-                    + math.sqrt(
-                        1
-                        - 4
-                        * (self.KD / math.pow(self.KL, 2))
-                        * (1 / math.tan(self.e_i_d))
-                        * (self.KD0 * (1 / math.tan(self.e_i_d)) + self.KL0)
-                    )
-                )
-            )
-
-            self.beta_d = math.radians(self.vars.BETA)
-
-            self.mb_d = (self.m - self.mh - self.mm) + (1 / self.g) * (
-                -math.sin(self.e_i_d) * (self.KD0 + self.KD * math.pow(self.alpha_d, 2))
-                + math.cos(self.e_i_d) * (self.KL0 + self.KL * self.alpha_d)
-            ) * math.pow(self.V_d, 2)
-
-            self.m0_d = self.mb_d + self.mh + self.mm - self.m
-
-            self.theta_d = self.e_i_d + self.alpha_d
-
-            self.v1_d = self.V_d * math.cos(self.alpha_d) * math.cos(self.beta_d)
-            self.v2_d = self.V_d * math.sin(self.beta_d)
-            self.v3_d = self.V_d * math.sin(self.alpha_d) * math.cos(self.beta_d)
-
-            self.rp1_d = -self.rp3 * math.tan(self.theta_d) + (
-                1 / (self.mm * self.g * math.cos(self.theta_d))
-            ) * (
-                (self.Mf[2, 2] - self.Mf[0, 0]) * self.v1_d * self.v3_d
-                + (self.KM0 + self.KM * self.alpha_d) * math.pow(self.V_d, 2)
-            )
-
             if self.info == True:
                 print(
                     "Desired angle of attack in deg = {}".format(
@@ -201,25 +165,12 @@ class ThreeD_Motion:
                     )
                 )
 
-            self.save_json()
+            self.set_variables()
 
             # Initial conditions for spiral motion
 
             if i == 0:
-                self.z_in = np.concatenate(
-                    [
-                        [0.0, 0.0, 0.0],
-                        [self.Omega0[0], self.Omega0[1], self.Omega0[2]],
-                        [self.v1_d, self.v2_d, self.v3_d],
-                        [0.0, 0.0, self.rp3],
-                        [self.rb1, self.rb2, self.rb3],
-                        [0.0, 0.0, 0.0],
-                        [0.0, 0.0, 0.0],
-                        [self.mb_d, 0, 0],
-                        [self.phi0, self.theta0, self.psi0],
-                    ]
-                ).ravel()
-
+                self.z_in = self.initial_state()
             else:
                 self.z_in = self.solver_array[-1]
 
@@ -237,36 +188,133 @@ class ThreeD_Motion:
                 self.wp = np.concatenate((self.wp, w))
 
             if self.mode == "3D":
-                v = math.sqrt(
-                    math.pow(self.solver_array[-1][6], 2)
-                    + math.pow(self.solver_array[-1][7], 2)
-                    + math.pow(self.solver_array[-1][8], 2)
-                )
-                beta = math.asin(self.solver_array[-1][7] / v)
-                alpha = math.atan(self.solver_array[-1][8] / self.solver_array[-1][6])
-                R = (
-                    v
-                    * math.cos(self.solver_array[-1][-2] - alpha)
-                    / self.solver_array[-1][5]
-                )
+                final = STATE_3D.view(self.solver_array[-1])
+                flight = flight_state(self.solver_array[-1], STATE_3D)
                 print(
                     "\nEquilibrium roll angle of glider: {} deg".format(
-                        math.degrees(self.solver_array[-1][-3])
+                        math.degrees(final["phi"])
                     )
                 )
                 print(
                     "Equilibrium pitch angle of glider: {} deg".format(
-                        math.degrees(self.solver_array[-1][-2])
+                        math.degrees(final["theta"])
                     )
                 )
-                print("Sideslip angle of glider: {} deg".format(math.degrees(beta)))
-                print("Equilibrium glide speed: {} m/s".format(v))
-                print("Radius : {} m".format(R))
+                print(
+                    "Sideslip angle of glider: {} deg".format(
+                        math.degrees(flight["beta"])
+                    )
+                )
+                print("Equilibrium glide speed: {} m/s".format(flight["V"]))
+                print("Radius : {} m".format(flight["turn_radius"]))
+
+        if self.stream is not None:
+            self.stream.close()
+
+        # Selected channels (-rc, -rs) replace the full trajectory file
+        self.record = channel_recorder(self.args, STATE_3D)
+        if self.record is not None:
+            self.record.append(self.total_time, self.solver_array.T)
+            self.record.close(self.trajectory_file)
+        elif self.trajectory_file is not None:
+            save_trajectory(
+                self.trajectory_file, self.total_time, self.solver_array.T, STATE_3D
+            )
+
+        utils.plots(self.total_time, STATE_3D.view(self.solver_array.T), self.plots)
+
+    def set_glide_angles(self):
+        # Desired glide angle of every cycle, dives and climbs in turn
+        self.E_i_d = np.array(
+            [
+                math.radians(math.pow(-1, k + 1) * self.glide_angle_deg)
+                for k in range(self.cycles)
+            ]
+        )
+
+        self.lim1 = self.params.lim1
+        self.lim2 = self.params.lim2
+
+    def set_cycle(self, i, z):
+        # Desired steady spiral of cycle i, with the ballast trimmed for the
+        # water displaced at depth z where the cycle starts
+        self.e_i_d = self.E_i_d[i]
+
+        if (self.e_i_d) > 0:
+            self.glider_direction = "U"
+            self.ballast_rate = -abs(self.ballast_rate)
+
+        elif (self.e_i_d) < 0:
+            self.glider_direction = "D"
+            self.ballast_rate = abs(self.ballast_rate)
+
+        self.alpha_d = (
+            (1 / 2)
+            * (self.KL / self.KD)
+            * math.tan(self.e_i_d)
+            * (
+                -1
+                + math.sqrt(
+                    1
+                    - 4
+                    * (self.KD / math.pow(self.KL, 2))
+                    * (1 / math.tan(self.e_i_d))
+                    * (self.KD0 * (1 / math.tan(self.e_i_d)) + self.KL0)
+                )
+            )
+        )
 
-        utils.plots(self.total_time, self.solver_array.T, self.plots)
+        self.beta_d = math.radians(self.vars.BETA)
 
-    def save_json(self):
-        glide_vars = {
+        self.m_local = displaced_mass(
+            self.m,
+            z,
+            self.density,
+            self.rho_ref,
+            self.hull_compressibility,
+            self.g,
+        )
+
+        self.mb_d = (self.m_local - self.mh - self.mm) + (1 / self.g) * (
+            -math.sin(self.e_i_d) * (self.KD0 + self.KD * math.pow(self.alpha_d, 2))
+            + math.cos(self.e_i_d) * (self.KL0 + self.KL * self.alpha_d)
+        ) * math.pow(self.V_d, 2)
+
+        self.m0_d = self.mb_d + self.mh + self.mm - self.m_local
+
+        self.theta_d = self.e_i_d + self.alpha_d
+
+        self.v1_d = self.V_d * math.cos(self.alpha_d) * math.cos(self.beta_d)
+        self.v2_d = self.V_d * math.sin(self.beta_d)
+        self.v3_d = self.V_d * math.sin(self.alpha_d) * math.cos(self.beta_d)
+
+        self.rp1_d = -self.rp3 * math.tan(self.theta_d) + (
+            1 / (self.mm * self.g * math.cos(self.theta_d))
+        ) * (
+            (self.Mf[2, 2] - self.Mf[0, 0]) * self.v1_d * self.v3_d
+            + (self.KM0 + self.KM * self.alpha_d) * math.pow(self.V_d, 2)
+        )
+
+    def initial_state(self):
+        return STATE_3D.pack(
+            {
+                "n1": [0.0, 0.0, 0.0],
+                "Omega": [self.Omega0[0], self.Omega0[1], self.Omega0[2]],
+                "v": [self.v1_d, self.v2_d, self.v3_d],
+                "rp": [0.0, 0.0, self.rp3],
+                "rp_dot": [0.0, 0.0, 0.0],
+                "mb": self.mb_d,
+                "n2": [self.phi0, self.theta0, self.psi0],
+            }
+        )
+
+    def set_variables(self):
+        # Variables the dynamics of the cycle are built from, held by the
+        # model so that runs in one process do not share them
+        self.var = self.glider_variables()
+
+    def glider_variables(self):
+        return {
             "glide_dir": self.glider_direction,
             "glide_angle_deg": self.glide_angle_deg,
             "lim1": self.lim1,
@@ -285,6 +333,9 @@ class ThreeD_Motion:
             "rb1": self.rb1,
             "rb2": self.rb2,
             "rb3": self.rb3,
+            "rw1": self.rw1,
+            "rw2": self.rw2,
+            "rw3": self.rw3,
             "phi0": self.phi0,
             "theta0": self.theta0,
             "psi0": self.psi0,
@@ -316,37 +367,61 @@ class ThreeD_Motion:
             "m": self.m,
             "m0": self.m0,
             "mt": self.mt,
+            "rho_ref": self.rho_ref,
+            "hull_compressibility": self.hull_compressibility,
+            "glider": self.glider_name,
+            "density_file": self.density_file,
+            "hydro_table_file": self.hydro_table_file,
             "pid_control": self.pid_control,
             "rudder": self.rudder,
             "rudder_angle": self.rudder_angle,
+            "current_file": self.current_file,
+            "attitude": self.attitude,
         }
 
-        utils.save_json(glide_vars, "vars/3d_glider_variables.json")
-
     def solve_ode(self, z0, time):
         def dvdt(t, y):
-            global inner_func
-
-            def inner_func(t, y):
-                eom = Dynamics(y)
-                D = eom.set_eom()
-                return D
-
-            Dr = inner_func(t, y)
-            return Dr[:-3]
+            eom = Dynamics(self.var, y, t, model=self.params)
+            return eom.set_eom()
+
+        def rudder(t, y):
+            eom = Dynamics(self.var, y, t, model=self.params)
+            eom.set_eom()
+            return eom.delta
+
+        fun = dvdt if self.stream is None else self.stream.wrap(dvdt)
+
+        # With -at quaternion the attitude is integrated as a quaternion and
+        # the output converted back to Euler angles
+        quaternion = self.attitude == "quaternion"
+        # The tolerances are scaled to the cycle's desired steady glide
+        psi0 = z0[STATE_3D.index["psi"]]
+        trim = self.initial_state()
+        if quaternion:
+            z0 = quaternion_states(z0)
+            trim = quaternion_states(trim)
+        schema = attitude_schema(self.attitude)
 
         sol = solve_ivp(
-            dvdt,
+            fun,
             t_span=(min(time), max(time)),
             y0=z0,
-            method="RK45",
-            t_eval=time,
-            dense_output=False,
+            method=self.method,
+            t_eval=None if self.output == "adaptive" else time,
+            dense_output=self.output == "adaptive",
+            atol=absolute_tolerances(schema, self.rtol, self.scales, trim),
+            rtol=self.rtol,
         )
 
-        w = np.array([inner_func(time[i], sol.y.T[i, :]) for i in range(len(time))])[
-            :, -2
-        ]
+        if self.output == "adaptive":
+            sol.t, sol.y = adaptive_times(sol)
+            self.dense.append(sol, psi0)
+
+        # Rudder angle at the output times
+        w = np.array([rudder(t, y) for t, y in zip(sol.t, sol.y.T)])
+
+        if quaternion:
+            sol.y = euler_states(sol.y, psi0)
 
         return sol, w
 
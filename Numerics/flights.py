@@ -0,0 +1,106 @@
+import copy
+import time
+
+import numpy as np
+
+from Modeling2d.glider_model_2D import Vertical_Motion, integrate_leg, steady_glide
+from Modeling3d.glider_model_3D import ThreeD_Motion
+from Waypoint.glider_model_waypoint import Waypoint_Following
+from State.attitude import attitude_schema
+from State.state_schema import STATE_2D, STATE_3D
+from State.tolerances import state_scales
+
+# Flights of the tolerances and benchmark modes (s): the first leg of the 2D
+# sawtooth and the first cycle of the 3D spiral and of the waypoint run
+DURATION = {"2D": 400.0, "3D": 2000.0, "waypoint": 1000.0}
+SAMPLES = {"2D": 200, "3D": 1000, "waypoint": 500}
+
+
+class Flight:
+    # One flight of a mode from z0 (in the output layout) with a given
+    # method and tolerances, at the model's own by default. schema is the
+    # integrated layout and `output` the one the solver output is in; they
+    # differ for the quaternion attitude. plane is the section of the
+    # tolerances file the flight reads. Errors are measured in units of the
+    # states' sizes at z0, the flight's steady glide (`unit`).
+    def __init__(self, name, plane, schema, output, z0, model, fly, constants=None):
+        self.name = name
+        self.plane = plane
+        self.schema = schema
+        self.output = output
+        self.constants = constants
+        self.unit = state_scales(output, z0)
+        self.method = model.method
+        self.rtol = model.rtol
+        self.scales = model.scales
+        self.fly = fly
+
+    def __call__(self, rtol=None, scales=None, method=None):
+        # Output states, RHS calls and wall time
+        start = time.perf_counter()
+        y, nfev = self.fly(
+            method or self.method,
+            rtol or self.rtol,
+            self.scales if scales is None else scales,
+        )
+
+        return y, nfev, time.perf_counter() - start
+
+
+def model_args(args, mode):
+    # The models fly without plots, live view or output files
+    args = copy.copy(args)
+    args.mode = mode
+    args.plot = []
+    args.live = False
+    args.output = "fixed"
+    args.trajectory = None
+    args.workers = 0
+
+    return args
+
+
+def flight_2D(args):
+    Z = Vertical_Motion(model_args(args, "2D"))
+    Z.set_glide_angles()
+    Z.set_leg(0, 0.0)
+    var = Z.glider_variables()
+    z0 = Z.initial_state()
+    t = np.linspace(0.0, DURATION["2D"], SAMPLES["2D"])
+    sampled = Z.control == "sampled"
+
+    def fly(method, rtol, scales):
+        sol, w = integrate_leg(var, z0, t, False, sampled, None, rtol, scales, method)
+        return sol.y, sol.nfev
+
+    return Flight(
+        "2D",
+        "2D",
+        STATE_2D,
+        STATE_2D,
+        steady_glide(var, z0, 0.0),
+        Z,
+        fly,
+        {"rp3": Z.rp3},
+    )
+
+
+def flight_3D(args, mode="3D"):
+    # The first cycle of the 3D or waypoint mode; the model sets its
+    # variables, and the waypoint heading PID state, before every flight
+    if mode == "3D":
+        Z = ThreeD_Motion(model_args(args, mode))
+    else:
+        Z = Waypoint_Following(model_args(args, mode))
+    Z.set_glide_angles()
+    Z.set_cycle(0, 0.0)
+    z0 = Z.initial_state()
+    t = np.linspace(0.0, DURATION[mode], SAMPLES[mode])
+
+    def fly(method, rtol, scales):
+        Z.method, Z.rtol, Z.scales = method, rtol, scales
+        Z.set_variables()
+        sol, w = Z.solve_ode(z0, t)
+        return sol.y, sol.nfev
+
+    return Flight(mode, "3D", attitude_schema(Z.attitude), STATE_3D, z0, Z, fly)
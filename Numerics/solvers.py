@@ -0,0 +1,89 @@
+import numpy as np
+from scipy.integrate import DenseOutput, OdeSolver
+
+# Adaptive methods of solve_ivp; RK4 steps at a fixed step instead of a
+# tolerance
+ADAPTIVE = ("RK45", "RK23", "DOP853", "Radau", "BDF", "LSODA")
+
+
+class HermiteDenseOutput(DenseOutput):
+    # Cubic Hermite interpolant of a step from the states and derivatives at
+    # its ends, third order like the continuous extension of RK4
+    def __init__(self, t_old, t, y_old, y, f_old, f):
+        super().__init__(t_old, t)
+        self.h = t - t_old
+        self.y_old = y_old
+        self.dy = y - y_old
+        self.f_old = f_old
+        self.f = f
+
+    def _call_impl(self, t):
+        s = (np.asarray(t) - self.t_old) / self.h
+        if s.ndim == 1:
+            s = s[None, :]
+            y_old, dy = self.y_old[:, None], self.dy[:, None]
+            f_old, f = self.f_old[:, None], self.f[:, None]
+        else:
+            y_old, dy, f_old, f = self.y_old, self.dy, self.f_old, self.f
+
+        return (
+            y_old
+            + s**2 * (3 - 2 * s) * dy
+            + self.h * s * (s - 1) * ((s - 1) * f_old + s * f)
+        )
+
+
+class RK4(OdeSolver):
+    # Classical fourth-order Runge-Kutta at a fixed step (s) for solve_ivp and
+    # Scheduler.solve, method=rk4(step). The last step is cut short to end on
+    # t_bound. Tolerances are accepted and ignored. The derivative at the end
+    # of a step is the first stage of the next, so a step costs four RHS
+    # calls.
+    fixed_step = 1.0
+
+    def __init__(
+        self, fun, t0, y0, t_bound, vectorized=False, rtol=None, atol=None, **options
+    ):
+        super().__init__(fun, t0, y0, t_bound, vectorized)
+        self.f = self.fun(self.t, self.y)
+        self.y_old = None
+        self.f_old = None
+
+    def _step_impl(self):
+        t, y, k1 = self.t, self.y, self.f
+        h = min(self.fixed_step, abs(self.t_bound - t)) * self.direction
+
+        k2 = self.fun(t + h / 2, y + h / 2 * k1)
+        k3 = self.fun(t + h / 2, y + h / 2 * k2)
+        k4 = self.fun(t + h, y + h * k3)
+
+        self.y_old, self.f_old = y, k1
+        self.t = self.t_bound if h == self.t_bound - t else t + h
+        self.y = y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        self.f = self.fun(self.t, self.y)
+
+        return True, None
+
+    def _dense_output_impl(self):
+        return HermiteDenseOutput(
+            self.t_old, self.t, self.y_old, self.y, self.f_old, self.f
+        )
+
+
+def rk4(step):
+    # RK4 at the given step, as a solve_ivp method
+    return type("RK4", (RK4,), {"fixed_step": float(step)})
+
+
+def solver_setting(spec, rtol):
+    # (method, rtol) of a -sm setting: a solve_ivp method, optionally with its
+    # relative tolerance ("DOP853:1e-6"), or RK4 with its step in seconds
+    # ("RK4:0.5"). Without a setting, RK45 at the mode's rtol.
+    if spec is None:
+        return "RK45", rtol
+
+    name, _, value = spec.partition(":")
+    if name == "RK4":
+        return rk4(value or RK4.fixed_step), rtol
+
+    return name, float(value) if value else rtol
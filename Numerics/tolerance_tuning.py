@@ -0,0 +1,102 @@
+import copy
+
+import numpy as np
+
+from Numerics.flights import DURATION, flight_2D, flight_3D
+from State.tolerances import state_scales, save_tolerances
+
+# The reference solution is integrated at REFERENCE_FACTOR times the
+# tolerances being tuned
+REFERENCE_FACTOR = 1e-3
+
+# A scale is loosened STEP times at a time while that saves right-hand side
+# calls, by at most MAX_LOOSENING
+STEP = 10.0
+MAX_LOOSENING = 1e4
+
+
+class Tolerance_Tuning:
+    # Tunes the per-state tolerance scales of the 2D and 3D modes against a
+    # reference solution and writes them for -tl. Every scale starts at its
+    # default (SCALES in State/tolerances.py) and is loosened while the
+    # largest error of any state, relative to its size in the steady glide,
+    # stays within that of the default tolerances and the flight takes fewer
+    # RHS calls.
+    def __init__(self, args):
+        self.args = args
+        self.mode = self.args.mode
+        self.info = self.args.info
+        self.path = self.args.tolerances or "vars/tolerances.json"
+
+        self.initialization()
+
+    def initialization(self):
+        # The flights start from the default scales, not from -tl
+        args = copy.copy(self.args)
+        args.tolerances = None
+        self.flights = [flight_2D(args), flight_3D(args)]
+
+    def set_desired_trajectory(self):
+        for flight in self.flights:
+            self.tune(flight)
+
+        print("\nTolerance scales written to {}".format(self.path))
+
+    def tune(self, flight):
+        S = flight.schema
+        scales = dict(zip(S.names, state_scales(S)))
+
+        print(
+            "\n{} flight of {:.0f} s at rtol {:g}".format(
+                flight.name, DURATION[flight.name], flight.rtol
+            )
+        )
+        factor = REFERENCE_FACTOR
+        reference, nfev, elapsed = flight(
+            flight.rtol * factor,
+            {name: value * factor for name, value in scales.items()},
+        )
+        print("Reference: {} RHS calls in {:.1f} s".format(nfev, elapsed))
+
+        # Errors are measured in units of the states' sizes (Flight.unit)
+        def errors(y):
+            return np.max(np.abs(y - reference), axis=1) / flight.unit
+
+        y, nfev, elapsed = flight(flight.rtol, scales)
+        default = (errors(y), nfev, elapsed)
+        target = default[0].max()
+        best = default
+
+        for name in S.names:
+            start = scales[name]
+            while scales[name] * STEP <= start * MAX_LOOSENING:
+                trial = dict(scales, **{name: scales[name] * STEP})
+                y, nfev, elapsed = flight(flight.rtol, trial)
+                error = errors(y)
+                if error.max() > target or nfev >= best[1]:
+                    break
+                scales = trial
+                best = (error, nfev, elapsed)
+
+            if self.info:
+                print(
+                    "{:>8}: scale {:9.3g} -> {:9.3g}, {} RHS calls".format(
+                        name, start, scales[name], best[1]
+                    )
+                )
+
+        self.print_summary(flight, default, best)
+        save_tolerances(self.path, flight.plane, flight.rtol, scales)
+
+    def print_summary(self, flight, default, tuned):
+        print(
+            "\n{:>10} {:>12} {:>12}".format("state", "default", "tuned")
+            + "\n{:>10} {:>12} {:>12}".format("", "error", "error")
+        )
+        for k, name in enumerate(flight.output.names):
+            print("{:>10} {:12.3g} {:12.3g}".format(name, default[0][k], tuned[0][k]))
+        print(
+            "RHS calls {} -> {}, {:.2f} s -> {:.2f} s".format(
+                default[1], tuned[1], default[2], tuned[2]
+            )
+        )
@@ -0,0 +1,252 @@
+import copy
+import json
+import math
+import os
+
+import numpy as np
+
+from Analysis.trajectory_analysis import flight_state
+from Numerics.flights import DURATION, SAMPLES, flight_2D, flight_3D
+from Numerics.solvers import ADAPTIVE, rk4
+
+# Each flight is checked against two references at REFERENCE_RTOL, one
+# explicit and one implicit. Their difference is the smallest error the
+# benchmark resolves.
+REFERENCES = ("DOP853", "Radau")
+REFERENCE_RTOL = 1e-10
+
+# Settings swept per flight: relative tolerances of the adaptive methods and
+# fixed steps (s) of RK4
+RTOLS = {
+    "2D": (1e-4, 1e-5, 1e-6, 1e-7, 1e-8, 1e-9),
+    "3D": (1e-2, 1e-3, 1e-4, 1e-5, 1e-6),
+    "waypoint": (1e-2, 1e-3, 1e-4, 1e-5, 1e-6),
+}
+STEPS = {
+    "2D": (2.0, 1.0, 0.5, 0.25),
+    "3D": (4.0, 2.0, 1.0, 0.5),
+    "waypoint": (4.0, 2.0, 1.0, 0.5),
+}
+
+# Errors at the end of a flight: position (m), heading (deg) and turn radius,
+# as the curvature 1/R (1/m), which unlike the radius stays finite in the
+# nearly straight glide the waypoint leg ends in. 1e-3 1/m is 0.1 m of the
+# 3D spiral's radius. A setting meets the budget when every error the flight
+# has does.
+ERRORS = ("position", "heading", "curvature")
+BUDGET = {"position": 1.0, "heading": 1.0, "curvature": 1e-3}
+UNITS = {"position": "m", "heading": "deg", "curvature": "1/m"}
+
+RESULTS_FILE = "vars/work_precision.json"
+
+
+class Work_Precision:
+    # Work-precision benchmark of the 2D leg, the 3D cycle and the waypoint
+    # leg (see Numerics/flights.py): every solve_ivp method over a range of
+    # relative tolerances, and RK4 over a range of steps. Each run is
+    # timed, its RHS calls counted and its final position, heading and turn
+    # radius compared with the reference. Writes the runs to RESULTS_FILE and
+    # one work-precision figure per flight next to it, and prints the
+    # cheapest setting within BUDGET as a -sm value.
+    def __init__(self, args):
+        self.args = args
+        self.mode = self.args.mode
+        self.info = self.args.info
+        self.path = RESULTS_FILE
+
+        self.initialization()
+
+    def initialization(self):
+        # The continuous waypoint heading PID updates its state on every RHS
+        # call, trial points included, so its result depends on the order of
+        # the calls; the waypoint leg is flown with the sampled controllers
+        waypoint = copy.copy(self.args)
+        waypoint.control = "sampled"
+
+        self.flights = [
+            flight_2D(self.args),
+            flight_3D(self.args),
+            flight_3D(waypoint, "waypoint"),
+        ]
+        self.runs = []
+
+    def settings(self, flight):
+        # (label, -sm value, method, rtol) of every run
+        for method in ADAPTIVE:
+            for rtol in RTOLS[flight.name]:
+                spec = "{}:{:g}".format(method, rtol)
+                yield method, spec, method, rtol
+        for step in STEPS[flight.name]:
+            spec = "RK4:{:g}".format(step)
+            yield "RK4", spec, rk4(step), None
+
+    def final(self, flight, y):
+        # Position, heading and turn curvature at the end of a flight, NaN for
+        # those the flight does not have (heading and curvature in 2D)
+        x = flight.output.view(y[:, -1], flight.constants)
+        turning = "psi" in flight.output
+
+        return {
+            "position": np.array(x["n1"], dtype=float),
+            "heading": math.degrees(x["psi"]) if turning else math.nan,
+            "curvature": (
+                1.0
+                / flight_state(y[:, -1], flight.output, flight.constants)["turn_radius"]
+                if turning
+                else math.nan
+            ),
+        }
+
+    def errors(self, a, b):
+        return {
+            "position": float(np.linalg.norm(a["position"] - b["position"])),
+            "heading": abs(a["heading"] - b["heading"]),
+            "curvature": abs(a["curvature"] - b["curvature"]),
+        }
+
+    def fly(self, flight, method, rtol):
+        # Final values, RHS calls and wall time; None for a run that failed
+        # or did not reach the end of the flight
+        try:
+            with np.errstate(all="ignore"):
+                y, nfev, elapsed = flight(rtol, None, method)
+        except (ArithmeticError, ValueError, np.linalg.LinAlgError):
+            return None
+        if y.shape[1] < SAMPLES[flight.name] or not np.all(np.isfinite(y[:, -1])):
+            return None
+
+        return self.final(flight, y), nfev, elapsed
+
+    def set_desired_trajectory(self):
+        for flight in self.flights:
+            self.benchmark(flight)
+
+        with open(self.path, "w", encoding="utf-8") as file:
+            json.dump(self.runs, file, indent=4)
+        print("\nRuns written to {}".format(self.path))
+
+    def benchmark(self, flight):
+        print(
+            "\n{} flight of {:.0f} s, references {} at rtol {:g}".format(
+                flight.name,
+                DURATION[flight.name],
+                " and ".join(REFERENCES),
+                REFERENCE_RTOL,
+            )
+        )
+        references = [self.fly(flight, method, REFERENCE_RTOL) for method in REFERENCES]
+        reference = references[0][0]
+        floor = self.errors(references[0][0], references[1][0])
+        print("References differ by {}".format(", ".join(self.format_errors(floor))))
+
+        print(
+            "\n{:>8} {:>10} {:>9} {:>8} {:>12} {:>12} {:>12}".format(
+                "method",
+                "setting",
+                "RHS",
+                "time s",
+                "position m",
+                "heading deg",
+                "curvature",
+            )
+        )
+        runs = []
+        for label, spec, method, rtol in self.settings(flight):
+            result = self.fly(flight, method, rtol)
+            run = {"flight": flight.name, "method": label, "setting": spec}
+            if result is None:
+                run.update(failed=True)
+                print("{:>8} {:>10} failed".format(label, spec.partition(":")[2]))
+            else:
+                final, nfev, elapsed = result
+                run.update(
+                    failed=False,
+                    nfev=nfev,
+                    time=elapsed,
+                    **self.errors(final, reference),
+                )
+                print(
+                    "{:>8} {:>10} {:>9} {:8.2f} {:>12} {:>12} {:>12}".format(
+                        label,
+                        spec.partition(":")[2],
+                        nfev,
+                        elapsed,
+                        *["{:.3g}".format(run[name]) for name in ERRORS],
+                    )
+                )
+            runs.append(run)
+
+        self.runs += runs
+        self.recommend(flight, runs)
+        self.plot(flight, runs)
+
+    def format_errors(self, errors):
+        return [
+            "{} {:.3g} {}".format(name, errors[name], UNITS[name])
+            for name in ERRORS
+            if not math.isnan(errors[name])
+        ]
+
+    def recommend(self, flight, runs):
+        # The cheapest run, by wall time, whose errors are within BUDGET
+        within = [
+            run
+            for run in runs
+            if not run["failed"]
+            and all(
+                math.isnan(run[name]) or run[name] <= BUDGET[name] for name in ERRORS
+            )
+        ]
+        if not within:
+            print("No setting is within the budget")
+            return
+
+        best = min(within, key=lambda run: run["time"])
+        print(
+            "Cheapest within the budget: -sm {} ({} RHS calls, {:.2f} s)".format(
+                best["setting"], best["nfev"], best["time"]
+            )
+        )
+
+    def plot(self, flight, runs):
+        # Wall time against each error, one line per method
+        import matplotlib
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
+        # An error a flight does not measure (the heading of a 2D leg) is NaN
+        # in all its runs; a failed run has none
+        names = [
+            name
+            for name in ERRORS
+            if any(not math.isnan(run.get(name, math.nan)) for run in runs)
+        ]
+        figure, axes = plt.subplots(1, len(names), figsize=(5 * len(names), 4))
+        axes = np.atleast_1d(axes)
+        for ax, name in zip(axes, names):
+            for method in dict.fromkeys(run["method"] for run in runs):
+                done = [
+                    run
+                    for run in runs
+                    if run["method"] == method
+                    and not run["failed"]
+                    and not math.isnan(run.get(name, math.nan))
+                ]
+                ax.loglog(
+                    [max(run[name], 1e-16) for run in done],
+                    [run["time"] for run in done],
+                    "o-",
+                    label=method,
+                )
+            ax.axvline(BUDGET[name], color="grey", linestyle="--")
+            ax.set_xlabel("{} error ({})".format(name, UNITS[name]))
+            ax.set_ylabel("wall time (s)")
+        axes[0].legend()
+        figure.suptitle("{} flight".format(flight.name))
+        figure.tight_layout()
+
+        path = "{}_{}.png".format(os.path.splitext(self.path)[0], flight.name)
+        figure.savefig(path)
+        plt.close(figure)
+        print("Work-precision curves written to {}".format(path))
@@ -0,0 +1,51 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def parareal(fine, coarse, job, y0, slices, workers, rtol=1e-4, atol=1e-6, info=False):
+    # Parallel-in-time integration over `slices` consecutive time slices:
+    #   coarse(k, y) -> cheap prediction of the state at the end of slice k
+    #                   started from y, evaluated in this process
+    #   job(k, y)    -> picklable argument of `fine` for slice k started from y
+    #   fine(job)    -> (state at the end of the slice, result), evaluated in a
+    #                   pool of `workers` processes
+    # The slice start states U are corrected with
+    #   U[k+1] = coarse(k, U_new[k]) + fine(U_old[k]) - coarse(k, U_old[k])
+    # until they stop moving. After iteration i the first i + 1 slices are
+    # exact, so at most `slices` iterations are needed and only the remaining
+    # slices are recomputed. Returns the fine result of every slice and U.
+    U = [np.asarray(y0, dtype=float)]
+    G = []
+    for k in range(slices):
+        G.append(np.asarray(coarse(k, U[k]), dtype=float))
+        U.append(G[k])
+
+    results = [None] * slices
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for start in range(slices):
+            F = pool.map(fine, [job(k, U[k]) for k in range(start, slices)])
+
+            change = 0.0
+            for k, (end, result) in zip(range(start, slices), F):
+                results[k] = result
+                g = np.asarray(coarse(k, U[k]), dtype=float)
+                new = g + end - G[k]
+                G[k] = g
+
+                error = np.abs(new - U[k + 1]) / (atol + rtol * np.abs(new))
+                change = max(change, np.max(error))
+                U[k + 1] = new
+
+            if info == True:
+                print(
+                    "Parareal iteration {} | slices computed: {} | largest change: {:.3g}".format(
+                        start, slices - start, change
+                    )
+                )
+
+            if change <= 1.0:
+                break
+
+    return results, U
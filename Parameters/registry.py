@@ -0,0 +1,250 @@
+import importlib.util
+import math
+import os
+from functools import lru_cache
+
+import numpy as np
+
+# Registered glider definitions: name -> definition file in this directory
+# for the vertical plane ("2D") and for 3D motion ("3D"). A definition is a
+# Python module with a parameter class laid out like Parameters/slocum.py, or
+# a TOML or YAML file with one table per group. -g also takes the path of a
+# definition file.
+GLIDERS = {
+    "slocum": {"2D": "slocum.py", "3D": "slocum3D.py"},
+    "seaglider": {"2D": "seaglider.toml", "3D": "seaglider.toml"},
+}
+
+GLIDER_CONFIG = (
+    "HULL_MASS",
+    "FIXED_POINT_MASS",
+    "BALLAST_MASS",
+    "INT_MOVABLE_MASS",
+    "FLUID_DISP_MASS",
+    "REF_DENSITY",
+    "HULL_COMPRESSIBILITY",
+    "MF1",
+    "MF2",
+    "MF3",
+    "J1",
+    "J2",
+    "J3",
+)
+
+HYDRODYNAMICS = ("KL", "KL0", "KD", "KD0", "KM", "KM0")
+
+VARIABLES = (
+    "GLIDE_ANGLE",
+    "SPEED",
+    "BALLAST_RATE",
+    "rp3",
+    "rb1",
+    "rb3",
+    "rw1",
+    "rw3",
+    "PHI",
+    "THETA",
+    "PSI",
+)
+
+CONTROLS = ("wp1", "wp2", "wp3")
+
+# Entries each plane needs on top of the shared ones
+REQUIRED = {
+    "2D": {
+        "GLIDER_CONFIG": GLIDER_CONFIG,
+        "HYDRODYNAMICS": HYDRODYNAMICS + ("KOmega1", "KOmega2"),
+        "VARIABLES": VARIABLES,
+        "CONTROLS": CONTROLS,
+        "CONTROL_PERIODS": ("PITCH", "BALLAST"),
+        "ENERGY": (
+            "HOTEL_LOAD",
+            "PUMP_EFFICIENCY",
+            "MOVING_MASS_EFFICIENCY",
+            "BATTERY_CAPACITY",
+        ),
+    },
+    "3D": {
+        "GLIDER_CONFIG": GLIDER_CONFIG,
+        "HYDRODYNAMICS": HYDRODYNAMICS
+        + ("K_beta", "K_MY", "K_MR")
+        + ("KOmega11", "KOmega12", "KOmega13", "KOmega21", "KOmega22", "KOmega23"),
+        "VARIABLES": VARIABLES + ("rp2", "rb2", "rw2", "BETA", "RUDDER"),
+        "CONTROLS": CONTROLS,
+        "CONTROL_PERIODS": ("HEADING", "BALLAST"),
+    },
+}
+
+POSITIVE = (
+    "HULL_MASS",
+    "INT_MOVABLE_MASS",
+    "FLUID_DISP_MASS",
+    "REF_DENSITY",
+    "MF1",
+    "MF2",
+    "MF3",
+    "J1",
+    "J2",
+    "J3",
+    "KL",
+    "KD",
+    "SPEED",
+)
+
+
+class ParameterGroup:
+    # Read-only group of parameters, e.g. P.GLIDER_CONFIG.HULL_MASS
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("glider parameters are read-only")
+
+
+class GliderModel:
+    # A glider definition, validated and compiled once per process (see
+    # load_glider). The groups of the definition are attributes, as on the
+    # parameter classes, next to the derived quantities:
+    #   Mf, Jf, M, J, M_inv, J_inv   3x3 added mass, inertia and their inverses
+    #   lim1, lim2                   glide angle limits (deg): steady glides
+    #                                climb steeper than lim1 or dive steeper
+    #                                than lim2
+    #   hydrodynamics                coefficient array in the order of
+    #                                `coefficients`
+    # Arrays are read-only. A model pickles as its name, so worker processes
+    # get it from their own cache (or, forked, from the parent's).
+    def __init__(self, name, plane, groups):
+        for group, values in groups.items():
+            object.__setattr__(self, group, ParameterGroup(values))
+
+        c = groups["GLIDER_CONFIG"]
+        h = groups["HYDRODYNAMICS"]
+        Mf = np.diag([c["MF1"], c["MF2"], c["MF3"]]).astype(float)
+        Jf = np.diag([c["J1"], c["J2"], c["J3"]]).astype(float)
+        M = c["HULL_MASS"] * np.eye(3) + Mf
+        J = Jf  # J = Jf + Jh
+
+        root = math.sqrt((h["KL0"] / h["KL"]) ** 2 + h["KD0"] / h["KD"])
+        limits = [
+            math.degrees(math.atan(2 * (h["KD"] / h["KL"]) * (h["KL0"] / h["KL"] + s)))
+            for s in (root, -root)
+        ]
+
+        derived = {
+            "name": name,
+            "plane": plane,
+            "groups": tuple(groups),
+            "Mf": Mf,
+            "Jf": Jf,
+            "M": M,
+            "J": J,
+            "M_inv": np.linalg.inv(M),
+            "J_inv": np.linalg.inv(J),
+            "lim1": limits[0],
+            "lim2": limits[1],
+            "coefficients": tuple(h),
+            "hydrodynamics": np.array(list(h.values()), dtype=float),
+        }
+        for key, value in derived.items():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("glider models are read-only")
+
+    def __reduce__(self):
+        return load_glider, (self.name, self.plane)
+
+    def definition(self):
+        # The groups as plain dicts, {group: {name: value}}
+        return {group: dict(vars(getattr(self, group))) for group in self.groups}
+
+
+def read_definition(path):
+    # Parameter groups {group: {name: value}} of a definition file
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == ".py":
+        spec = importlib.util.spec_from_file_location(
+            os.path.splitext(os.path.basename(path))[0], path
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # The parameter class is the one with a GLIDER_CONFIG group
+        classes = [
+            value
+            for value in vars(module).values()
+            if isinstance(value, type) and hasattr(value, "GLIDER_CONFIG")
+        ]
+        if len(classes) != 1:
+            raise ValueError("{} must define exactly one parameter class".format(path))
+        return {
+            group: {
+                name: value
+                for name, value in vars(cls).items()
+                if not name.startswith("__")
+            }
+            for group, cls in vars(classes[0]).items()
+            if isinstance(cls, type)
+        }
+
+    if extension == ".toml":
+        import tomllib
+
+        with open(path, "rb") as file:
+            return tomllib.load(file)
+
+    if extension in (".yaml", ".yml"):
+        import yaml
+
+        with open(path, encoding="utf-8") as file:
+            return yaml.safe_load(file)
+
+    raise ValueError(
+        "{}: glider definitions are Python, TOML or YAML files".format(path)
+    )
+
+
+def validate(path, plane, groups):
+    for group, names in REQUIRED[plane].items():
+        values = groups.get(group)
+        if not isinstance(values, dict):
+            raise ValueError("{} has no {} group".format(path, group))
+
+        missing = [name for name in names if name not in values]
+        if missing:
+            raise ValueError(
+                "{}: {} is missing {}".format(path, group, ", ".join(missing))
+            )
+
+        for name in names:
+            value = values[name]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(
+                    "{}: {}.{} = {!r} is not a number".format(path, group, name, value)
+                )
+            if not math.isfinite(value):
+                raise ValueError("{}: {}.{} is not finite".format(path, group, name))
+            if name in POSITIVE and value <= 0:
+                raise ValueError("{}: {}.{} must be positive".format(path, group, name))
+
+
+@lru_cache(maxsize=None)
+def load_glider(name, plane="3D"):
+    # name is a key of GLIDERS or the path of a definition file
+    if name in GLIDERS:
+        path = os.path.join(os.path.dirname(__file__), GLIDERS[name][plane])
+    elif os.path.isfile(name):
+        path = name
+    else:
+        raise ValueError(
+            "Invalid glider model {!r}: use one of {} or a definition file".format(
+                name, ", ".join(GLIDERS)
+            )
+        )
+
+    groups = read_definition(path)
+    validate(path, plane, groups)
+
+    return GliderModel(name, plane, groups)
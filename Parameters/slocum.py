@@ -6,6 +6,8 @@ class SLOCUM_PARAMS:
         INT_MOVABLE_MASS = 9.0
 
         FLUID_DISP_MASS = 50.0
+        REF_DENSITY = 1025.0  # kg/m3, water density in which FLUID_DISP_MASS is displaced
+        HULL_COMPRESSIBILITY = 0.0  # 1/Pa, relative hull volume change per unit pressure
 
         VEH_DENSITY = 0.0  # change
 
@@ -32,8 +34,9 @@ class SLOCUM_PARAMS:
         KM = -100
         KM0 = 0.0
 
-        KOmega1 = 50
-        KOmega2 = 50
+        # Pitch moment KOmega1 * q + KOmega2 * q^2, damping with KOmega1 < 0
+        KOmega1 = -50  # Kq1
+        KOmega2 = 50  # Kq2
 
     class VARIABLES:
         GLIDE_ANGLE = 25  # degrees
@@ -72,3 +75,14 @@ class SLOCUM_PARAMS:
         ww1 = 0.0
         ww2 = 0.0
         ww3 = 0.0
+
+    class CONTROL_PERIODS:
+        # Sampled-data controllers (-ct sampled), seconds between ticks
+        PITCH = 1.0
+        BALLAST = 4.0
+
+    class ENERGY:
+        HOTEL_LOAD = 0.3  # W, computer, sensors and communications
+        PUMP_EFFICIENCY = 0.5  # hydraulic work out / electrical energy in
+        MOVING_MASS_EFFICIENCY = 0.5  # mechanical work out / electrical energy in
+        BATTERY_CAPACITY = 8.0e6  # J
@@ -6,6 +6,8 @@ class SLOCUM_PARAMS:
         INT_MOVABLE_MASS = 9.0
 
         FLUID_DISP_MASS = 50.0
+        REF_DENSITY = 1025.0  # kg/m3, water density in which FLUID_DISP_MASS is displaced
+        HULL_COMPRESSIBILITY = 0.0  # 1/Pa, relative hull volume change per unit pressure
 
         VEH_DENSITY = 0.0  # change
 
@@ -85,3 +87,8 @@ class SLOCUM_PARAMS:
         ww1 = 0.0
         ww2 = 0.0
         ww3 = 0.0
+
+    class CONTROL_PERIODS:
+        # Sampled-data controllers (-ct sampled), seconds between ticks
+        HEADING = 1.0
+        BALLAST = 4.0
@@ -0,0 +1,257 @@
+import numpy as np
+import math
+from scipy.integrate import solve_ivp
+import utils
+from Environment.density import load_density_profile, displaced_mass_batch
+from Modeling3d.batch_dynamics import BatchDynamics
+from State.state_schema import STATE_3D
+from Parameters.registry import load_glider
+
+# Design parameters the trajectory is differentiated with respect to
+PARAMETERS = ("KL", "KD", "KM", "K_beta", "K_MY", "mm", "rp3")
+
+# Central difference step, relative to the parameter value
+RELATIVE_STEP = 1e-3
+
+# Waypoint of the arrival run (fleet mode default) and its heading PD
+TARGET = (200.0, 70.0)
+KP = 3.5
+KD = 0.5
+RUDDER_LIMIT = math.radians(30.0)
+
+
+class Sensitivity_Analysis:
+    # Forward sensitivities of the 3D spiral (glide speed, turning radius) and
+    # of a run to a waypoint (arrival error) with respect to PARAMETERS. The
+    # nominal glider and a +h and -h copy per parameter are flown as one
+    # BatchDynamics fleet, so every copy takes the same steps and the central
+    # differences are not polluted by differing step sequences.
+    def __init__(self, args):
+        self.args = args
+        self.mode = self.args.mode
+        self.glider_name = self.args.glider
+        self.info = self.args.info
+        self.plots = self.args.plot
+        self.rudder = self.args.rudder
+        self.rudder_angle = math.radians(self.args.setrudder)
+        self.current_file = self.args.current
+        self.density_file = self.args.density
+        self.hydro_table_file = self.args.hydrotable
+
+        self.initialization()
+
+        self.total_time = np.array([])
+        self.trajectory = np.array([])
+        self.sensitivity = np.array([])
+        self.gradients = {}
+
+    def initialization(self):
+        self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
+
+        P = load_glider(self.glider_name, "3D")
+        self.params = P
+
+        self.mass_params = P.GLIDER_CONFIG
+        self.hydro_params = P.HYDRODYNAMICS
+        self.vars = P.VARIABLES
+
+        self.mh = self.mass_params.HULL_MASS
+        self.mw = self.mass_params.FIXED_POINT_MASS
+        self.mm = self.mass_params.INT_MOVABLE_MASS
+        self.m = self.mass_params.FLUID_DISP_MASS
+
+        self.Mf = P.Mf
+        self.Jf = P.Jf
+
+        self.M = P.M
+        self.J = P.J  # J = Jf + Jh
+
+        self.density = load_density_profile(self.density_file)
+
+        self.var = {
+            "Mf": self.Mf,
+            "M": self.M,
+            "J": self.J,
+            "KL": self.hydro_params.KL,
+            "KL0": self.hydro_params.KL0,
+            "KD": self.hydro_params.KD,
+            "KD0": self.hydro_params.KD0,
+            "K_beta": self.hydro_params.K_beta,
+            "KM": self.hydro_params.KM,
+            "KM0": self.hydro_params.KM0,
+            "K_MY": self.hydro_params.K_MY,
+            "K_MR": self.hydro_params.K_MR,
+            "KOmega11": self.hydro_params.KOmega11,
+            "KOmega12": self.hydro_params.KOmega12,
+            "KOmega13": self.hydro_params.KOmega13,
+            "mh": self.mh,
+            "mw": self.mw,
+            "mm": self.mm,
+            "m": self.m,
+            "rp2": self.vars.rp2,
+            "rp3": self.vars.rp3,
+            "rb1": self.vars.rb1,
+            "rb2": self.vars.rb2,
+            "rb3": self.vars.rb3,
+            "rw1": self.vars.rw1,
+            "rw2": self.vars.rw2,
+            "rw3": self.vars.rw3,
+            "rho_ref": self.mass_params.REF_DENSITY,
+            "hull_compressibility": self.mass_params.HULL_COMPRESSIBILITY,
+            "ballast_rate": self.vars.BALLAST_RATE,
+            "current_file": self.current_file,
+            "glider": self.glider_name,
+            "density_file": self.density_file,
+            "hydro_table_file": self.hydro_table_file,
+        }
+
+        self.glide_angle = math.radians(self.vars.GLIDE_ANGLE)
+        self.V_d = self.vars.SPEED
+        self.beta_d = math.radians(self.vars.BETA)
+        self.phi0 = math.radians(self.vars.PHI)
+        self.theta0 = -math.radians(self.vars.THETA)
+        self.psi0 = math.radians(self.vars.PSI)
+        self.Omega0 = [0.0046, 0.0025, 0.0077]
+
+        # Copy 0 is the nominal glider, copies 2j + 1 and 2j + 2 fly with
+        # PARAMETERS[j] moved by +h_j and -h_j
+        self.n = 1 + 2 * len(PARAMETERS)
+        self.steps = np.array(
+            [RELATIVE_STEP * abs(self.var[name]) for name in PARAMETERS]
+        )
+        for j, name in enumerate(PARAMETERS):
+            values = np.full(self.n, float(self.var[name]))
+            values[2 * j + 1] += self.steps[j]
+            values[2 * j + 2] -= self.steps[j]
+            self.var[name] = values
+
+    def fly(self, duration, samples, steering):
+        batch = BatchDynamics(self.var, self.n, model=self.params)
+        c = batch.controls
+
+        m_local = displaced_mass_batch(
+            self.m,
+            np.zeros(self.n),
+            self.density,
+            self.var["rho_ref"],
+            self.var["hull_compressibility"],
+            self.g,
+        )
+        eq = utils.glide_equilibrium(
+            -self.glide_angle, self.V_d, self.var, m=m_local, beta_d=self.beta_d
+        )
+        c.mb_d[:] = eq["mb_d"]
+        c.rp1_d[:] = eq["rp1_d"]
+
+        S = STATE_3D
+        Z = np.zeros((self.n, S.size))
+        Z[:, S.index["v1"]] = eq["v1_d"]
+        Z[:, S.index["v2"]] = eq["v2_d"]
+        Z[:, S.index["v3"]] = eq["v3_d"]
+        Z[:, S.index["rp3"]] = self.var["rp3"]
+        Z[:, S.index["mb"]] = eq["mb_d"]
+        Z[:, S.index["phi"]] = self.phi0
+        Z[:, S.index["theta"]] = self.theta0
+        Z[:, S.index["psi"]] = self.psi0
+
+        if steering:
+            c.rudder[:] = True
+            c.heading_control[:] = True
+            c.kp[:], c.kd[:], c.rudder_limit[:] = KP, KD, RUDDER_LIMIT
+            c.target[:] = TARGET
+            c.rp2_d[:] = 0.0
+        else:
+            # The spiral of 3D mode
+            Z[:, S.slice("Omega")] = self.Omega0
+            c.rudder[:] = self.rudder == "enable"
+            c.rudder_angle[:] = self.rudder_angle
+            c.rp2_d[:] = 0.0 if self.rudder == "enable" else self.var["rp2"]
+
+        # The moving mass stops at rp1_d (which mm and rp3 shift) inside a
+        # step; at looser tolerances the error made there is of the size of the
+        # differences between the copies
+        t = np.linspace(0.0, duration, samples)
+        sol = solve_ivp(
+            batch.derivatives,
+            t_span=(t[0], t[-1]),
+            y0=Z.ravel(),
+            method="RK45",
+            t_eval=t,
+            rtol=1e-10,
+            atol=1e-12,
+        )
+
+        return sol.t, sol.y.reshape(self.n, S.size, -1)
+
+    def central_difference(self, values):
+        # values[k] of copy k -> d(value)/d(PARAMETERS[j]) for every j
+        values = np.asarray(values)
+        return (values[1::2] - values[2::2]) / (
+            2 * self.steps.reshape((-1,) + (1,) * (values.ndim - 1))
+        )
+
+    def set_desired_trajectory(self):
+        self.total_time, self.trajectory = self.fly(2000.0, 1000, steering=False)
+
+        # (len(PARAMETERS), STATE_3D.size, T)
+        self.sensitivity = self.central_difference(self.trajectory)
+
+        final = STATE_3D.view(self.trajectory[:, :, -1].T)
+        speed = np.sqrt(final["v1"] ** 2 + final["v2"] ** 2 + final["v3"] ** 2)
+        alpha = np.arctan(final["v3"] / final["v1"])
+        radius = speed * np.cos(final["theta"] - alpha) / final["r"]
+
+        # The arrival run ends when a planner flying the desired glide straight
+        # to TARGET expects the glider there
+        planned = math.hypot(*TARGET) / (self.V_d * math.cos(self.glide_angle))
+        arrival_time, arrival = self.fly(planned, int(planned) + 1, steering=True)
+        arrival_error = self.arrival_error(arrival)
+
+        self.arrival_time = arrival_time
+        self.arrival_sensitivity = self.central_difference(arrival)
+
+        self.metrics = {
+            "glide speed (m/s)": speed[0],
+            "turning radius (m)": radius[0],
+            "arrival error (m)": arrival_error[0],
+        }
+        self.gradients = {
+            "glide speed (m/s)": self.central_difference(speed),
+            "turning radius (m)": self.central_difference(radius),
+            "arrival error (m)": self.central_difference(arrival_error),
+        }
+
+        self.print_summary()
+
+        utils.plots(self.total_time, STATE_3D.view(self.trajectory[0]), self.plots)
+
+    def arrival_error(self, trajectory):
+        # Horizontal distance still to go to TARGET along the final track,
+        # negative once the glider has passed it
+        x = trajectory[:, STATE_3D.index["x"]]
+        y = trajectory[:, STATE_3D.index["y"]]
+        ux, uy = x[:, -1] - x[:, -2], y[:, -1] - y[:, -2]
+        dx, dy = TARGET[0] - x[:, -1], TARGET[1] - y[:, -1]
+
+        return (ux * dx + uy * dy) / np.hypot(ux, uy)
+
+    def print_summary(self):
+        print("\nNominal design")
+        for name, value in self.metrics.items():
+            print("{}: {}".format(name, value))
+
+        print("\nGradients d(metric)/d(parameter), change for +1 % in brackets")
+        for j, name in enumerate(PARAMETERS):
+            value = self.var[name][0]
+            print("{} = {}".format(name, value))
+            for metric, gradient in self.gradients.items():
+                print(
+                    "    {}: {:.6g} ({:.3g})".format(
+                        metric, gradient[j], gradient[j] * value / 100
+                    )
+                )
+
+
+if __name__ == "__main__":
+    Z = Sensitivity_Analysis()
+    Z.set_desired_trajectory()
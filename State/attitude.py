@@ -0,0 +1,122 @@
+import numpy as np
+
+from State.state_schema import STATE_3D, STATE_3D_QUATERNION
+
+# Rate (1/s) at which the quaternion kinematics pull the norm of the quaternion
+# back to one (Fossen's normalization term); small next to the glider's
+# dynamics so that it does not limit the step size
+NORMALIZATION_GAIN = 0.1
+
+
+def attitude_schema(attitude):
+    # State schema of the 3D and waypoint dynamics for -at euler or quaternion
+    return STATE_3D_QUATERNION if attitude == "quaternion" else STATE_3D
+
+
+def euler_to_quaternion(phi, theta, psi):
+    # Unit quaternion (eta, eps1, eps2, eps3) of the zyx Euler angles, with
+    # the quaternion on the first axis
+    cphi, sphi = np.cos(0.5 * np.asarray(phi)), np.sin(0.5 * np.asarray(phi))
+    cth, sth = np.cos(0.5 * np.asarray(theta)), np.sin(0.5 * np.asarray(theta))
+    cpsi, spsi = np.cos(0.5 * np.asarray(psi)), np.sin(0.5 * np.asarray(psi))
+
+    return np.array(
+        [
+            cphi * cth * cpsi + sphi * sth * spsi,
+            sphi * cth * cpsi - cphi * sth * spsi,
+            cphi * sth * cpsi + sphi * cth * spsi,
+            cphi * cth * spsi - sphi * sth * cpsi,
+        ]
+    )
+
+
+def normalized(e):
+    e = np.asarray(e, dtype=float)
+    return e / np.sqrt(np.sum(e**2, axis=0))
+
+
+def quaternion_to_euler(e):
+    # phi, theta, psi of quaternions (4, ...), psi in (-pi, pi]
+    eta, e1, e2, e3 = normalized(e)
+
+    phi = np.arctan2(2 * (eta * e1 + e2 * e3), 1 - 2 * (e1**2 + e2**2))
+    theta = np.arcsin(np.clip(2 * (eta * e2 - e3 * e1), -1.0, 1.0))
+    psi = np.arctan2(2 * (eta * e3 + e1 * e2), 1 - 2 * (e2**2 + e3**2))
+
+    return np.array([phi, theta, psi])
+
+
+def quaternion_rotation(e):
+    # Body to world rotation of quaternions (4, ...), (..., 3, 3): the same
+    # matrix as utils.transformationMatrix's J1_n2 and batch_dynamics.rotation
+    eta, e1, e2, e3 = normalized(e)
+
+    R = np.empty(np.shape(eta) + (3, 3))
+    R[..., 0, 0] = 1 - 2 * (e2**2 + e3**2)
+    R[..., 0, 1] = 2 * (e1 * e2 - e3 * eta)
+    R[..., 0, 2] = 2 * (e1 * e3 + e2 * eta)
+    R[..., 1, 0] = 2 * (e1 * e2 + e3 * eta)
+    R[..., 1, 1] = 1 - 2 * (e1**2 + e3**2)
+    R[..., 1, 2] = 2 * (e2 * e3 - e1 * eta)
+    R[..., 2, 0] = 2 * (e1 * e3 - e2 * eta)
+    R[..., 2, 1] = 2 * (e2 * e3 + e1 * eta)
+    R[..., 2, 2] = 1 - 2 * (e1**2 + e2**2)
+
+    return R
+
+
+def quaternion_rate(e, Omega, gain=NORMALIZATION_GAIN):
+    # Derivative of quaternions (4, ...) at body rates Omega = (p, q, r),
+    # (3, ...). Unlike the Euler angle rates it has no singularity. The last
+    # term decays the norm error, |e|^2 - 1, at twice the gain.
+    eta, e1, e2, e3 = e
+    p, q, r = Omega
+    correction = 0.5 * gain * (1 - (eta**2 + e1**2 + e2**2 + e3**2))
+
+    return np.array(
+        [
+            -0.5 * (e1 * p + e2 * q + e3 * r) + correction * eta,
+            0.5 * (eta * p - e3 * q + e2 * r) + correction * e1,
+            0.5 * (e3 * p + eta * q - e1 * r) + correction * e2,
+            0.5 * (-e2 * p + e1 * q + eta * r) + correction * e3,
+        ]
+    )
+
+
+def quaternion_states(y):
+    # STATE_3D states (size, ...) in the STATE_3D_QUATERNION layout
+    y = np.asarray(y, dtype=float)
+    n = STATE_3D.index["phi"]
+
+    out = np.empty((STATE_3D_QUATERNION.size,) + y.shape[1:])
+    out[:n] = y[:n]
+    out[n:] = euler_to_quaternion(*STATE_3D.get(y, "n2"))
+
+    return out
+
+
+def euler_states(y, psi0=None):
+    # STATE_3D_QUATERNION states (size, ...) in the STATE_3D layout, with
+    # normalized quaternions. psi is unwrapped along the last axis and starts
+    # on the branch of psi0 (by default in (-pi, pi]), so that it keeps
+    # counting the turns of a spiral like the integrated Euler angle does.
+    # psi0 may also give one heading per sample, for samples too far apart to
+    # unwrap: each psi is then put on the branch nearest its own.
+    y = np.asarray(y, dtype=float)
+    n = STATE_3D.index["phi"]
+
+    out = np.empty((STATE_3D.size,) + y.shape[1:])
+    out[:n] = y[:n]
+    out[n:] = quaternion_to_euler(y[n:])
+
+    k = STATE_3D.index["psi"]
+    if np.ndim(psi0) > 0:
+        out[k] += 2 * np.pi * np.round((psi0 - out[k]) / (2 * np.pi))
+        return out
+    if y.ndim > 1:
+        out[k] = np.unwrap(out[k])
+    if psi0 is not None:
+        first = out[k] if y.ndim == 1 else out[k, ..., 0]
+        out[k] += 2 * np.pi * np.round((psi0 - first) / (2 * np.pi))
+
+    return out
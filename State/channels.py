@@ -0,0 +1,206 @@
+import json
+import os
+
+import numpy as np
+
+from Analysis.trajectory_analysis import flight_state
+from State.state_schema import VECTORS
+
+# Flight quantities (Analysis/trajectory_analysis.flight_state) that can be
+# recorded besides the states
+DIAGNOSTICS = ("V", "alpha", "beta", "gamma", "course", "psi_dot", "turn_radius")
+
+
+def parse_channels(spec, schema):
+    # {name: decimation} of a -rc setting: comma separated channels, each
+    # optionally with the number of output samples per recorded one
+    # ("x,y,z,psi:10,mb"). Vector names (n1, v, ...) stand for their
+    # components. Without a setting, every state at every sample.
+    if spec is None:
+        return {name: 1 for name in schema.names}
+
+    channels = {}
+    for item in spec.split(","):
+        name, _, every = item.strip().partition(":")
+        for channel in VECTORS.get(name, (name,)):
+            if channel not in schema and channel not in DIAGNOSTICS:
+                raise ValueError("Unknown channel {}".format(channel))
+            channels[channel] = int(every or 1)
+
+    return channels
+
+
+def channel_recorder(args, schema, constants=None):
+    # Recorder of the -rc and -rs settings of a run, None without either
+    if args.record is None and args.storage is None:
+        return None
+
+    return ChannelRecorder(
+        parse_channels(args.record, schema),
+        schema,
+        constants,
+        args.storage or "float64",
+    )
+
+
+class ChannelRecorder:
+    # Records selected channels of a run, or of a fleet, window by window.
+    # append(t, y) takes output times (T,) and states (schema.size, T), or
+    # (N, schema.size, T) for N gliders; each channel keeps every
+    # `decimation`th output sample, counted over the whole run. Values are
+    # held in float32 or float64 while the run goes on and packed into the
+    # storage type by finish().
+    def __init__(self, channels, schema, constants=None, storage="float64"):
+        self.channels = channels
+        self.schema = schema
+        self.constants = constants
+        self.storage = storage
+        self.hold = np.float32 if storage != "float64" else np.float64
+
+        self.times = []
+        self.blocks = {name: [] for name in channels}
+        self.samples = 0
+        self.members = None
+        self.data = None
+        self.packing = {}
+
+    def append(self, t, y):
+        t = np.asarray(t, dtype=float)
+        y = np.asarray(y)
+        if y.ndim == 3:
+            self.members = y.shape[0]
+            # flight_state and the schema take the state on the first axis
+            y = np.moveaxis(y, 1, 0)
+
+        index = self.samples + np.arange(len(t))
+        self.times.append(t)
+        self.samples += len(t)
+
+        x = self.schema.view(y, self.constants)
+        diagnostics = {}
+        for name, every in self.channels.items():
+            keep = index % every == 0
+            if not keep.any():
+                continue
+
+            if name in DIAGNOSTICS:
+                if every not in diagnostics:
+                    diagnostics[every] = flight_state(
+                        y[..., keep], self.schema, self.constants
+                    )
+                value = diagnostics[every][name]
+            else:
+                value = np.broadcast_to(x[name], y.shape[1:])[..., keep]
+            self.blocks[name].append(np.asarray(value, dtype=self.hold))
+
+    def finish(self):
+        # Joins the blocks of every channel and packs them into the storage
+        # type. Nothing can be appended afterwards.
+        if self.data is not None:
+            return
+
+        self.t = np.concatenate(self.times)
+        self.data = {}
+        for name, blocks in self.blocks.items():
+            value = np.concatenate(blocks, axis=-1)
+            if self.storage.startswith("int"):
+                value, self.packing[name] = pack(value, self.storage)
+            self.data[name] = value
+        self.times = self.blocks = None
+
+    def report(self):
+        # Size of the record against every state at every sample in float64
+        recorded = self.t.nbytes + sum(value.nbytes for value in self.data.values())
+        full = 8 * len(self.t) * (1 + self.schema.size * (self.members or 1))
+        print(
+            "Recorded {} channels in {}: {:.2f} MB instead of {:.2f} MB".format(
+                len(self.data), self.storage, recorded / 1e6, full / 1e6
+            )
+        )
+
+    def close(self, path=None):
+        # End of the run: packs the record, prints its size and writes it to
+        # path if one is given
+        self.finish()
+        self.report()
+        if path is not None:
+            self.save(path)
+
+    def save(self, path):
+        # A JSON header plus one .npy file per channel next to it, and one for
+        # the output times: <stem>.t.npy, <stem>.<channel>.npy
+        self.finish()
+        stem = os.path.splitext(path)[0]
+        np.save(stem + ".t.npy", self.t)
+
+        channels = {}
+        for name, value in self.data.items():
+            np.save("{}.{}.npy".format(stem, name), value)
+            channels[name] = dict(
+                data=os.path.basename("{}.{}.npy".format(stem, name)),
+                every=self.channels[name],
+                **self.packing.get(name, {})
+            )
+
+        header = {
+            "times": os.path.basename(stem + ".t.npy"),
+            "members": self.members,
+            "storage": self.storage,
+            "channels": channels,
+        }
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(header, file, indent=4)
+
+
+def pack(value, storage):
+    # Quantizes value over its finite range into the integer type storage,
+    # value = add_offset + scale_factor * stored as in packed netCDF
+    # variables. The largest integer of the type is kept for NaN.
+    info = np.iinfo(storage)
+    finite = np.isfinite(value)
+    low = float(np.min(value, where=finite, initial=np.inf))
+    high = float(np.max(value, where=finite, initial=-np.inf))
+    if not finite.any():
+        low = high = 0.0
+
+    levels = info.max - 1 - info.min
+    scale = (high - low) / levels if high > low else 1.0
+    offset = low - info.min * scale
+
+    packed = np.full(value.shape, info.max, dtype=storage)
+    # In float64: float32 held values would be quantized at their own
+    # resolution, coarser than that of int16 and int32
+    packed[finite] = np.rint((value[finite].astype(float) - offset) / scale)
+
+    return packed, {"scale_factor": scale, "add_offset": offset}
+
+
+class Recording:
+    # Channels of a file written by ChannelRecorder.save, memory-mapped.
+    # recording["psi"] is the unpacked float64 array, (T_psi,) or
+    # (N, T_psi) for a fleet, at the times recording.times("psi").
+    def __init__(self, path):
+        with open(path, encoding="utf-8") as file:
+            header = json.load(file)
+
+        folder = os.path.dirname(os.path.abspath(path))
+        self.members = header["members"]
+        self.storage = header["storage"]
+        self.channels = header["channels"]
+        self.t = np.load(os.path.join(folder, header["times"]), mmap_mode="r")
+        self.data = {
+            name: np.load(os.path.join(folder, channel["data"]), mmap_mode="r")
+            for name, channel in self.channels.items()
+        }
+
+    def times(self, name):
+        return np.asarray(self.t[:: self.channels[name]["every"]])
+
+    def __getitem__(self, name):
+        channel = self.channels[name]
+        value = np.asarray(self.data[name])
+        if "scale_factor" not in channel:
+            return value.astype(float)
+
+        unpacked = channel["add_offset"] + channel["scale_factor"] * value
+        return np.where(value == np.iinfo(value.dtype).max, np.nan, unpacked)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+
+import numpy as np
+
+
+def _encode(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{!r} cannot be part of a checkpoint key".format(value))
+
+
+def file_signature(path):
+    # Size and modification time of an input file (and of the data file of a
+    # current field header), so an edited file invalidates the checkpoints
+    # without reading it
+    if path is None:
+        return None
+
+    stat = os.stat(path)
+    signature = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as file:
+            header = json.load(file)
+        if isinstance(header, dict) and "data" in header:
+            data = os.path.join(os.path.dirname(os.path.abspath(path)), header["data"])
+            signature.append(file_signature(data))
+
+    return signature
+
+
+class SegmentCache:
+    # Checkpoints of a run flown in segments (2D cycles, fleet windows, energy
+    # legs), one file per segment in `directory`. Segment k is stored under a
+    # key chaining the key of segment k - 1 with the inputs segment k reads,
+    # so a key only matches when the segment and all the ones before it were
+    # flown with the same inputs. A re-run restores the longest unchanged
+    # prefix and flies the rest. With directory None nothing is stored.
+    def __init__(self, directory, inputs=None):
+        self.directory = directory
+        self.key = self.digest("", inputs)
+        self.restored = 0
+        self.flown = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def digest(key, inputs):
+        text = json.dumps(inputs, sort_keys=True, default=_encode)
+        return hashlib.sha256((key + text).encode("utf-8")).hexdigest()
+
+    def path(self):
+        return os.path.join(self.directory, self.key + ".pkl")
+
+    def run(self, inputs, fly):
+        # Result of the next segment: restored, or fly() stored under its key.
+        # A None result (failed integration) is not stored.
+        self.key = self.digest(self.key, inputs)
+
+        if self.directory is not None and os.path.exists(self.path()):
+            with open(self.path(), "rb") as file:
+                result = pickle.load(file)
+            self.restored += 1
+            return result
+
+        result = fly()
+        self.flown += 1
+
+        if self.directory is not None and result is not None:
+            # Written under a temporary name first, so an interrupted run
+            # never leaves a truncated checkpoint behind; the name is the
+            # process's and thread's own
+            temporary = "{}.{}.{}".format(
+                self.path(), os.getpid(), threading.get_ident()
+            )
+            with open(temporary, "wb") as file:
+                pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.path())
+
+        return result
+
+    def report(self, segments):
+        if self.directory is not None:
+            print(
+                "\nCheckpoints: {} of {} {} restored from {}".format(
+                    self.restored, self.restored + self.flown, segments, self.directory
+                )
+            )
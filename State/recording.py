@@ -0,0 +1,108 @@
+import numpy as np
+
+from State.state_schema import STATE_3D
+
+# Recorded points reproduce the trajectory by linear interpolation to within
+# ATOL + RTOL * (range of each state over the window)
+RTOL = 1e-3
+ATOL = 1e-6
+
+
+class DenseTrajectory:
+    # Continuous trajectory stitched from the dense output of consecutive
+    # solve_ivp windows. traj(t) resamples it at any times: (size,) for a
+    # scalar t, (size, len(t)) for an array. convert(y, psi) maps the
+    # integrated states to the output ones, a quaternion attitude to Euler
+    # angles (State/attitude.euler_states), with psi the heading of each
+    # sample's branch.
+    def __init__(self, convert=None):
+        self.convert = convert
+        self.segments = []
+        self.starts = []
+        self.headings = []
+        self.size = None
+
+    def append(self, sol, psi0=None):
+        # psi0: heading at the start of the window, on the branch of the run.
+        # The heading is unwrapped over the solver steps from there, and
+        # resampled headings are put on the branch nearest it.
+        self.segments.append(sol.sol)
+        self.starts.append(sol.sol.t_min)
+        self.size = sol.y.shape[0]
+        if self.convert is not None:
+            steps = sol.sol.ts
+            psi = self.convert(sol.sol(steps), psi0)[STATE_3D.index["psi"]]
+            self.headings.append((steps, psi))
+
+    @property
+    def t_min(self):
+        return self.segments[0].t_min
+
+    @property
+    def t_max(self):
+        return self.segments[-1].t_max
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        times = np.atleast_1d(t)
+
+        k = np.searchsorted(self.starts, times, side="right") - 1
+        k = np.clip(k, 0, len(self.segments) - 1)
+
+        out = np.empty((self.size, len(times)))
+        psi = np.empty(len(times))
+        for s in np.unique(k):
+            mask = k == s
+            out[:, mask] = self.segments[s](times[mask])
+            if self.convert is not None:
+                psi[mask] = np.interp(times[mask], *self.headings[s])
+
+        if self.convert is not None:
+            out = self.convert(out, psi)
+
+        return out[:, 0] if t.ndim == 0 else out
+
+
+def _simplify(t, y):
+    # Douglas-Peucker on the time axis: keep the fewest points such that the
+    # straight line between kept neighbours stays within 1 (y is pre-scaled)
+    # of every dropped point.
+    keep = np.zeros(len(t), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(t) - 1)]
+
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+
+        f = (t[i + 1 : j] - t[i]) / (t[j] - t[i])
+        line = y[:, i : i + 1] + f * (y[:, j : j + 1] - y[:, i : i + 1])
+        error = np.max(np.abs(y[:, i + 1 : j] - line), axis=0)
+
+        k = int(np.argmax(error))
+        if error[k] > 1.0:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+
+    return np.flatnonzero(keep)
+
+
+def adaptive_times(sol, rtol=RTOL, atol=ATOL, substeps=4):
+    # Output points for a solve_ivp result computed with dense_output=True and
+    # no t_eval. The candidates are the solver steps, each split into
+    # `substeps` parts; where the trajectory bends (transitions) many are
+    # kept, in steady segments few. Returns the times and the states there.
+    t = sol.t
+    f = np.arange(substeps) / substeps
+    times = np.append((t[:-1, None] + f * np.diff(t)[:, None]).ravel(), t[-1])
+
+    y = sol.sol(times)
+    y[:, ::substeps] = sol.y
+
+    scale = atol + rtol * (np.max(y, axis=1) - np.min(y, axis=1))
+    keep = _simplify(times, y / scale[:, None])
+
+    return times[keep], y[:, keep]
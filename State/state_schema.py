@@ -0,0 +1,174 @@
+import numpy as np
+
+# Layout of the original 27 entry state vector, kept for reference and for
+# unpacking reduced states back into it, followed by the attitude quaternion.
+FULL_LAYOUT = (
+    "x",
+    "y",
+    "z",
+    "p",
+    "q",
+    "r",
+    "v1",
+    "v2",
+    "v3",
+    "rp1",
+    "rp2",
+    "rp3",
+    "rb1",
+    "rb2",
+    "rb3",
+    "rp1_dot",
+    "rp2_dot",
+    "rp3_dot",
+    "rb1_dot",
+    "rb2_dot",
+    "rb3_dot",
+    "mb",
+    "pad1",
+    "pad2",
+    "phi",
+    "theta",
+    "psi",
+    "eta",
+    "eps1",
+    "eps2",
+    "eps3",
+)
+
+VECTORS = {
+    "n1": ("x", "y", "z"),
+    "Omega": ("p", "q", "r"),
+    "v": ("v1", "v2", "v3"),
+    "rp": ("rp1", "rp2", "rp3"),
+    "rb": ("rb1", "rb2", "rb3"),
+    "rp_dot": ("rp1_dot", "rp2_dot", "rp3_dot"),
+    "rb_dot": ("rb1_dot", "rb2_dot", "rb3_dot"),
+    "n2": ("phi", "theta", "psi"),
+    "quaternion": ("eta", "eps1", "eps2", "eps3"),
+}
+
+COMPONENT = {
+    name: (vector, k)
+    for vector, names in VECTORS.items()
+    for k, name in enumerate(names)
+}
+
+
+class StateSchema:
+    # Declares which scalar states are integrated and in which order. Arrays of
+    # states have the state on the first axis: (size,) for one sample,
+    # (size, T) for a trajectory. Every other entry of FULL_LAYOUT is a
+    # constant, taken from `constants` (by name) or zero.
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.size = len(self.names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.full_index = np.array([FULL_LAYOUT.index(name) for name in self.names])
+
+        # pack() copies whole vectors at once: (vector, state indices, components)
+        self.plan = []
+        for vector, names in VECTORS.items():
+            k = [j for j, name in enumerate(names) if name in self.index]
+            if k:
+                self.plan.append(
+                    (vector, np.array([self.index[names[j]] for j in k]), np.array(k))
+                )
+        for name in self.names:
+            if name not in COMPONENT:
+                self.plan.append((name, self.index[name], None))
+
+        self.complete = {
+            vector: np.array([self.index[name] for name in names])
+            for vector, names in VECTORS.items()
+            if all(name in self.index for name in names)
+        }
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def slice(self, name):
+        # Position of a whole vector, for arrays with the state on the last axis
+        names = VECTORS.get(name, (name,))
+        start = self.index[names[0]]
+        if any(self.index.get(n) != start + k for k, n in enumerate(names)):
+            raise KeyError("{} is not stored contiguously".format(name))
+
+        return slice(start, start + len(names))
+
+    def get(self, y, name, constants=None):
+        if name in self.complete:
+            return y[self.complete[name]]
+
+        if name in VECTORS:
+            return np.array([self.get(y, n, constants) for n in VECTORS[name]])
+
+        if name in self.index:
+            return y[self.index[name]]
+
+        value = 0.0 if constants is None else constants.get(name, 0.0)
+        return np.full(np.shape(y)[1:], value) if np.ndim(y) > 1 else value
+
+    def column(self, y, name, constants=None):
+        # 3x1 column vector, as used by the Dynamics classes
+        return np.reshape(self.get(y, name, constants), (3, 1))
+
+    def pack(self, values):
+        # values maps vector or state names to values, e.g. {"v": v1_dot, "mb": 0.1}
+        out = np.empty(self.size)
+        for name, index, k in self.plan:
+            if k is None:
+                out[index] = values[name]
+            elif name in values:
+                out[index] = np.ravel(values[name])[k]
+            else:
+                out[index] = [values[VECTORS[name][j]] for j in k]
+
+        return out
+
+    def unpack(self, y, constants=None):
+        full = np.zeros((len(FULL_LAYOUT),) + np.shape(y)[1:])
+        for name, value in (constants or {}).items():
+            if name in FULL_LAYOUT:
+                full[FULL_LAYOUT.index(name)] = value
+        full[self.full_index] = y
+
+        return full
+
+    def view(self, y, constants=None):
+        return StateView(self, y, constants)
+
+
+class StateView:
+    # Named read access to a state array: view["theta"], view["v"]
+    def __init__(self, schema, y, constants=None):
+        self.schema = schema
+        self.y = y
+        self.constants = constants
+
+    def __getitem__(self, name):
+        return self.schema.get(self.y, name, self.constants)
+
+
+# Integrated states of the 3D and waypoint modes. rb and rb_dot never change
+# (wb = 0), so they are glider variables (rb1, rb2, rb3) rather than states.
+STATE_3D = StateSchema(
+    VECTORS["n1"]
+    + VECTORS["Omega"]
+    + VECTORS["v"]
+    + VECTORS["rp"]
+    + VECTORS["rp_dot"]
+    + ("mb",)
+    + VECTORS["n2"]
+)
+
+# Vertical plane: y, v2, p, r, phi and psi stay at their initial values and the
+# moving mass only slides along the body axis (rp3 is a glider variable).
+STATE_2D = StateSchema(("x", "z", "q", "v1", "v3", "rp1", "rp1_dot", "mb", "theta"))
+
+# 3D and waypoint modes with -at quaternion: the attitude is a unit quaternion
+# (State/attitude.py) instead of the Euler angles, which are singular at
+# theta = +-90 deg
+STATE_3D_QUATERNION = StateSchema(
+    STATE_3D.names[: STATE_3D.index["phi"]] + VECTORS["quaternion"]
+)
@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+
+# Absolute tolerance of each state over the relative tolerance (SI units,
+# rad): its typical size. Positions are resolved in metres, the moving mass
+# in centimetres, the ballast in kilograms and the rates in 1e-3 rad/s. Each
+# mode also passes its trim state, and a state larger there is scaled by
+# that size. Tuned scales (-m tolerances, -tl) loosen the states that allow
+# it.
+SCALES = {
+    "x": 1.0,
+    "y": 1.0,
+    "z": 1.0,
+    "p": 1e-3,
+    "q": 1e-3,
+    "r": 1e-3,
+    "v1": 0.01,
+    "v2": 0.01,
+    "v3": 0.01,
+    "rp1": 0.01,
+    "rp2": 0.01,
+    "rp3": 0.01,
+    "rp1_dot": 1e-3,
+    "rp2_dot": 1e-3,
+    "rp3_dot": 1e-3,
+    "mb": 1.0,
+    "phi": 0.01,
+    "theta": 0.01,
+    "psi": 0.01,
+    "eta": 0.01,
+    "eps1": 0.01,
+    "eps2": 0.01,
+    "eps3": 0.01,
+}
+
+
+def state_scales(schema, equilibrium=None, scales=None):
+    # Scale of each state of the schema, (size,): the SCALES entry, or the
+    # tuned one from `scales` ({name: scale}). With `equilibrium` ((size,) or
+    # (size, ...)) a state's magnitude there is taken if that is larger; the
+    # tuner measures errors in these units.
+    table = dict(SCALES, **(scales or {}))
+    values = np.array([table[name] for name in schema.names])
+    if equilibrium is not None:
+        magnitude = np.abs(np.asarray(equilibrium, dtype=float))
+        values = np.maximum(values, magnitude.reshape(schema.size, -1).max(axis=1))
+
+    return values
+
+
+def absolute_tolerances(schema, rtol, scales=None, equilibrium=None):
+    # atol vector for solve_ivp at the relative tolerance rtol, around the
+    # trim state `equilibrium` of the flight
+    return rtol * state_scales(schema, equilibrium, scales)
+
+
+def load_tolerances(path, plane):
+    # Tuned scales {name: scale} of a plane ("2D" or "3D") from a file written
+    # in tolerances mode, None (SCALES) without a file. Scales do not depend
+    # on the relative tolerance, so every mode keeps its own.
+    if path is None:
+        return None
+
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)[plane]["scales"]
+
+
+def save_tolerances(path, plane, rtol, scales):
+    # Replaces the plane's entry of the file, keeping the other planes. rtol
+    # is the relative tolerance the scales were tuned at.
+    tolerances = {}
+    if os.path.isfile(path):
+        with open(path, encoding="utf-8") as file:
+            tolerances = json.load(file)
+
+    tolerances[plane] = {"rtol": rtol, "scales": dict(scales)}
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(tolerances, file, indent=4)
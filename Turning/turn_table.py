@@ -0,0 +1,377 @@
+import numpy as np
+import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from scipy.interpolate import RegularGridInterpolator
+import utils
+from Environment.density import load_density_profile, displaced_mass_batch
+from Modeling3d.batch_dynamics import BatchDynamics, fly_batch
+from State.state_schema import STATE_3D
+from Parameters.registry import load_glider
+
+# Default grid: rudder angle (deg), lateral offset rp2 of the movable mass (m)
+# and glide angle magnitude (deg), for dives and climbs. The rudder and rp2
+# axes must be symmetric about 0 (see mirrored()).
+RUDDER_ANGLES = np.linspace(-30.0, 30.0, 13)
+RP2_OFFSETS = np.linspace(-0.03, 0.03, 7)
+# Straight dives steeper than about 38 deg roll over in this model, so the
+# grid stops below that
+GLIDE_ANGLES = np.array([15.0, 20.0, 25.0, 30.0, 35.0])
+DIRECTIONS = ("dive", "climb")
+
+# The turn is flown for DURATION seconds and counts as steady when the yaw
+# rate and roll have changed by less than STEADY_TOL (relative) over the last
+# STEADY_WINDOW seconds
+DURATION = 1500.0
+STEADY_WINDOW = 100.0
+STEADY_TOL = 1e-3
+
+RTOL = 1e-6
+ATOL = 1e-8
+
+# The curvature (1/radius) is tabulated instead of the radius: it is 0 for a
+# straight glide and changes sign smoothly where rudder and rp2 cancel, so it
+# interpolates well where the radius does not
+QUANTITIES = ("curvature", "phi", "theta", "beta", "speed", "turn_rate")
+
+
+def steady_turns(job):
+    # Flies the turns of the job as one BatchDynamics fleet and returns the
+    # QUANTITIES at the end of the run, (n,) each, NaN for a glider that
+    # stalled or flipped over, and whether each turn has settled. Runs in a
+    # worker process, so it takes plain arrays and dicts only.
+    var, Z, controls = job
+    S = STATE_3D
+
+    def make_batch(active):
+        batch = BatchDynamics(var, len(active))
+        for name, value in controls.items():
+            getattr(batch.controls, name)[:] = value[active]
+
+        return batch
+
+    t = np.array([0.0, DURATION - STEADY_WINDOW, DURATION])
+    Y = fly_batch(make_batch, Z, t, method="RK45", rtol=RTOL, atol=ATOL)
+
+    with np.errstate(invalid="ignore"):
+        D = make_batch(np.arange(len(Z))).set_eom(t[-1], Y[:, :, -1])
+    final = S.view(Y[:, :, -1].T)
+
+    V = np.sqrt(final["v1"] ** 2 + final["v2"] ** 2 + final["v3"] ** 2)
+    psi_dot = D[:, S.index["psi"]]
+    horizontal = np.hypot(D[:, S.index["x"]], D[:, S.index["y"]])
+
+    values = {
+        # Signed like the turn rate: positive turning to starboard
+        "curvature": psi_dot / horizontal,
+        "phi": final["phi"],
+        "theta": final["theta"],
+        "beta": np.arcsin(final["v2"] / V),
+        "speed": V,
+        "turn_rate": psi_dot,
+    }
+
+    # A glider that stalled compares as not steady (NaN)
+    before = S.view(Y[:, :, 1].T)
+    r, phi = final["r"], final["phi"]
+    steady = (np.abs(r - before["r"]) <= STEADY_TOL * np.abs(r) + 1e-8) & (
+        np.abs(phi - before["phi"]) <= STEADY_TOL * np.abs(phi) + 1e-8
+    )
+
+    return values, steady
+
+
+def mirrored(value, name):
+    # Quantity of the mirror image turn (rudder and rp2 negated): the glider
+    # is laterally symmetric, so the turn, roll and sideslip change sign
+    return value if name in ("theta", "speed") else -value
+
+
+class Turn_Table:
+    # Steady-turn performance over a grid of rudder angles, rp2 offsets and
+    # glide angles, flown as one BatchDynamics fleet (split between `workers`
+    # processes) and written as a table that TurnTable looks up.
+    def __init__(self, args):
+        self.args = args
+        self.mode = self.args.mode
+        self.glider_name = self.args.glider
+        self.info = self.args.info
+        self.workers = self.args.workers
+        self.current_file = self.args.current
+        self.density_file = self.args.density
+        self.hydro_table_file = self.args.hydrotable
+        self.path = self.args.turntable or "vars/turn_table.json"
+
+        self.initialization()
+
+    def initialization(self):
+        self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
+
+        P = load_glider(self.glider_name, "3D")
+        self.params = P
+
+        self.mass_params = P.GLIDER_CONFIG
+        self.hydro_params = P.HYDRODYNAMICS
+        self.vars = P.VARIABLES
+
+        self.mh = self.mass_params.HULL_MASS
+        self.mw = self.mass_params.FIXED_POINT_MASS
+        self.mm = self.mass_params.INT_MOVABLE_MASS
+        self.m = self.mass_params.FLUID_DISP_MASS
+
+        self.Mf = P.Mf
+        self.Jf = P.Jf
+
+        self.M = P.M
+        self.J = P.J  # J = Jf + Jh
+
+        self.density = load_density_profile(self.density_file)
+
+        self.var = {
+            "Mf": self.Mf,
+            "M": self.M,
+            "J": self.J,
+            "KL": self.hydro_params.KL,
+            "KL0": self.hydro_params.KL0,
+            "KD": self.hydro_params.KD,
+            "KD0": self.hydro_params.KD0,
+            "K_beta": self.hydro_params.K_beta,
+            "KM": self.hydro_params.KM,
+            "KM0": self.hydro_params.KM0,
+            "K_MY": self.hydro_params.K_MY,
+            "K_MR": self.hydro_params.K_MR,
+            "KOmega11": self.hydro_params.KOmega11,
+            "KOmega12": self.hydro_params.KOmega12,
+            "KOmega13": self.hydro_params.KOmega13,
+            "mh": self.mh,
+            "mw": self.mw,
+            "mm": self.mm,
+            "m": self.m,
+            "rp2": 0.0,
+            "rp3": self.vars.rp3,
+            "rb1": self.vars.rb1,
+            "rb2": self.vars.rb2,
+            "rb3": self.vars.rb3,
+            "rw1": self.vars.rw1,
+            "rw2": self.vars.rw2,
+            "rw3": self.vars.rw3,
+            "rho_ref": self.mass_params.REF_DENSITY,
+            "hull_compressibility": self.mass_params.HULL_COMPRESSIBILITY,
+            "ballast_rate": self.vars.BALLAST_RATE,
+            "rudder": "enable",
+            "current_file": self.current_file,
+            "glider": self.glider_name,
+            "density_file": self.density_file,
+            "hydro_table_file": self.hydro_table_file,
+        }
+
+        self.V_d = self.vars.SPEED
+        self.beta_d = math.radians(self.vars.BETA)
+        self.psi0 = math.radians(self.vars.PSI)
+
+    def set_desired_trajectory(self):
+        # (direction, glide angle, rudder, rp2); only the turns with a positive
+        # rudder angle, or no rudder and rp2 >= 0, are flown, the others are
+        # their mirror images
+        shape = (
+            len(DIRECTIONS),
+            len(GLIDE_ANGLES),
+            len(RUDDER_ANGLES),
+            len(RP2_OFFSETS),
+        )
+        d, a, r, p = np.indices(shape).reshape(4, -1)
+        rudder, rp2 = RUDDER_ANGLES[r], RP2_OFFSETS[p]
+        flown = (rudder > 0) | ((rudder == 0) & (rp2 >= 0))
+
+        glide_dir = np.where(d == 0, 1.0, -1.0)
+        e_i_d = -glide_dir * np.radians(GLIDE_ANGLES[a])
+
+        Z, controls = self.initial_states(e_i_d[flown], rudder[flown], rp2[flown])
+        values, steady = self.fly(Z, controls)
+
+        # The mirror image of turn k sits at the negated rudder and rp2 indices
+        mirror = np.ravel_multi_index(
+            (d, a, len(RUDDER_ANGLES) - 1 - r, len(RP2_OFFSETS) - 1 - p), shape
+        )
+        index = np.empty(len(d), dtype=int)
+        index[np.flatnonzero(flown)] = np.arange(np.sum(flown))
+        index[~flown] = index[mirror[~flown]]
+
+        self.table = {
+            name: np.where(
+                flown, values[name][index], mirrored(values[name][index], name)
+            ).reshape(shape)
+            for name in QUANTITIES
+        }
+        self.steady = steady[index].reshape(shape)
+
+        if not np.all(self.steady):
+            print(
+                "{} of {} turns have not settled after {:.0f} s".format(
+                    np.sum(~self.steady), self.steady.size, DURATION
+                )
+            )
+
+        self.save_json()
+        print("Turn table written to {}".format(self.path))
+
+        if self.info == True:
+            k = np.argmin(np.abs(GLIDE_ANGLES - self.vars.GLIDE_ANGLE))
+            with np.errstate(divide="ignore"):
+                radius = 1 / self.table["curvature"][0, k]
+            print(
+                "\nDive at {} deg, turn radius (m) over rudder (rows) and rp2 (columns)".format(
+                    GLIDE_ANGLES[k]
+                )
+            )
+            print("rp2 (cm): {}".format(RP2_OFFSETS * 100))
+            for j, delta in enumerate(RUDDER_ANGLES):
+                print("{:6.1f} deg: {}".format(delta, np.round(radius[j], 1)))
+
+    def initial_states(self, e_i_d, rudder, rp2):
+        # Straight glide trim of each turn, with the rudder set and the
+        # movable mass moved out to rp2 from the start
+        n = len(e_i_d)
+        S = STATE_3D
+
+        m_local = displaced_mass_batch(
+            self.m,
+            np.zeros(n),
+            self.density,
+            self.var["rho_ref"],
+            self.var["hull_compressibility"],
+            self.g,
+        )
+        eq = utils.glide_equilibrium(
+            e_i_d, self.V_d, self.var, m=m_local, beta_d=self.beta_d
+        )
+
+        Z = np.zeros((n, S.size))
+        Z[:, S.index["v1"]] = eq["v1_d"]
+        Z[:, S.index["v2"]] = eq["v2_d"]
+        Z[:, S.index["v3"]] = eq["v3_d"]
+        Z[:, S.index["rp1"]] = eq["rp1_d"]
+        Z[:, S.index["rp2"]] = rp2
+        Z[:, S.index["rp3"]] = self.var["rp3"]
+        Z[:, S.index["mb"]] = eq["mb_d"]
+        Z[:, S.index["theta"]] = eq["theta_d"]
+        Z[:, S.index["psi"]] = self.psi0
+
+        # With the rudder enabled the movable mass holds its rp2
+        controls = {
+            "glide_dir": -np.sign(e_i_d),
+            "mb_d": eq["mb_d"],
+            "rp1_d": eq["rp1_d"],
+            "rp2_d": rp2,
+            "rudder": np.ones(n, dtype=bool),
+            "rudder_angle": np.radians(rudder),
+        }
+
+        return Z, controls
+
+    def fly(self, Z, controls):
+        chunks = np.array_split(np.arange(len(Z)), max(self.workers, 1))
+        jobs = [
+            (self.var, Z[k], {name: value[k] for name, value in controls.items()})
+            for k in chunks
+        ]
+
+        if self.workers > 0:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = list(pool.map(steady_turns, jobs))
+        else:
+            results = [steady_turns(job) for job in jobs]
+
+        values = {
+            name: np.concatenate([v[name] for v, s in results]) for name in QUANTITIES
+        }
+        steady = np.concatenate([s for v, s in results])
+
+        return values, steady
+
+    def save_json(self):
+        table = {
+            "angle_units": "deg",
+            "rudder": RUDDER_ANGLES.tolist(),
+            "rp2": RP2_OFFSETS.tolist(),
+            "glide_angle": GLIDE_ANGLES.tolist(),
+            "speed_d": self.V_d,
+            "steady": self.steady.tolist(),
+        }
+        for name in QUANTITIES:
+            values = self.table[name]
+            if name in ("phi", "theta", "beta", "turn_rate"):
+                values = np.degrees(values)
+            table[name] = {
+                direction: values[k].tolist() for k, direction in enumerate(DIRECTIONS)
+            }
+
+        utils.save_json(table, self.path)
+
+
+class TurnTable:
+    # Lookup of a table written by Turn_Table. Queries take the rudder angle
+    # (rad), rp2 (m) and the signed glide angle (rad, negative diving, as
+    # e_i_d) as scalars or arrays and interpolate linearly; points off the grid
+    # are clamped to its edges. Angles come back in radians, and turns that
+    # rolled over or stalled when the table was made as NaN.
+    def __init__(self, path):
+        data = utils.load_json(path)
+
+        scale = math.pi / 180 if data.get("angle_units", "rad") == "deg" else 1.0
+        self.rudder = np.asarray(data["rudder"], dtype=float) * scale
+        self.rp2 = np.asarray(data["rp2"], dtype=float)
+        self.glide_angle = np.asarray(data["glide_angle"], dtype=float) * scale
+        self.axes = (self.glide_angle, self.rudder, self.rp2)
+
+        self.interpolators = {}
+        for name in QUANTITIES:
+            factor = scale if name in ("phi", "theta", "beta", "turn_rate") else 1.0
+            for direction in DIRECTIONS:
+                values = np.asarray(data[name][direction], dtype=float) * factor
+                self.interpolators[name, direction] = RegularGridInterpolator(
+                    self.axes, values, method="linear"
+                )
+
+    def __call__(self, rudder, rp2, glide_angle, quantities=QUANTITIES):
+        rudder, rp2, glide_angle = np.broadcast_arrays(
+            np.asarray(rudder, dtype=float),
+            np.asarray(rp2, dtype=float),
+            np.asarray(glide_angle, dtype=float),
+        )
+        points = np.stack(
+            [
+                np.clip(np.abs(glide_angle), *self.glide_angle[[0, -1]]),
+                np.clip(rudder, *self.rudder[[0, -1]]),
+                np.clip(rp2, *self.rp2[[0, -1]]),
+            ],
+            axis=-1,
+        )
+        diving = glide_angle < 0
+
+        out = {}
+        for name in quantities:
+            dive = self.interpolators[name, "dive"](points)
+            climb = self.interpolators[name, "climb"](points)
+            out[name] = np.where(diving, dive, climb)
+
+        return out
+
+    def radius(self, rudder, rp2, glide_angle):
+        # Signed turn radius (m), inf for a straight glide
+        curvature = self(rudder, rp2, glide_angle, quantities=("curvature",))
+        with np.errstate(divide="ignore"):
+            return 1 / curvature["curvature"]
+
+
+@lru_cache(maxsize=None)
+def load_turn_table(path):
+    if path is None:
+        return None
+
+    return TurnTable(path)
+
+
+if __name__ == "__main__":
+    Z = Turn_Table()
+    Z.set_desired_trajectory()
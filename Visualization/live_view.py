@@ -0,0 +1,321 @@
+import math
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+
+from State.state_schema import StateSchema
+
+# Frames per second the live view draws at most
+FPS = 10
+
+# Samples the view keeps: when the buffer fills up every other sample is
+# dropped and the stride between kept samples doubles, so the whole run stays
+# on screen and a frame never draws more than CAPACITY points per line
+CAPACITY = 4096
+
+# Seconds between full draws of the figure for new axis limits at most; in
+# between, lines leaving the limits are clipped to their axes
+RESCALE_PERIOD = 2.0
+
+# Simulated time (s) between the states the integrator hands to the view
+SAMPLE_TIME = 1.0
+
+# Batches of states waiting for the view. When it falls behind the integrator
+# keeps its states for the next frame instead of waiting.
+QUEUE_SIZE = 4
+
+# Time series next to the 3D path, those the schema integrates
+TIME_SERIES = ("z", "theta", "phi", "psi", "mb", "rp1")
+DEGREES = ("theta", "phi", "psi")
+LABELS = {
+    "z": "z (m)",
+    "theta": "theta (deg)",
+    "phi": "phi (deg)",
+    "psi": "psi (deg)",
+    "mb": "mb (kg)",
+    "rp1": "rp1 (m)",
+}
+
+
+class DecimatingBuffer:
+    # Rows (time, states) of a run at a fixed capacity. Row k of the stream is
+    # kept when k is a multiple of the stride; the newest row is always kept
+    # apart so the view shows where the glider is now.
+    def __init__(self, capacity, width):
+        self.data = np.empty((capacity - capacity % 2, width))
+        self.size = 0
+        self.count = 0
+        self.stride = 1
+        self.last = None
+
+    def extend(self, rows):
+        rows = np.atleast_2d(rows)
+        if len(rows) == 0:
+            return
+        self.last = rows[-1].copy()
+
+        while len(rows):
+            offset = -self.count % self.stride
+            room = len(self.data) - self.size
+            keep = rows[offset :: self.stride][:room]
+            self.data[self.size : self.size + len(keep)] = keep
+            self.size += len(keep)
+
+            if self.size < len(self.data):
+                self.count += len(rows)
+                break
+
+            # Full: the rows after the last one kept go in after compaction
+            used = offset + (len(keep) - 1) * self.stride + 1
+            self.count += used
+            rows = rows[used:]
+            half = len(self.data) // 2
+            self.data[:half] = self.data[::2]
+            self.size = half
+            self.stride *= 2
+
+    def rows(self):
+        kept = self.data[: self.size]
+        if self.size and kept[-1, 0] == self.last[0]:
+            return kept
+        return np.vstack([kept, self.last])
+
+
+class LiveStream:
+    # Integrator side of the live view, running in its own process (see show).
+    # wrap(fun) returns the right-hand side with one comparison added to each
+    # call: a state at least sample_time after the last one kept is kept, and
+    # the kept states go to the view in one batch per frame. Nothing here
+    # waits for the view until close(). convert maps the integrated states to
+    # the schema's, e.g. a quaternion attitude to Euler angles.
+    def __init__(
+        self, schema, constants=None, fps=FPS, sample_time=SAMPLE_TIME, convert=None
+    ):
+        context = multiprocessing.get_context("spawn")
+        self.queue = context.Queue(QUEUE_SIZE)
+        self.ready = context.Event()
+        self.process = context.Process(
+            target=show, args=(self.queue, self.ready, schema.names, constants, fps)
+        )
+        self.process.start()
+
+        self.period = 1.0 / fps
+        self.sample_time = sample_time
+        self.convert = convert
+        self.pending = []
+        self.t_last = -math.inf
+        self.next_frame = 0.0
+
+    def wrap(self, fun):
+        def live(t, y, *args):
+            if t >= self.t_last + self.sample_time:
+                self.offer(t, y)
+            return fun(t, y, *args)
+
+        return live
+
+    def offer(self, t, y):
+        self.t_last = t
+        if self.convert is not None:
+            y = self.convert(y)
+        self.pending.append(np.concatenate(([t], y)))
+
+        now = time.perf_counter()
+        if now >= self.next_frame:
+            self.next_frame = now + self.period
+            self.flush()
+
+    def record(self, t, y):
+        # States of a segment that was not integrated, e.g. restored from a
+        # checkpoint
+        for k in range(len(t)):
+            if t[k] >= self.t_last + self.sample_time:
+                self.offer(t[k], y[:, k])
+
+    def flush(self):
+        if not self.pending:
+            return
+        try:
+            self.queue.put_nowait(np.array(self.pending))
+            self.pending = []
+        except queue.Full:
+            # The view closed: its states are dropped
+            if not self.process.is_alive():
+                self.pending = []
+
+    def close(self):
+        # The view keeps its window open until it is closed, and the run exits
+        # once it is (or once the view has drawn the last states, headless). A
+        # run shorter than the start of the view waits for it: the queue is
+        # gone once this process exits. A view that is gone does not hold the
+        # exit up.
+        while not self.ready.wait(0.1) and self.process.is_alive():
+            pass
+        try:
+            if self.pending:
+                self.queue.put(np.array(self.pending), timeout=1.0)
+            self.queue.put(None, timeout=1.0)
+        except queue.Full:
+            pass
+        self.pending = []
+        self.queue.cancel_join_thread()
+
+
+class LiveView:
+    # The 3D path and the time series of a run, drawn with blitting: a frame
+    # restores the background saved at the last full draw and draws the lines
+    # on it. The figure is only drawn in full when the data leave the axis
+    # limits, which grow geometrically, and at most every RESCALE_PERIOD.
+    def __init__(self, schema, constants=None, capacity=CAPACITY):
+        import matplotlib.pyplot as plt
+
+        self.schema = schema
+        self.constants = constants or {}
+        self.buffer = DecimatingBuffer(capacity, 1 + schema.size)
+        self.series = [name for name in TIME_SERIES if name in schema.index]
+        self.frames = 0
+        self.full_draws = 0
+        self.background = None
+        self.next_rescale = 0.0
+
+        self.figure = plt.figure(figsize=(12, 7))
+        self.canvas = self.figure.canvas
+        grid = self.figure.add_gridspec(len(self.series), 2, wspace=0.3)
+
+        self.path_axes = self.figure.add_subplot(grid[:, 0], projection="3d")
+        self.path_axes.set_xlabel("x (m)")
+        self.path_axes.set_ylabel("y (m)")
+        self.path_axes.set_zlabel("z (m)")
+        (self.path,) = self.path_axes.plot3D([], [], [], animated=True)
+        (self.head,) = self.path_axes.plot3D([], [], [], "o", animated=True)
+
+        self.axes = []
+        self.lines = []
+        for k, name in enumerate(self.series):
+            ax = self.figure.add_subplot(grid[k, 1])
+            ax.set_ylabel(LABELS[name])
+            if k < len(self.series) - 1:
+                ax.tick_params(labelbottom=False)
+            self.axes.append(ax)
+            self.lines.append(ax.plot([], [], animated=True)[0])
+        self.axes[-1].set_xlabel("time (s)")
+
+        self.clock = self.figure.text(0.01, 0.97, "", animated=True)
+        self.artists = [self.path, self.head, self.clock] + self.lines
+
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        # After a full draw (a resize, a rotation of the 3D axes or new limits)
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.figure.draw_artist(artist)
+
+    def rescale(self, t, x):
+        # New limits for the axes the data left; True when there were any
+        grew = False
+
+        # Time grows to twice the current span
+        t0, t1 = self.axes[0].get_xlim()
+        if t[-1] > t1 or self.full_draws == 0:
+            span = max(t[-1] - t[0], 1.0)
+            for ax in self.axes:
+                ax.set_xlim(t[0], t[0] + 2 * span)
+            grew = True
+
+        limits = [
+            (self.path_axes.get_xlim3d, self.path_axes.set_xlim3d, x["x"], False),
+            (self.path_axes.get_ylim3d, self.path_axes.set_ylim3d, x["y"], False),
+            (self.path_axes.get_zlim3d, self.path_axes.set_zlim3d, x["z"], True),
+        ]
+        for ax, line in zip(self.axes, self.lines):
+            limits.append(
+                (ax.get_ylim, ax.set_ylim, line.get_ydata(), ax is self.axes[0])
+            )
+
+        # Values get a margin of their span on both sides
+        for get, set_limits, values, inverted in limits:
+            low, high = sorted(get())
+            lo, hi = np.nanmin(values), np.nanmax(values)
+            if lo >= low and hi <= high and self.full_draws:
+                continue
+            margin = max(hi - lo, 1e-3 * max(abs(lo), abs(hi)), 1e-3)
+            low, high = lo - margin, hi + margin
+            set_limits((high, low) if inverted else (low, high))
+            grew = True
+
+        return grew
+
+    def extend(self, rows):
+        self.buffer.extend(rows)
+
+    def update(self):
+        if self.buffer.last is None:
+            return
+
+        rows = self.buffer.rows()
+        t = rows[:, 0]
+        x = self.schema.view(rows[:, 1:].T, self.constants)
+
+        self.path.set_data_3d(x["x"], x["y"], x["z"])
+        self.head.set_data_3d(x["x"][-1:], x["y"][-1:], x["z"][-1:])
+        for name, line in zip(self.series, self.lines):
+            values = np.degrees(x[name]) if name in DEGREES else x[name]
+            line.set_data(t, values)
+        self.clock.set_text("t = {:.0f} s".format(t[-1]))
+
+        now = time.perf_counter()
+        due = now >= self.next_rescale
+        if (due and self.rescale(t, x)) or self.background is None:
+            self.next_rescale = now + RESCALE_PERIOD
+            self.full_draws += 1
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_artists()
+            self.canvas.blit(self.figure.bbox)
+        self.canvas.flush_events()
+        self.frames += 1
+
+
+def show(states, ready, names, constants, fps):
+    # The view process: drains the queue, draws at most fps frames per second
+    # and keeps the window open once the run is over
+    ready.set()
+
+    import matplotlib.pyplot as plt
+
+    view = LiveView(StateSchema(names), constants)
+    interactive = view.canvas.required_interactive_framework is not None
+    if interactive:
+        plt.show(block=False)
+
+    period = 1.0 / fps
+    finished = False
+    while not finished and plt.fignum_exists(view.figure.number):
+        start = time.perf_counter()
+        while True:
+            try:
+                rows = states.get_nowait()
+            except queue.Empty:
+                break
+            if rows is None:
+                finished = True
+                break
+            view.extend(rows)
+
+        view.update()
+        wait = period - (time.perf_counter() - start)
+        if not finished and wait > 0:
+            if interactive:
+                view.canvas.start_event_loop(wait)
+            else:
+                time.sleep(wait)
+
+    if finished and interactive:
+        plt.show()
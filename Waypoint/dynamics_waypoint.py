@@ -1,50 +1,125 @@
 import numpy as np
 import math
 import utils
-from Parameters.slocum3D import SLOCUM_PARAMS
+from Control.control_transformation import solve_control_forces
+from Control.scheduler import Task
+from Environment.density import load_density_profile, displaced_mass
+from Hydrodynamics.coefficient_tables import load_hydro_table
+from Environment.currents import load_current_field
+from Parameters.registry import load_glider
+from State.state_schema import STATE_3D
+from State.attitude import (
+    attitude_schema,
+    quaternion_rate,
+    quaternion_rotation,
+    quaternion_to_euler,
+)
+
+# Heading PID towards the desired position (utils.PID gains and time step)
+HEADING_KP = 3.5
+HEADING_KI = 0.0
+HEADING_KD = 0.5
+HEADING_DT = 0.1
+# Rudder change (rad) below which the sampled heading task keeps its held
+# output (Control/scheduler.Task tolerance)
+HEADING_TOLERANCE = 3e-4
+
+
+def desired_heading(desired_pos, x, y):
+    return math.radians(90) - math.atan((desired_pos[0] - x) / (desired_pos[1] - y))
+
+
+def heading(schema, y, psi_d):
+    # psi of state y. A quaternion only gives it to within whole turns: the
+    # turn nearest the desired heading psi_d is taken.
+    if schema is STATE_3D:
+        return y[schema.index["psi"]]
+
+    psi = quaternion_to_euler(schema.get(y, "quaternion"))[2]
+    return psi_d + (psi - psi_d + math.pi) % (2 * math.pi) - math.pi
+
+
+def controller_tasks(var, pid):
+    # Heading PID and ballast pump as discrete-time controllers for
+    # Control/scheduler, at the rates of the glider's CONTROL_PERIODS. Their
+    # held outputs are passed to Dynamics as `held`.
+    integral = pid["psi_prev"]
+    periods = load_glider(var.get("glider", "slocum"), "3D").CONTROL_PERIODS
+    schema = attitude_schema(var.get("attitude", "euler"))
+    i = schema.index
+
+    def heading_control(t, y):
+        nonlocal integral
+        psi_d = desired_heading(var["desired_pos"], y[i["x"]], y[i["y"]])
+        delta, integral, error = utils.PID(
+            HEADING_KP,
+            HEADING_KI,
+            HEADING_KD,
+            psi_d,
+            heading(schema, y, psi_d),
+            integral,
+            periods.HEADING,
+            -y[i["r"]],
+        )
+        return delta
 
+    def ballast(t, y):
+        # Rate that reaches mb_d at the next tick, within the pump rate, so
+        # that the held command does not overshoot
+        limit = abs(var["ballast_rate"])
+        rate = (var["mb_d"] - y[i["mb"]]) / periods.BALLAST
+        return min(max(rate, -limit), limit)
 
-class Dynamics:
-    def __init__(self, z):
-        self.initialization()
-
-        self.n1 = np.array([z[0:3]]).T
-        self.Omega = np.array([z[3:6]]).T
-        self.v = np.array([z[6:9]]).T
-        self.rp = np.array([z[9:12]]).T
-        self.rb = np.array([z[12:15]]).T
-        self.rp_dot = np.array([z[15:18]]).T
-        self.rb_dot = np.array([z[18:21]]).T
-        self.mb = z[21]
-        self.phi = z[24]
-        self.theta = z[25]
-        self.psi = z[26]
+    return [
+        Task("heading", periods.HEADING, heading_control, HEADING_TOLERANCE),
+        Task("ballast", periods.BALLAST, ballast),
+    ]
 
-        self.V = math.sqrt(
-            math.pow(self.v[0][0], 2)
-            + math.pow(self.v[1][0], 2)
-            + math.pow(self.v[2][0], 2)
-        )
 
-        self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()    
-            
-        self.psi_d = math.radians(90) - math.atan((self.desired_pos[0] - self.n1[0])/(self.desired_pos[1] - self.n1[1]))
-                
-        self.delta, self.psi_prev, self.error1 = utils.PID(
-            3.5,
-            0.0,
-            0.5,
-            self.psi_d,
-            self.psi,
-            self.psi_prev,
-            0.1,
-            -self.Omega[2],
-        )
-        
-        pid_vars = {"psi_prev": self.psi_prev}
-        utils.save_json(pid_vars, "vars/pid_variables.json")
+class Dynamics:
+    def __init__(self, var, z, t=0.0, held=None, pid=None, model=None):
+        self.t = t
+
+        self.initialization(var, pid, model)
+
+        self.n1 = self.schema.column(z, "n1")
+        self.Omega = self.schema.column(z, "Omega")
+        self.v = self.schema.column(z, "v")
+        self.rp = self.schema.column(z, "rp")
+        self.rb = np.array([[self.rb1, self.rb2, self.rb3]]).T
+        self.rp_dot = self.schema.column(z, "rp_dot")
+        self.rb_dot = np.zeros((3, 1))
+        self.mb = z[self.schema.index["mb"]]
+        if self.attitude == "quaternion":
+            self.e = self.schema.get(z, "quaternion")
+            self.phi, self.theta, self.psi = quaternion_to_euler(self.e)
+        else:
+            self.phi, self.theta, self.psi = self.schema.get(z, "n2")
+
+        self.g, self.I3, self.Z3, self.i_hat, self.j_hat, self.k_hat = utils.constants()
+
+        self.v_c = self.current_velocity()
+
+        # held: outputs of the sampled-data controllers of controller_tasks
+        if held is None:
+            self.psi_d = desired_heading(self.desired_pos, self.n1[0], self.n1[1])
+
+            self.delta, self.psi_prev, self.error1 = utils.PID(
+                HEADING_KP,
+                HEADING_KI,
+                HEADING_KD,
+                self.psi_d,
+                heading(self.schema, z, self.psi_d),
+                self.psi_prev,
+                HEADING_DT,
+                -self.Omega[2],
+            )
+
+            pid["psi_prev"] = self.psi_prev
+        else:
+            self.delta = held["heading"]
 
-        self.controls = SLOCUM_PARAMS.CONTROLS
+        self.controls = self.model.CONTROLS
 
         self.set_force_torque()
 
@@ -53,19 +128,33 @@ class Dynamics:
 
         self.R, self.R_T = self.transformation()
 
+        self.m = displaced_mass(
+            self.m,
+            self.n1[2][0],
+            self.density,
+            self.rho_ref,
+            self.hull_compressibility,
+            self.g,
+        )
+
         self.m0 = self.mh + self.mw + self.mb + self.mm - self.m
 
-        if self.glide_dir == "U":
+        if held is not None:
+            self.ballast_rate = held["ballast"]
+        elif self.glide_dir == "U":
             if self.mb <= self.mb_d:
                 self.ballast_rate = 0
         elif self.glide_dir == "D":
             if self.mb >= self.mb_d:
                 self.ballast_rate = 0
 
-    def initialization(self):
-        var = utils.load_json("vars/waypoint_glider_variables.json")
-        pid_var = utils.load_json("vars/pid_variables.json")
-
+    def initialization(self, var, pid, model):
+        # var: the glider variables of the model; pid: the heading PID state
+        # of the run, carried from one call to the next and updated in place
+        # (Waypoint_Following.set_variables)
+        self.glider = var.get("glider", "slocum")
+        self.attitude = var.get("attitude", "euler")
+        self.schema = attitude_schema(self.attitude)
         self.pid_control = var["pid_control"]
         self.alpha_d = var["alpha_d"]
         self.beta_d = var["beta_d"]
@@ -85,28 +174,22 @@ class Dynamics:
         self.rb1 = var["rb1"]
         self.rb2 = var["rb2"]
         self.rb3 = var["rb3"]
+        self.rw = np.array([[var["rw1"], var["rw2"], var["rw3"]]]).T
         self.phi0 = var["phi0"]
         self.theta0 = var["theta0"]
         self.psi0 = var["psi0"]
 
-        self.Mf = np.array(var["Mf"])
-        self.M = np.array(var["M"])
-        self.J = np.array(var["J"])
-        self.KL = var["KL"]
-        self.KL0 = var["KL0"]
-        self.KM = var["KM"]
-        self.KM0 = var["KM0"]
-        self.K_beta = var["K_beta"]
-        self.KD = var["KD"]
-        self.KD0 = var["KD0"]
-        self.K_MY = var["K_MY"]
-        self.K_MR = var["K_MR"]
-        self.KOmega11 = var["KOmega11"]
-        self.KOmega12 = var["KOmega12"]
-        self.KOmega13 = var["KOmega13"]
-        self.KOmega21 = var["KOmega21"]
-        self.KOmega22 = var["KOmega22"]
-        self.KOmega23 = var["KOmega23"]
+        # Mass matrices, their inverses and the hydrodynamic coefficients of
+        # the compiled glider model (Parameters/registry.GliderModel)
+        self.model = model or load_glider(self.glider, "3D")
+        self.Mf = self.model.Mf
+        self.M = self.model.M
+        self.J = self.model.J
+        self.M_inv = self.model.M_inv
+        self.J_inv = self.model.J_inv
+        self.__dict__.update(
+            zip(self.model.coefficients, self.model.hydrodynamics.tolist())
+        )
         self.V_d = var["desired_glide_speed"]
         self.ballast_rate = var["ballast_rate"]
         self.mh = var["mh"]
@@ -118,40 +201,72 @@ class Dynamics:
         self.m0 = var["m0"]
         self.mt = var["mt"]
 
+        self.rho_ref = var["rho_ref"]
+        self.hull_compressibility = var["hull_compressibility"]
+        self.density = load_density_profile(var.get("density_file"))
+        self.hydro_table = load_hydro_table(var.get("hydro_table_file"))
+
         self.desired_pos = var["desired_pos"]
 
         self.rudder = var["rudder"]
         self.rudder_angle = var["rudder_angle"]
 
-        self.psi_prev = pid_var["psi_prev"]
+        self.current = load_current_field(var.get("current_file"))
+
+        self.psi_prev = pid["psi_prev"] if pid is not None else None
+
+    def current_velocity(self):
+        if self.current is None:
+            return np.array([self.Z3]).T
+
+        return np.array([self.current.sample(self.t, *self.n1[:, 0])]).T
 
     def set_force_torque(self):
-        self.alpha = math.atan(self.v[2][0] / self.v[0][0])
-        self.beta = math.asin(self.v[1][0] / self.V)
+        # v is the velocity relative to the water, on which the hydrodynamic
+        # forces act; the current only carries the glider along (n1_dot)
+        self.v_r = self.v
+
+        self.V = math.sqrt(
+            math.pow(self.v_r[0][0], 2)
+            + math.pow(self.v_r[1][0], 2)
+            + math.pow(self.v_r[2][0], 2)
+        )
+
+        self.alpha = math.atan(self.v_r[2][0] / self.v_r[0][0])
+        self.beta = math.asin(self.v_r[1][0] / self.V)
 
         KD_delta = 2.0
         KFS_delta = 5.0
         KMY_delta = 1
 
-        L = (self.KL0 + self.KL * self.alpha) * (math.pow(self.V, 2))
-        D = (
-            self.KD0
-            + self.KD * (math.pow(self.alpha, 2))
-            + KD_delta * (math.pow(self.delta, 2))
-        ) * (math.pow(self.V, 2))
-        SF = (self.K_beta * self.beta + KFS_delta * self.delta) * math.pow(self.V, 2)
+        if self.hydro_table is None:
+            CL = self.KL0 + self.KL * self.alpha
+            CD = self.KD0 + self.KD * (math.pow(self.alpha, 2))
+            CM = self.KM0 + self.KM * self.alpha
+        else:
+            CL, CD, CM = self.hydro_table.longitudinal(self.alpha)
+
+        if self.hydro_table is not None and self.hydro_table.CD_delta is not None:
+            CD += self.hydro_table.CD_delta(self.delta)
+        else:
+            CD += KD_delta * (math.pow(self.delta, 2))
+
+        if self.hydro_table is not None and self.hydro_table.lateral:
+            CSF, CMR, CMY = self.hydro_table.lateral_coefficients(
+                self.beta, self.delta
+            )
+        else:
+            CSF = self.K_beta * self.beta + KFS_delta * self.delta
+            CMR = self.K_MR * self.beta
+            CMY = self.K_MY * self.beta + KMY_delta * self.delta
+
+        L = CL * (math.pow(self.V, 2))
+        D = CD * (math.pow(self.V, 2))
+        SF = CSF * math.pow(self.V, 2)
 
-        MDL1 = (self.K_MR * self.beta + self.KOmega11 * self.Omega[0][0]) * math.pow(
-            self.V, 2
-        )
-        MDL2 = (self.KM0 + self.KM * self.alpha + self.KOmega12 * self.Omega[1][0]) * (
-            math.pow(self.V, 2)
-        )
-        MDL3 = (
-            self.K_MY * self.beta
-            + self.KOmega13 * self.Omega[2][0]
-            + KMY_delta * self.delta
-        ) * math.pow(self.V, 2)
+        MDL1 = (CMR + self.KOmega11 * self.Omega[0][0]) * math.pow(self.V, 2)
+        MDL2 = (CM + self.KOmega12 * self.Omega[1][0]) * (math.pow(self.V, 2))
+        MDL3 = (CMY + self.KOmega13 * self.Omega[2][0]) * math.pow(self.V, 2)
 
         self.F_ext = np.array([[-D, SF, -L]]).transpose()  # same as X, Y, Z
 
@@ -171,12 +286,17 @@ class Dynamics:
             [tau1.transpose(), tau2.transpose()], dtype=np.float32
         ).transpose()
 
-        self.J1_n2, self.J2_n2 = utils.transformationMatrix(
-            self.phi, self.theta, self.psi
-        )
+        # The quaternion rates have no singularity at theta = +-90 deg
+        if self.attitude == "quaternion":
+            self.J1_n2 = quaternion_rotation(self.e)
+            self.n2_dot = quaternion_rate(self.e, self.Omega[:, 0])
+        else:
+            self.J1_n2, self.J2_n2 = utils.transformationMatrix(
+                self.phi, self.theta, self.psi
+            )
+            self.n2_dot = self.J2_n2 @ self.Omega
 
-        self.n1_dot = self.J1_n2 @ self.v
-        self.n2_dot = self.J2_n2 @ self.Omega
+        self.n1_dot = self.J1_n2 @ self.v + self.v_c
 
         R = self.J1_n2
         R_T = R.T  # same as np.linalg.inv(self.R)
@@ -211,29 +331,8 @@ class Dynamics:
 
         self.ww = np.array([[0, 0, 0]]).transpose()
 
-        self.F = np.array(
-            [
-                [
-                    np.linalg.inv(self.M)
-                    - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rp_c)
-                    + (1 / self.mm) * self.I3,
-                    np.linalg.inv(self.M)
-                    - self.rp_c @ (np.linalg.inv(self.J)) @ (self.rb_c),
-                ],
-                [
-                    np.linalg.inv(self.M)
-                    - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rp_c),
-                    np.linalg.inv(self.M)
-                    - self.rb_c @ (np.linalg.inv(self.J)) @ (self.rb_c)
-                    + (1 / self.mb) * self.I3,
-                ],
-            ]
-        )
-
-        self.H = np.linalg.inv(self.F)
-
         Zp = (
-            -np.linalg.inv(self.M)
+            -self.M_inv
             @ (
                 np.cross(self.M @ (self.v) + self.Pp + self.Pb, self.Omega, axis=0)
                 + self.m0 * self.g * np.matmul(self.R_T, self.k_hat)
@@ -241,7 +340,7 @@ class Dynamics:
             )
             - np.cross(self.Omega, self.rp_dot, axis=0)
             - np.cross(
-                np.linalg.inv(self.J)
+                self.J_inv
                 @ (
                     np.cross(
                         np.matmul(self.J, self.Omega)
@@ -264,7 +363,7 @@ class Dynamics:
         )
 
         Zb = (
-            -np.linalg.inv(self.M)
+            -self.M_inv
             @ (
                 np.cross(self.M @ (self.v) + self.Pp + self.Pb, self.Omega, axis=0)
                 + self.m0 * self.g * np.matmul(self.R_T, self.k_hat)
@@ -272,7 +371,7 @@ class Dynamics:
             )
             - np.cross(self.Omega, self.rp_dot, axis=0)
             - np.cross(
-                np.linalg.inv(self.J)
+                self.J_inv
                 @ (
                     np.cross(
                         np.matmul(self.J, self.Omega)
@@ -294,16 +393,53 @@ class Dynamics:
             )
         )
 
-        self.H = np.concatenate(
-            (
-                np.concatenate((self.H[0][0], self.H[0][1]), axis=0),
-                np.concatenate((self.H[1][0], self.H[1][1]), axis=0),
-            ),
-            axis=1,
-        )
+        if self.mw != 0:
+            Zw = (
+                -self.M_inv
+                @ (
+                    np.cross(self.M @ (self.v) + self.Pp + self.Pb, self.Omega, axis=0)
+                    + self.m0 * self.g * np.matmul(self.R_T, self.k_hat)
+                    + self.F_ext
+                )
+                - np.cross(self.Omega, self.rp_dot, axis=0)
+                - np.cross(
+                    self.J_inv
+                    @ (
+                        np.cross(
+                            np.matmul(self.J, self.Omega)
+                            + np.matmul(self.rp_c, self.Pp)
+                            + np.matmul(self.rb_c, self.Pb),
+                            self.Omega,
+                            axis=0,
+                        )
+                        + np.cross(np.matmul(self.M, self.v), self.v, axis=0)
+                        + self.T_ext
+                        + np.cross(
+                            np.cross(self.Omega, self.rp, axis=0), self.Pp, axis=0
+                        )
+                        + np.cross(
+                            np.cross(self.Omega, self.rb, axis=0), self.Pb, axis=0
+                        )
+                        + (self.mm * self.rp_c + self.mb * self.rb_c)
+                        * self.g
+                        @ (self.R_T @ self.k_hat)
+                    ),
+                    self.rw,
+                    axis=0,
+                )
+            )
+
+        masses = [self.mm, self.mb]
+        positions = [self.rp, self.rb]
+        rhs = [-Zp + self.wp, -Zb + self.wb]
 
-        self.u = self.H @ np.array(((-Zp + self.wp), (-Zb + self.wb))).ravel()
-        self.u = self.u.reshape(2, 3)
+        if self.mw != 0:
+            masses.append(self.mw)
+            positions.append(self.rw)
+            rhs.append(-Zw + self.ww)
+
+        # Solves F u = rhs without forming or inverting F
+        self.u = solve_control_forces(self.M, self.J, masses, positions, rhs)
 
         self.u_bar = np.array([self.u[0]]).T
 
@@ -360,32 +496,25 @@ class Dynamics:
             - (self.u_b)
         )
 
-        n1_dot = self.R @ self.v
+        n1_dot = self.R @ self.v + self.v_c
 
-        Omega_dot = np.linalg.inv(self.J) @ T_bar
+        Omega_dot = self.J_inv @ T_bar
 
-        v1_dot = np.linalg.inv(self.M) @ F_bar
+        v1_dot = self.M_inv @ F_bar
 
         rp_ddot = self.wp
 
-        rb_ddot = self.wb
-
-        mb_dot = np.array([[self.ballast_rate, 0, 0]]).T
-
-        return np.concatenate(
-            [
-                n1_dot,
-                Omega_dot,
-                v1_dot,
-                self.rp_dot,
-                self.rb_dot,
-                rp_ddot,
-                rb_ddot,
-                mb_dot,
-                self.n2_dot,
-                np.array([[math.degrees(self.delta), 0.0, 0.0]]).T,
-            ]
-        ).ravel()
+        return self.schema.pack(
+            {
+                "n1": n1_dot,
+                "Omega": Omega_dot,
+                "v": v1_dot,
+                "rp": self.rp_dot,
+                "rp_dot": rp_ddot,
+                "mb": self.ballast_rate,
+                "quaternion" if self.attitude == "quaternion" else "n2": self.n2_dot,
+            }
+        )
 
 
 if __name__ == "__main__":
@@ -2,6 +2,14 @@ import argparse
 from Modeling2d.glider_model_2D import Vertical_Motion
 from Modeling3d.glider_model_3D import ThreeD_Motion
 from Waypoint.glider_model_waypoint import Waypoint_Following
+from Fleet.glider_fleet import Fleet_Motion
+from Sensitivity.parameter_sensitivity import Sensitivity_Analysis
+from Identification.parameter_identification import Parameter_Identification
+from Turning.turn_table import Turn_Table
+from Energy.energy_budget import Energy_Budget
+from Numerics.tolerance_tuning import Tolerance_Tuning
+from Numerics.work_precision import Work_Precision
+from Batch.batch_runner import Batch_Runner
 from Parameters.slocum import SLOCUM_PARAMS
 from Parameters.slocum3D import SLOCUM_PARAMS as params_3D
 
@@ -13,28 +21,49 @@ def main(args):
         Z = ThreeD_Motion(args)
     elif args.mode == "waypoint":
         Z = Waypoint_Following(args)
+    elif args.mode == "fleet":
+        Z = Fleet_Motion(args)
+    elif args.mode == "sensitivity":
+        Z = Sensitivity_Analysis(args)
+    elif args.mode == "identify":
+        Z = Parameter_Identification(args)
+    elif args.mode == "turntable":
+        Z = Turn_Table(args)
+    elif args.mode == "energy":
+        Z = Energy_Budget(args)
+    elif args.mode == "tolerances":
+        Z = Tolerance_Tuning(args)
+    elif args.mode == "benchmark":
+        Z = Work_Precision(args)
+    elif args.mode == "batch":
+        Z = Batch_Runner(args)
     Z.set_desired_trajectory()
 
 
-if __name__ == "__main__":
+def argument_parser():
     parser = argparse.ArgumentParser(
         description="An Autonomous Underwater Glider Simulator."
     )
     parser.add_argument(
         "-i", "--info", help="give full information in each cycle", action="store_true"
     )
-    parser.add_argument("-m", "--mode", help="set mode as 2D, 3D, or waypoint", default="2D")
+    parser.add_argument(
+        "-m",
+        "--mode",
+        help="set mode as 2D, 3D, waypoint, fleet, sensitivity, identify, turntable, energy, tolerances, benchmark, or batch",
+        default="2D",
+    )
     parser.add_argument(
         "-c",
         "--cycle",
-        help="number of desired cycles in sawtooth trajectory",
+        help="number of desired cycles in sawtooth trajectory, or of yos flown in full to check the estimate in energy mode",
         default=4,
         type=int,
     )
     parser.add_argument(
         "-g",
         "--glider",
-        help="desired glider model ['slocum']",
+        help="glider model: a registered one ['slocum', 'seaglider'] or the path of a glider definition (.py, .toml or .yaml)",
         default=("slocum"),
     )
     parser.add_argument(
@@ -57,6 +86,18 @@ if __name__ == "__main__":
         help="enable or disable PID pitch control",
         default="disable",
     )
+    parser.add_argument(
+        "-ct",
+        "--control",
+        help="controllers: continuous (evaluated in the equations of motion) or sampled (discrete-time tasks at their own rates, outputs held between ticks) in 2D and waypoint modes. Sampled control is for fidelity, not speed: a held output that changes at a tick restarts the solver there. The waypoint heading is only changed when it moves by more than 3e-4 rad",
+        default="continuous",
+    )
+    parser.add_argument(
+        "-at",
+        "--attitude",
+        help="attitude states in 3D and waypoint modes: euler (phi, theta, psi) or quaternion (no singularity at theta = +-90 deg, output still in Euler angles)",
+        default="euler",
+    )
     parser.add_argument(
         "-r",
         "--rudder",
@@ -70,6 +111,147 @@ if __name__ == "__main__":
         default=params_3D.VARIABLES.RUDDER,
         type=float,
     )
+    parser.add_argument(
+        "-cf",
+        "--current",
+        help="path to a gridded ocean current field header (JSON). Defaults to still water",
+        default=None,
+    )
+    parser.add_argument(
+        "-dp",
+        "--density",
+        help="path to a CTD-style density profile (CSV: depth, density[, temperature, salinity]). Defaults to uniform water",
+        default=None,
+    )
+    parser.add_argument(
+        "-ht",
+        "--hydrotable",
+        help="path to hydrodynamic coefficient tables over alpha, beta and rudder angle (JSON). Defaults to the linear model",
+        default=None,
+    )
+    parser.add_argument(
+        "-fl",
+        "--fleet",
+        help="path to a fleet description (JSON) for fleet mode",
+        default=None,
+    )
+    parser.add_argument(
+        "-n",
+        "--gliders",
+        help="number of gliders in fleet mode when no fleet file is given",
+        default=20,
+        type=int,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="output sampling: fixed (evenly spaced) or adaptive (more points where the trajectory changes, dense output kept)",
+        default="fixed",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="worker processes for parallel-in-time (parareal) integration of the 2D cycles, for the log segments in identify mode, for the turns in turntable mode, or for the jobs in batch mode. 0 works in the main process. Parareal flies the 2D legs at the tolerances of -w 0 and converges to them. On an 8 cycle mission that takes all 8 iterations, so it is not faster than -w 0",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "-lg",
+        "--log",
+        help="path to a glider log (CSV: time, depth, pitch, roll, heading, pump, battery) for identify mode",
+        default=None,
+    )
+    parser.add_argument(
+        "-sg",
+        "--segment",
+        help="length in seconds of the log segments flown from logged initial states in identify mode",
+        default=100.0,
+        type=float,
+    )
+    parser.add_argument(
+        "-pm",
+        "--parammodule",
+        help="parameter module written by identify mode",
+        default="Parameters/identified.py",
+    )
+    parser.add_argument(
+        "-pg",
+        "--propagation",
+        help="fleet propagation: full (dynamics throughout), hybrid (settled straight glides moved on kinematically) or compare (hybrid, checked against full)",
+        default="full",
+    )
+    parser.add_argument(
+        "-tt",
+        "--turntable",
+        help="turn performance table (JSON) written in turntable mode (default vars/turn_table.json) and used by fleet mode to size the waypoint capture radius",
+        default=None,
+    )
+    parser.add_argument(
+        "-tl",
+        "--tolerances",
+        help="per-state solver tolerance scales (JSON) written in tolerances mode (default vars/tolerances.json) and used by the 2D, 3D, waypoint, fleet and energy modes. Defaults to the scales in State/tolerances.py",
+        default=None,
+    )
+    parser.add_argument(
+        "-sm",
+        "--solver",
+        help="integration method of the 2D, 3D and waypoint modes: RK45 (default), RK23, DOP853, Radau, BDF or LSODA, optionally with its relative tolerance (DOP853:1e-6), or RK4 with its fixed step in seconds (RK4:0.5). The benchmark mode compares them",
+        default=None,
+    )
+    parser.add_argument(
+        "-wp",
+        "--waypoint",
+        help="target of the waypoint mode, x,y,z in m",
+        default="200,70,60",
+    )
+    parser.add_argument(
+        "-mf",
+        "--manifest",
+        help="scenario manifest (TOML or JSON) run by batch mode, with the -w worker processes. Each job runs in its own directory, next to the manifest under its name without extension, and the batch resumes after the jobs already done",
+        default=None,
+    )
+    parser.add_argument(
+        "-th",
+        "--threads",
+        help="run the jobs of batch mode as -w threads of one process instead of worker processes (2D, 3D, waypoint and fleet jobs). The simulations hold the GIL, so threads are slower than processes and only help jobs that mostly wait on I/O",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-mp",
+        "--mission",
+        help="path to a mission plan (JSON) for energy mode. Defaults to 30 days of yos between 5 and 100 m",
+        default=None,
+    )
+    parser.add_argument(
+        "-ck",
+        "--checkpoints",
+        help="directory of segment checkpoints (2D cycles, fleet windows, energy mode legs). Segments whose inputs are unchanged since an earlier run are restored instead of flown again",
+        default=None,
+    )
+    parser.add_argument(
+        "-tf",
+        "--trajectory",
+        help="write the output times and states of a 2D, 3D or waypoint run to this trajectory file (JSON header and .npy data) for Analysis/trajectory_analysis.py. With -rc or -rs, the recorded channels of these and of fleet mode instead (one .npy per channel)",
+        default=None,
+    )
+    parser.add_argument(
+        "-rc",
+        "--record",
+        help="channels recorded in 2D, 3D, waypoint and fleet modes, comma separated, each optionally keeping one sample in N (psi:10): states (x, psi, mb, ...), state vectors (n1, v, ...) or flight quantities (V, alpha, beta, gamma, course, psi_dot, turn_radius). Defaults to every state",
+        default=None,
+    )
+    parser.add_argument(
+        "-rs",
+        "--storage",
+        help="storage of the recorded channels: float64 (default), float32, or int16 or int32 quantized over the range of each channel",
+        default=None,
+    )
+    parser.add_argument(
+        "-lv",
+        "--live",
+        help="show the path and the main states of a 2D, 3D or waypoint run live while it is integrated",
+        action="store_true",
+    )
     parser.add_argument(
         "-p",
         "--plot",
@@ -78,6 +260,10 @@ if __name__ == "__main__":
         nargs="*",
     )
 
-    args = parser.parse_args()
+    return parser
+
+
+if __name__ == "__main__":
+    args = argument_parser().parse_args()
 
     main(args)
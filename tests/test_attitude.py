@@ -0,0 +1,130 @@
+import numpy as np
+from scipy.integrate import solve_ivp
+
+import utils
+from Modeling3d.batch_dynamics import rotation
+from State.attitude import (
+    euler_states,
+    euler_to_quaternion,
+    quaternion_rate,
+    quaternion_rotation,
+    quaternion_states,
+    quaternion_to_euler,
+)
+from State.recording import DenseTrajectory
+from State.state_schema import FULL_LAYOUT, STATE_3D, STATE_3D_QUATERNION
+
+
+def attitudes(seed, n=20):
+    rng = np.random.default_rng(seed)
+    return zip(
+        rng.uniform(-1.2, 1.2, n), rng.uniform(-1.4, 1.4, n), rng.uniform(-3, 3, n)
+    )
+
+
+def test_quaternion_rotation_matches_euler_rotation():
+    for phi, theta, psi in attitudes(0):
+        R = quaternion_rotation(euler_to_quaternion(phi, theta, psi))
+
+        np.testing.assert_allclose(
+            R, utils.transformationMatrix(phi, theta, psi)[0], atol=1e-14
+        )
+        np.testing.assert_allclose(R, rotation(phi, theta, psi), atol=1e-14)
+
+
+def test_quaternion_to_euler_inverts_euler_to_quaternion():
+    for n2 in attitudes(1):
+        np.testing.assert_allclose(
+            quaternion_to_euler(euler_to_quaternion(*n2)), n2, atol=1e-12
+        )
+
+
+def test_quaternion_rate_is_the_rate_of_the_euler_angles():
+    # d/dt e(n2) = de/dn2 J2(n2) Omega, with de/dn2 by central differences
+    rng = np.random.default_rng(2)
+    h = 1e-6
+    for n2 in attitudes(2):
+        n2 = np.array(n2)
+        Omega = rng.normal(scale=0.1, size=3)
+        n2_dot = utils.transformationMatrix(*n2)[1] @ Omega
+        de = np.array(
+            [
+                (
+                    euler_to_quaternion(*(n2 + h * k))
+                    - euler_to_quaternion(*(n2 - h * k))
+                )
+                / (2 * h)
+                for k in np.eye(3)
+            ]
+        ).T
+
+        np.testing.assert_allclose(
+            quaternion_rate(euler_to_quaternion(*n2), Omega), de @ n2_dot, atol=1e-9
+        )
+
+
+def test_integrated_quaternion_follows_the_euler_angles():
+    # Body rates that turn a glider through a spiral, integrated both ways
+    def Omega(t):
+        return np.array([0.02 * np.sin(0.3 * t), 0.01 * np.cos(0.2 * t), 0.05])
+
+    def euler(t, n2):
+        return utils.transformationMatrix(*n2)[1] @ Omega(t)
+
+    def quaternion(t, e):
+        return quaternion_rate(e, Omega(t))
+
+    n2_0 = np.array([0.1, -0.4, 0.3])
+    t_eval = np.linspace(0.0, 100.0, 11)
+    options = {"rtol": 1e-10, "atol": 1e-12, "t_eval": t_eval}
+    n2 = solve_ivp(euler, (0.0, 100.0), n2_0, **options).y
+    e = solve_ivp(quaternion, (0.0, 100.0), euler_to_quaternion(*n2_0), **options).y
+
+    np.testing.assert_allclose(np.linalg.norm(e, axis=0), 1.0, atol=1e-9)
+    angles = quaternion_to_euler(e)
+    angles[2] = np.unwrap(angles[2])
+    angles[2] += 2 * np.pi * np.round((n2[2, 0] - angles[2, 0]) / (2 * np.pi))
+    np.testing.assert_allclose(angles, n2, atol=1e-7)
+
+
+def test_quaternion_layout_keeps_the_other_states():
+    rng = np.random.default_rng(3)
+    y = rng.normal(size=(STATE_3D.size, 4))
+    y[STATE_3D.index["theta"]] = rng.uniform(-1.2, 1.2, 4)
+    y[STATE_3D.index["phi"]] = rng.uniform(-1.0, 1.0, 4)
+    y[STATE_3D.index["psi"]] = rng.uniform(-3.0, 3.0, 4)
+
+    q = quaternion_states(y)
+    n = STATE_3D.index["phi"]
+
+    np.testing.assert_array_equal(q[:n], y[:n])
+    np.testing.assert_allclose(euler_states(q[:, 0]), y[:, 0], atol=1e-12)
+
+    full = STATE_3D_QUATERNION.unpack(q[:, 0])
+    for name in STATE_3D_QUATERNION.names:
+        assert full[FULL_LAYOUT.index(name)] == q[STATE_3D_QUATERNION.index[name], 0]
+
+
+def test_resampled_quaternion_heading_stays_on_the_run_branch():
+    # A spiral at a constant yaw rate, flown in a window that starts after
+    # several turns: the heading read back from the dense output at sparse
+    # times keeps counting the turns from the window's psi0
+    r, psi0 = 0.05, 4 * np.pi + 0.3
+    schema = STATE_3D_QUATERNION
+    y0 = np.zeros(schema.size)
+    y0[schema.index["r"]] = r
+    y0[schema.slice("quaternion")] = euler_to_quaternion(0.0, 0.0, psi0)
+
+    def fun(t, y):
+        dy = np.zeros_like(y)
+        dy[schema.slice("quaternion")] = quaternion_rate(
+            y[schema.slice("quaternion")], [0.0, 0.0, r]
+        )
+        return dy
+
+    sol = solve_ivp(fun, (0.0, 500.0), y0, rtol=1e-10, atol=1e-12, dense_output=True)
+    dense = DenseTrajectory(euler_states)
+    dense.append(sol, psi0)
+
+    t = np.linspace(0.0, 500.0, 7)
+    np.testing.assert_allclose(dense(t)[STATE_3D.index["psi"]], psi0 + r * t, atol=1e-7)
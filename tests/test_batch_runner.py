@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+import Batch.batch_runner as batch_runner
+from Batch.batch_runner import Batch_Runner, run_job
+from main import argument_parser
+
+
+class Interrupted(Exception):
+    pass
+
+
+def write_manifest(path, angles):
+    manifest = {
+        "defaults": {"mode": "2D", "cycle": 1},
+        "scenario": [{"name": "dive", "angle": angles}, {"name": "bad", "speed": "x"}],
+    }
+    path.write_text(json.dumps(manifest))
+
+    return str(path)
+
+
+def batch(manifest):
+    runner = Batch_Runner(
+        argument_parser().parse_args(["-m", "batch", "-mf", manifest])
+    )
+    ran = []
+
+    def job(job):
+        ran.append(job[0])
+        return run_job(job)
+
+    return runner, ran, job
+
+
+def test_an_interrupted_batch_resumes_with_the_jobs_not_done(tmp_path, monkeypatch):
+    manifest = write_manifest(tmp_path / "batch.json", [20, 30])
+
+    # Interrupted after its first job: the ledger already holds it
+    runner, ran, job = batch(manifest)
+
+    def interrupted(settings):
+        if ran:
+            raise Interrupted
+        return job(settings)
+
+    monkeypatch.setattr(batch_runner, "run_job", interrupted)
+    with pytest.raises(Interrupted):
+        runner.set_desired_trajectory()
+    assert ran == ["dive-angle=20"]
+
+    runner, ran, job = batch(manifest)
+    monkeypatch.setattr(batch_runner, "run_job", job)
+    runner.set_desired_trajectory()
+    assert ran == ["dive-angle=30", "bad"]
+    status = {name: entry["status"] for name, entry in runner.ledger.items()}
+    assert status == {"dive-angle=20": "done", "dive-angle=30": "done", "bad": "failed"}
+
+    # Failed jobs are run again, and so are jobs whose settings changed
+    manifest = write_manifest(tmp_path / "batch.json", [20, 25])
+    runner, ran, job = batch(manifest)
+    monkeypatch.setattr(batch_runner, "run_job", job)
+    assert runner.pending() == ["dive-angle=25", "bad"]
+    runner.set_desired_trajectory()
+    assert ran == ["dive-angle=25", "bad"]
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from State.channels import ChannelRecorder, Recording, pack, parse_channels
+from State.state_schema import STATE_2D
+
+
+def states(n, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0.0, 400.0, n)
+    y = (
+        rng.normal(size=(STATE_2D.size, n))
+        * np.linspace(0.1, 100.0, STATE_2D.size)[:, None]
+    )
+
+    return t, y
+
+
+def record(path, storage, spec, windows):
+    recorder = ChannelRecorder(parse_channels(spec, STATE_2D), STATE_2D, {}, storage)
+    for t, y in windows:
+        recorder.append(t, y)
+    recorder.close(str(path))
+
+    return Recording(str(path))
+
+
+@pytest.mark.parametrize("storage", ["int8", "int16", "int32"])
+def test_packed_channels_are_restored_to_their_resolution(tmp_path, storage):
+    t, y = states(300)
+    recording = record(tmp_path / "run.json", storage, "x,z,theta", [(t, y)])
+
+    for name in ("x", "z", "theta"):
+        value = y[STATE_2D.index[name]].astype(np.float32)
+        scale = recording.channels[name]["scale_factor"]
+        assert recording[name].dtype == float
+        assert np.max(np.abs(recording[name] - value)) <= 0.5 * scale * (1 + 1e-6)
+        assert recording[name].min() == pytest.approx(value.min(), abs=1e-6 * scale)
+        assert recording[name].max() == pytest.approx(value.max(), abs=1e-6 * scale)
+
+
+def test_decimated_channels_count_samples_over_the_whole_run(tmp_path):
+    # Two windows of 7 and 8 samples; every 3rd sample of the run is kept
+    t, y = states(15)
+    windows = [(t[:7], y[:, :7]), (t[7:], y[:, 7:])]
+    recording = record(tmp_path / "run.json", "float64", "x:3,z", windows)
+
+    np.testing.assert_array_equal(recording.times("x"), t[::3])
+    np.testing.assert_array_equal(recording["x"], y[STATE_2D.index["x"], ::3])
+    np.testing.assert_array_equal(recording["z"], y[STATE_2D.index["z"]])
+
+
+def test_nan_is_kept_through_packing():
+    value = np.array([1.0, np.nan, 3.0, 2.0])
+    packed, packing = pack(value, "int16")
+    unpacked = packing["add_offset"] + packing["scale_factor"] * packed
+    unpacked = np.where(packed == np.iinfo(np.int16).max, np.nan, unpacked)
+
+    np.testing.assert_allclose(unpacked, value, rtol=0, atol=1e-12)
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+
+from main import argument_parser
+from Modeling2d.glider_model_2D import Vertical_Motion
+from State.checkpoints import SegmentCache, file_signature
+
+
+def fly_segments(cache, inputs):
+    flown = []
+    results = [
+        cache.run(segment, lambda: flown.append(k) or k)
+        for k, segment in enumerate(inputs)
+    ]
+
+    return results, flown
+
+
+def test_a_changed_segment_is_flown_again_with_the_ones_after_it(tmp_path):
+    fly_segments(
+        SegmentCache(str(tmp_path), {"run": 1}), [{"leg": k} for k in range(4)]
+    )
+
+    results, flown = fly_segments(
+        SegmentCache(str(tmp_path), {"run": 1}), [{"leg": k} for k in range(4)]
+    )
+    assert results == [0, 1, 2, 3] and flown == []
+
+    # Segment 2 is changed: segments 0 and 1 are restored, 2 and 3 flown
+    inputs = [{"leg": 0}, {"leg": 1}, {"leg": 2.5}, {"leg": 3}]
+    results, flown = fly_segments(SegmentCache(str(tmp_path), {"run": 1}), inputs)
+    assert results == [0, 1, 2, 3] and flown == [2, 3]
+
+    # Other run inputs change the key of every segment
+    results, flown = fly_segments(
+        SegmentCache(str(tmp_path), {"run": 2}), [{"leg": k} for k in range(4)]
+    )
+    assert flown == [0, 1, 2, 3]
+
+
+def test_an_edited_input_file_invalidates_the_checkpoints(tmp_path):
+    path = tmp_path / "density.txt"
+    path.write_text("0 1025\n")
+    signature = file_signature(str(path))
+    cache = SegmentCache(str(tmp_path / "checkpoints"), {"files": [signature]})
+    fly_segments(cache, [{"leg": 0}])
+
+    path.write_text("0 1026\n")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    cache = SegmentCache(
+        str(tmp_path / "checkpoints"), {"files": [file_signature(str(path))]}
+    )
+    assert fly_segments(cache, [{"leg": 0}])[1] == [0]
+
+
+def test_2D_cycles_are_restored_unchanged(tmp_path, capsys):
+    def run(*options):
+        args = ["-m", "2D", "-c", "2", "-ck", str(tmp_path), *options]
+        model = Vertical_Motion(argument_parser().parse_args(args))
+        model.set_glide_angles()
+        model.solve_cycles()
+        report = capsys.readouterr().out.splitlines()[-1]
+
+        return model.solver_array, report
+
+    flown, report = run()
+    assert report.startswith("Checkpoints: 0 of 2 cycles restored")
+
+    restored, report = run()
+    assert report.startswith("Checkpoints: 2 of 2 cycles restored")
+    np.testing.assert_array_equal(restored, flown)
+
+    # A different solver setting is part of the key
+    _, report = run("-sm", "RK45:1e-5")
+    assert report.startswith("Checkpoints: 0 of 2 cycles restored")
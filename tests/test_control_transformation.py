@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from Control.control_transformation import (
+    solve_control_forces,
+    solve_control_forces_batch,
+)
+
+
+def skew(r):
+    return np.array([[0.0, -r[2], r[1]], [r[2], 0.0, -r[0]], [-r[1], r[0], 0.0]])
+
+
+def direct_solve(M, J, masses, positions, rhs):
+    # The block matrix of control_transformation, built and solved as a whole:
+    #   F_ij = inv(M) + delta_ij I / m_i - r_i^ inv(J) r_j^
+    M_inv, J_inv = np.linalg.inv(M), np.linalg.inv(J)
+    n = len(masses)
+    F = np.zeros((3 * n, 3 * n))
+    for i in range(n):
+        for j in range(n):
+            block = M_inv - skew(positions[i]) @ J_inv @ skew(positions[j])
+            if i == j:
+                block = block + np.eye(3) / masses[i]
+            F[3 * i : 3 * i + 3, 3 * j : 3 * j + 3] = block
+
+    u = np.linalg.solve(F, np.concatenate(rhs))
+    return [u[3 * i : 3 * i + 3] for i in range(n)]
+
+
+def glider(rng, n):
+    M = np.diag(rng.uniform(50.0, 80.0, 3))
+    J = np.diag(rng.uniform(2.0, 12.0, 3))
+    masses = list(rng.uniform(1.0, 15.0, n))
+    positions = [rng.uniform(-0.3, 0.3, 3) for _ in range(n)]
+    rhs = [rng.normal(size=3) for _ in range(n)]
+
+    return M, J, masses, positions, rhs
+
+
+@pytest.mark.parametrize("n", [2, 3])
+def test_schur_solve_matches_direct_block_solve(n):
+    rng = np.random.default_rng(n)
+    for _ in range(20):
+        M, J, masses, positions, rhs = glider(rng, n)
+
+        expected = direct_solve(M, J, masses, positions, rhs)
+        u = solve_control_forces(M, J, masses, positions, rhs)
+
+        np.testing.assert_allclose(u, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_cached_fixed_masses_give_the_same_forces():
+    # Only the first mass moves; the blocks of the others come from the cache
+    rng = np.random.default_rng(7)
+    M, J, masses, positions, rhs = glider(rng, 3)
+
+    first = solve_control_forces(M, J, masses, positions, rhs, moving=1)
+    again = solve_control_forces(M, J, masses, positions, rhs, moving=1)
+    full = solve_control_forces(M, J, masses, positions, rhs, moving=3)
+
+    np.testing.assert_array_equal(first, again)
+    np.testing.assert_allclose(first, full, rtol=1e-12, atol=1e-14)
+
+
+def test_batch_solve_matches_scalar_solve():
+    rng = np.random.default_rng(11)
+    n = 5
+    gliders = [glider(rng, 3) for _ in range(n)]
+
+    M = np.array([g[0] for g in gliders])
+    J = np.array([g[1] for g in gliders])
+    masses = [np.array([g[2][i] for g in gliders]) for i in range(3)]
+    positions = [np.array([g[3][i] for g in gliders]) for i in range(3)]
+    rhs = [np.array([g[4][i] for g in gliders]) for i in range(3)]
+
+    u = solve_control_forces_batch(M, J, masses, positions, rhs)
+    for k, g in enumerate(gliders):
+        expected = direct_solve(*g)
+        np.testing.assert_allclose(
+            [u_i[k] for u_i in u], expected, rtol=1e-10, atol=1e-12
+        )
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from Environment.currents import save_current_field
+from main import argument_parser
+from Modeling3d.batch_dynamics import BatchDynamics
+from Modeling3d.dynamics_3D import Dynamics as Dynamics3D
+from Modeling3d.glider_model_3D import ThreeD_Motion
+from State.state_schema import STATE_3D
+from Waypoint.dynamics_waypoint import Dynamics as DynamicsWaypoint
+from Waypoint.glider_model_waypoint import Waypoint_Following
+
+# A horizontal current, so that the glider stays at the depths (and in the
+# water density) of its still-water track
+CURRENT = np.array([0.05, 0.1, 0.0])
+
+
+@pytest.fixture
+def uniform_current(tmp_path):
+    path = str(tmp_path / "current.json")
+    u = np.broadcast_to(CURRENT, (2, 2, 2, 2, 3))
+    save_current_field(path, u, origin=[0, -1e4, -1e4, -1e3], spacing=[1e4] * 4)
+
+    return path
+
+
+def trimmed_glider(model_class, mode, current=None, options=()):
+    options = ["-m", mode, *options] + ([] if current is None else ["-cf", current])
+    model = model_class(argument_parser().parse_args(options))
+    model.set_glide_angles()
+    model.set_cycle(0, 0.0)
+    model.set_variables()
+
+    return model
+
+
+def test_glider_drifts_with_a_uniform_current(uniform_current):
+    # v is the velocity relative to the water: in a uniform current the
+    # glider flies its still-water spiral and drifts along at the current.
+    # RK4 at a fixed step takes the same steps in both runs.
+    t = np.linspace(0.0, 200.0, 11)
+    runs = []
+    for current in (None, uniform_current):
+        model = trimmed_glider(ThreeD_Motion, "3D", current, ["-sm", "RK4:1"])
+        sol, _ = model.solve_ode(model.initial_state(), t)
+        runs.append(sol.y)
+
+    still, drifting = runs
+    n1 = STATE_3D.slice("n1")
+    np.testing.assert_allclose(
+        drifting[n1] - still[n1], np.outer(CURRENT, t), rtol=0, atol=1e-9
+    )
+    np.testing.assert_allclose(
+        np.delete(drifting, n1, axis=0), np.delete(still, n1, axis=0), atol=1e-12
+    )
+
+
+def test_current_only_adds_to_the_position_rate(uniform_current):
+    # The same convention in the 3D, waypoint and batch dynamics
+    def rates(current):
+        model = trimmed_glider(ThreeD_Motion, "3D", current)
+        z = model.initial_state()
+        yield Dynamics3D(model.var, z, 10.0, model=model.params).set_eom()
+        batch = BatchDynamics(model.var, 2, model=model.params)
+        yield from batch.set_eom(10.0, np.array([z, z]))
+
+        model = trimmed_glider(Waypoint_Following, "waypoint", current)
+        pid = {"psi_prev": model.psi0}
+        z = model.initial_state()
+        yield DynamicsWaypoint(
+            model.var, z, 10.0, pid=pid, model=model.params
+        ).set_eom()
+
+    expected = np.zeros(STATE_3D.size)
+    expected[STATE_3D.slice("n1")] = CURRENT
+    for still, drifting in zip(rates(None), rates(uniform_current)):
+        np.testing.assert_allclose(
+            np.ravel(drifting) - np.ravel(still), expected, atol=1e-12
+        )
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from main import argument_parser
+from Modeling2d.dynamics_2D import Dynamics
+from Modeling2d.glider_model_2D import Vertical_Motion
+from Modeling2d.planar_dynamics import PlanarDynamics
+from State.state_schema import STATE_2D
+
+
+def glider_variables(pid, leg):
+    model = Vertical_Motion(argument_parser().parse_args(["-m", "2D", "-pid", pid]))
+    model.set_glide_angles()
+    model.set_leg(leg, 0.0)
+
+    return model.glider_variables(), model.initial_state()
+
+
+def states(z0, seed, n=10):
+    # Steady-glide start and states around it, with the moving mass and the
+    # ballast on either side of their targets
+    rng = np.random.default_rng(seed)
+    scale = np.abs(z0) * 0.2 + 0.01
+    yield z0
+    for _ in range(n):
+        yield z0 + rng.normal(size=z0.size) * scale
+
+
+@pytest.mark.parametrize("pid", ["disable", "enable"])
+@pytest.mark.parametrize("leg", [0, 1])
+def test_planar_kernel_matches_the_2D_dynamics(pid, leg):
+    var, z0 = glider_variables(pid, leg)
+    kernel = PlanarDynamics(var)
+
+    for z in states(z0, leg):
+        expected = Dynamics(var, z, {"theta_prev": 0.0}).set_eom()
+
+        np.testing.assert_allclose(
+            kernel.set_eom(0.0, z), expected, rtol=1e-9, atol=1e-12
+        )
+
+
+def test_batch_kernel_matches_the_single_glider_kernel():
+    var, z0 = glider_variables("disable", 0)
+    Z = np.array(list(states(z0, 5, n=7)))
+
+    batch = PlanarDynamics(var, len(Z)).set_eom(0.0, Z.ravel())
+    single = [PlanarDynamics(var).set_eom(0.0, z) for z in Z]
+
+    np.testing.assert_allclose(batch, np.ravel(single), rtol=1e-12, atol=1e-14)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from Control.scheduler import Scheduler, Task
+
+
+def test_outputs_are_held_between_ticks():
+    # y' = u with u = -y / 2 sampled every second: the held rate halves y
+    # over each tick, which RK45 integrates exactly
+    scheduler = Scheduler([Task("u", 1.0, lambda t, y: -0.5 * y)])
+    t = np.arange(11.0)
+    sol = scheduler.solve(
+        lambda t, y: scheduler.held["u"], (0.0, 10.0), [1.0], t_eval=t
+    )
+
+    np.testing.assert_allclose(sol.y[0], 0.5**t, rtol=1e-12)
+    np.testing.assert_allclose(sol.outputs["u"][:, 0], -(0.5 ** (t + 1)), rtol=1e-12)
+
+
+def test_outputs_within_the_tolerance_are_not_applied():
+    # The law moves by 1e-3 per tick; with a tolerance of 1.05e-2 the held
+    # output is only replaced once it has moved by more, at t = 11 and 22
+    def law(t, y):
+        return np.array([1.0 + 1e-3 * t])
+
+    scheduler = Scheduler([Task("u", 1.0, law, tolerance=1.05e-2)])
+    t = np.arange(31.0)
+    sol = scheduler.solve(
+        lambda t, y: scheduler.held["u"], (0.0, 30.0), [0.0], t_eval=t
+    )
+
+    held = np.select([t >= 22, t >= 11], [1.022, 1.011], 1.0)
+    np.testing.assert_allclose(sol.outputs["u"][:, 0], held, rtol=1e-12)
+    np.testing.assert_allclose(sol.y[0], np.cumsum(np.r_[0.0, held[:-1]]), rtol=1e-12)
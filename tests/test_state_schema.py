@@ -0,0 +1,66 @@
+import numpy as np
+
+from State.state_schema import FULL_LAYOUT, STATE_2D, STATE_3D
+
+RB = {"rb1": 0.02, "rb2": 0.0, "rb3": 0.05}
+
+
+def test_reduced_states_sit_at_their_full_layout_entries():
+    rng = np.random.default_rng(0)
+    for schema in (STATE_3D, STATE_2D):
+        y = rng.normal(size=schema.size)
+        full = schema.unpack(y, RB)
+
+        assert full.shape == (len(FULL_LAYOUT),)
+        for name in schema.names:
+            assert full[FULL_LAYOUT.index(name)] == y[schema.index[name]]
+        np.testing.assert_array_equal(full[schema.full_index], y)
+
+
+def test_constants_fill_the_states_that_are_not_integrated():
+    y = np.arange(STATE_3D.size, dtype=float)
+    full = STATE_3D.unpack(y, RB)
+
+    for name, value in RB.items():
+        assert full[FULL_LAYOUT.index(name)] == value
+    for name in ("rb1_dot", "rb2_dot", "rb3_dot", "pad1", "pad2"):
+        assert full[FULL_LAYOUT.index(name)] == 0.0
+
+    # 2D: the out-of-plane states read as zero, rp3 as its glider variable
+    y = np.arange(1.0, STATE_2D.size + 1)
+    view = STATE_2D.view(y, {"rp3": 0.05})
+    i = STATE_2D.index
+    np.testing.assert_array_equal(view["rp"], [y[i["rp1"]], 0.0, 0.05])
+    np.testing.assert_array_equal(view["v"], [y[i["v1"]], 0.0, y[i["v3"]]])
+    assert view["phi"] == 0.0 and view["psi"] == 0.0
+
+
+def test_trajectories_unpack_sample_by_sample():
+    rng = np.random.default_rng(1)
+    Y = rng.normal(size=(STATE_3D.size, 6))
+    full = STATE_3D.unpack(Y, RB)
+
+    for k in range(Y.shape[1]):
+        np.testing.assert_array_equal(full[:, k], STATE_3D.unpack(Y[:, k], RB))
+
+
+def test_pack_and_get_round_trip():
+    rng = np.random.default_rng(2)
+    y = rng.normal(size=STATE_3D.size)
+    values = {
+        vector: STATE_3D.get(y, vector)
+        for vector in ("n1", "Omega", "v", "rp", "rp_dot", "n2")
+    }
+    values["mb"] = STATE_3D.get(y, "mb")
+
+    np.testing.assert_array_equal(STATE_3D.pack(values), y)
+
+    # 2D packs the in-plane components of full 3-vectors
+    z = rng.normal(size=STATE_2D.size)
+    values = {
+        vector: STATE_2D.get(z, vector, {"rp3": 0.05})
+        for vector in ("n1", "Omega", "v", "rp", "rp_dot", "n2")
+    }
+    values["mb"] = STATE_2D.get(z, "mb")
+
+    np.testing.assert_array_equal(STATE_2D.pack(values), z)
@@ -3,6 +3,7 @@ import math
 import json
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from State.state_schema import STATE_3D
 
 
 def transformationMatrix(phi, theta, psi):
@@ -32,7 +33,7 @@ def transformationMatrix(phi, theta, psi):
 
     J2_n2 = np.array(
         [
-            [1, math.sin(theta) * math.tan(theta), math.cos(phi) * math.tan(theta)],
+            [1, math.sin(phi) * math.tan(theta), math.cos(phi) * math.tan(theta)],
             [0, math.cos(phi), -math.sin(phi)],
             [0, math.sin(phi) / math.cos(theta), math.cos(phi) / math.cos(theta)],
         ]
@@ -59,12 +60,12 @@ def constants():
     return g, I3, Z3, i_hat, j_hat, k_hat
 
 
-def save_json(vars, path="vars/2d_glider_variables.json"):
+def save_json(vars, path):
     with open(path, "w", encoding="utf-8") as file:
         json.dump(vars, file, separators=(",", ":"), sort_keys=True, indent=4)
 
 
-def load_json(path="vars/2d_glider_variables.json"):
+def load_json(path):
     file = open(path)
 
     return json.load(file)
@@ -83,28 +84,15 @@ def PID(kp, ki, kd, setpoint, measured, integral, dt, derivative):
 
 
 def plots(t, x, plot):
-    vel = []
-    phi = []
-    theta = []
-    psi = []
-    for i in range(len(t)):
-        v = math.sqrt(math.pow(x[6][i], 2) + math.pow(x[8][i], 2))
-        phi_angle = math.degrees(x[-3][i])
-        theta_angle = math.degrees(x[-2][i])
-        psi_angle = math.degrees(x[-1][i]) % 360
-        vel.append(v)
-        phi.append(phi_angle)
-        theta.append(theta_angle)
-        psi.append(psi_angle)
-
-    vel = np.array(vel)
-    phi = np.array(phi)
-    theta = np.array(theta)
-    psi = np.array(psi)
+    # x gives named access to the states, e.g. State.state_schema.STATE_3D.view
+    vel = np.sqrt(x["v1"] ** 2 + x["v3"] ** 2)
+    phi = np.degrees(x["phi"])
+    theta = np.degrees(x["theta"])
+    psi = np.degrees(x["psi"]) % 360
 
     if plot == ["3D"]:
         ax = plt.axes(projection="3d")
-        ax.plot3D(x[0], x[1], x[2], "gray")
+        ax.plot3D(x["x"], x["y"], x["z"], "gray")
         x1, y1, z1 = [0, 200], [0, 70], [0, 70]
         ax.plot(x1, y1, z1, color="red")
         ax.set_xlabel("x (m)")
@@ -116,28 +104,28 @@ def plots(t, x, plot):
     elif plot == ["all"] or plot == "all":
         fig = plt.figure()
         ax = fig.add_subplot(2, 2, 1, projection="3d")
-        ax.plot3D(x[0], x[1], x[2], "gray")
+        ax.plot3D(x["x"], x["y"], x["z"], "gray")
         ax.set_xlabel("x (m)")
         ax.set_ylabel("y (m)")
         ax.set_zlabel("z (m)")
         ax.invert_zaxis()
         ax = fig.add_subplot(2, 2, 2)
-        ax.plot(x[0], x[2])
+        ax.plot(x["x"], x["z"])
         ax.set(xlabel="x (m)", ylabel="z (m)")
         ax = fig.add_subplot(2, 2, 3)
-        ax.plot(x[1], x[2])
+        ax.plot(x["y"], x["z"])
         ax.set(xlabel="y (m)", ylabel="z (m)")
         ax = fig.add_subplot(2, 2, 4)
-        ax.plot(x[1], x[0])
+        ax.plot(x["y"], x["x"])
         ax.set(xlabel="y (m)", ylabel="x (m)")
         plt.show()
 
         fig, ax = plt.subplots(3, 2)
-        ax[0, 0].plot(t, x[0])
+        ax[0, 0].plot(t, x["x"])
         ax[0, 0].set(xlabel="time (s)", ylabel="x (m)")
-        ax[1, 0].plot(t, x[1])
+        ax[1, 0].plot(t, x["y"])
         ax[1, 0].set(xlabel="time (s)", ylabel="y (m)")
-        ax[2, 0].plot(t, x[2])
+        ax[2, 0].plot(t, x["z"])
         ax[2, 0].set(xlabel="time (s)", ylabel="z (m)")
         ax[0, 1].plot(t, phi)
         ax[0, 1].set(xlabel="time (s)", ylabel="phi (deg)")
@@ -149,22 +137,22 @@ def plots(t, x, plot):
 
         fig = plt.figure()
         ax = fig.add_subplot(4, 2, 1)
-        ax.plot(t, x[3])
+        ax.plot(t, x["p"])
         ax.set(xlabel="time (s)", ylabel="Omega1 (rad/s)")
         ax = fig.add_subplot(4, 2, 3)
-        ax.plot(t, x[4])
+        ax.plot(t, x["q"])
         ax.set(xlabel="time (s)", ylabel="Omega2 (rad/s)")
         ax = fig.add_subplot(4, 2, 5)
-        ax.plot(t, x[5])
+        ax.plot(t, x["r"])
         ax.set(xlabel="time (s)", ylabel="Omega3 (rad/s)")
         ax = fig.add_subplot(4, 2, 2)
-        ax.plot(t, x[6])
+        ax.plot(t, x["v1"])
         ax.set(xlabel="time (s)", ylabel="v1 (m/s)")
         ax = fig.add_subplot(4, 2, 4)
-        ax.plot(t, x[7])
+        ax.plot(t, x["v2"])
         ax.set(xlabel="time (s)", ylabel="v2 (m/s)")
         ax = fig.add_subplot(4, 2, 6)
-        ax.plot(t, x[8])
+        ax.plot(t, x["v3"])
         ax.set(xlabel="time (s)", ylabel="v3 (m/s)")
         ax = fig.add_subplot(4, 1, 4)
         ax.plot(t, vel)
@@ -172,46 +160,46 @@ def plots(t, x, plot):
         plt.show()
 
         fig, ax = plt.subplots(2, 2)
-        ax[0, 0].plot(t, x[9])
+        ax[0, 0].plot(t, x["rp1"])
         ax[0, 0].set(xlabel="time (s)", ylabel="rp1 (m)")
-        ax[1, 0].plot(t, x[10])
+        ax[1, 0].plot(t, x["rp2"])
         ax[1, 0].set(xlabel="time (s)", ylabel="rp2 (m)")
-        ax[0, 1].plot(t, x[11])
+        ax[0, 1].plot(t, x["rp3"])
         ax[0, 1].set(xlabel="time (s)", ylabel="rp3 (m)")
-        ax[1, 1].plot(t, x[21])
+        ax[1, 1].plot(t, x["mb"])
         ax[1, 1].set(xlabel="time (s)", ylabel="mb (kg)")
         plt.show()
 
     else:
         for p in plot:
             if p == "x":
-                plt.plot(t, x[0])
+                plt.plot(t, x["x"])
             elif p == "y":
-                plt.plot(t, x[1])
+                plt.plot(t, x["y"])
             elif p == "z":
-                plt.plot(t, x[2])
+                plt.plot(t, x["z"])
             elif p == "omega1":
-                plt.plot(t, x[3])
+                plt.plot(t, x["p"])
             elif p == "omega2":
-                plt.plot(t, x[4])
+                plt.plot(t, x["q"])
             elif p == "omega3":
-                plt.plot(t, x[5])
+                plt.plot(t, x["r"])
             elif p == "v1":
-                plt.plot(t, x[6])
+                plt.plot(t, x["v1"])
             elif p == "v2":
-                plt.plot(t, x[7])
+                plt.plot(t, x["v2"])
             elif p == "v3":
-                plt.plot(t, x[8])
+                plt.plot(t, x["v3"])
             elif p == "vel":
                 plt.plot(t, vel)
             elif p == "rp1":
-                plt.plot(t, x[9])
+                plt.plot(t, x["rp1"])
             elif p == "rp2":
-                plt.plot(t, x[10])
+                plt.plot(t, x["rp2"])
             elif p == "rp3":
-                plt.plot(t, x[11])
+                plt.plot(t, x["rp3"])
             elif p == "mb":
-                plt.plot(t, x[21])
+                plt.plot(t, x["mb"])
             elif p == "phi":
                 plt.plot(t, phi)
             elif p == "theta":
@@ -220,3 +208,91 @@ def plots(t, x, plot):
                 plt.plot(t, psi)
 
             plt.show()
+
+
+def fleet_plots(t, trajectory, plot):
+    # trajectory is (N, STATE_3D.size, T): one solver_array.T per glider
+    if plot == ["3D"] or plot == ["all"] or plot == "all":
+        fig = plt.figure()
+        ax = fig.add_subplot(1, 2, 1, projection="3d")
+        for x in trajectory:
+            x = STATE_3D.view(x)
+            ax.plot3D(x["x"], x["y"], x["z"])
+        ax.set_xlabel("x (m)")
+        ax.set_ylabel("y (m)")
+        ax.set_zlabel("z (m)")
+        ax.invert_zaxis()
+        ax = fig.add_subplot(1, 2, 2)
+        for x in trajectory:
+            x = STATE_3D.view(x)
+            ax.plot(x["y"], x["x"])
+        ax.set(xlabel="y (m)", ylabel="x (m)")
+        plt.show()
+
+    if plot == ["all"] or plot == "all":
+        fig, ax = plt.subplots(3, 1)
+        for x in trajectory:
+            x = STATE_3D.view(x)
+            ax[0].plot(t, x["z"])
+            ax[1].plot(t, np.degrees(x["psi"]) % 360)
+            ax[2].plot(t, x["mb"])
+        ax[0].set(xlabel="time (s)", ylabel="z (m)")
+        ax[1].set(xlabel="time (s)", ylabel="psi (deg)")
+        ax[2].set(xlabel="time (s)", ylabel="mb (kg)")
+        ax[0].invert_yaxis()
+        plt.show()
+
+
+def glide_equilibrium(e_i_d, V_d, var, m=None, beta_d=0.0):
+    # Closed-form steady glide of set_desired_trajectory, vectorized over the
+    # desired glide angles e_i_d (rad). var holds the glider variables of the
+    # models (glider_variables); m overrides the displaced mass.
+    g = constants()[0]
+    e_i_d = np.asarray(e_i_d, dtype=float)
+    m = var["m"] if m is None else m
+    KL, KL0, KD, KD0 = var["KL"], var["KL0"], var["KD"], var["KD0"]
+    KM, KM0 = var["KM"], var["KM0"]
+    Mf = np.asarray(var["Mf"])
+
+    alpha_d = (
+        (1 / 2)
+        * (KL / KD)
+        * np.tan(e_i_d)
+        * (
+            -1
+            + np.sqrt(
+                1
+                - 4
+                * (KD / np.power(KL, 2))
+                * (1 / np.tan(e_i_d))
+                * (KD0 * (1 / np.tan(e_i_d)) + KL0)
+            )
+        )
+    )
+
+    mb_d = (m - var["mh"] - var["mm"]) + (1 / g) * (
+        -np.sin(e_i_d) * (KD0 + KD * np.power(alpha_d, 2))
+        + np.cos(e_i_d) * (KL0 + KL * alpha_d)
+    ) * np.power(V_d, 2)
+
+    theta_d = e_i_d + alpha_d
+
+    v1_d = V_d * np.cos(alpha_d) * np.cos(beta_d)
+    v2_d = V_d * np.sin(beta_d) * np.ones_like(alpha_d)
+    v3_d = V_d * np.sin(alpha_d) * np.cos(beta_d)
+
+    rp1_d = -var["rp3"] * np.tan(theta_d) + (1 / (var["mm"] * g * np.cos(theta_d))) * (
+        (Mf[..., 2, 2] - Mf[..., 0, 0]) * v1_d * v3_d
+        + (KM0 + KM * alpha_d) * np.power(V_d, 2)
+    )
+
+    return {
+        "alpha_d": alpha_d,
+        "mb_d": mb_d,
+        "m0_d": mb_d + var["mh"] + var["mm"] - m,
+        "theta_d": theta_d,
+        "v1_d": v1_d,
+        "v2_d": v2_d,
+        "v3_d": v3_d,
+        "rp1_d": rp1_d,
+    }